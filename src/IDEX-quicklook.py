@@ -35,6 +35,16 @@ try:
     numLib +=1
     from readTrc import Trc
     numLib +=1
+    from trcIndex import DEFAULT_PATTERN, indexRun
+    numLib +=1
+    from runSession import RunSession
+    numLib +=1
+    from runFits import fitFolder
+    numLib +=1
+    from fitWorker import ExportWorker, IonFitWorker, QDWorker
+    numLib +=1
+    from envelopePyramid import EnvelopePyramid
+    numLib +=1
     from ImpactSQLConnector import SQLWindow
     numLib +=1
     from PyQt6.QtCore import QSize  # , Qt
@@ -73,26 +83,8 @@ plt.style.use('seaborn-pastel')
 
 
 # logging.debug("Plotting settings loaded.")
-# %%INITIALIZE (AND/OR DECLARE) GLOBAL VARIABLES
-global traceNumber
-global traceList
-global times
-global amps
-global metas
-global nChannels
-global channelNames
-global numDisplay
-global displayDex
-global mass
-global velocity
-global trcdir
-times = []
-amps = []
-metas = []
-traceList = []
-mass = []
-velocity = []
-traceNumber = 1
+# The open run, the shot on display and the matched accelerator data live in
+# a runSession.RunSession owned by each MainWindow.
 
 # %%DO OUR BEST TO SET THE BASE DIRECTORY
 """
@@ -160,11 +152,13 @@ except ImportError:
 # %%SET UP INTERACTIVE PLOT
 class MplCanvas(FigureCanvasQTAgg):
 
-    def __init__(self, parent=None, width=15, height=8, dpi=100):
-        """A class to set up the interactive matplotlib plot. Uses the global
-        traceNumber and channelNames variables to decide which data to display.
+    def __init__(self, session, parent=None, width=15, height=8, dpi=100):
+        """A class to set up the interactive matplotlib plot. The session's
+        displayDex and channelNames decide which channels get an axis.
 
         Args:
+           session (RunSession): The run being displayed.
+
            width (float):  The width of the figure.
            height (float):  The height of the figure.
            dpi (float):  Controls the quality of the interactive plot. Stands
@@ -181,19 +175,17 @@ class MplCanvas(FigureCanvasQTAgg):
            None
            """
 
-        global traceNumber
-        global channelNames
-        global numDisplay
-        global displayDex
-        global mass
-        global velocity
-        traceNumber = 1
-        self.numDisplay = numDisplay
+        self.session = session
+        displayDex = list(session.displayDex)
+        channelNames = session.channelNames + [
+            "Channel {}".format(k + 1)
+            for k in range(len(session.channelNames), session.nChannels)]
+        self.numDisplay = len(displayDex)
         self.fig = Figure(figsize=(width, height), dpi=dpi)
 
-        self.fig.suptitle("Trace Number " + str(traceNumber) + ": {:.2e} kg Particle @ {:.2e} km/s".format(mass[traceNumber-1],
-                             velocity[traceNumber-1]),
-                             fontsize=20)
+        # Drawn with the lines, so a new shot never forces a full redraw
+        self.title = self.fig.suptitle(session.title(), fontsize=20,
+                                       animated=True)
 
         if(self.numDisplay == 1):
             self.ax = self.fig.add_subplot(111)
@@ -291,21 +283,134 @@ class MplCanvas(FigureCanvasQTAgg):
             print("Invalid number of channels to display, must be 1, 2, 3, or",
                   "4.")
 
+        if(self.numDisplay == 1):
+            self.channelAxes = [self.ax]
+        else:
+            self.channelAxes = [getattr(self, "ax{}".format(k + 1))
+                                for k in range(self.numDisplay)]
+        # One persistent line per displayed channel, updated with set_data
+        self.lines = [None] * len(self.channelAxes)
+        self._background = None
+
         super().__init__(self.fig)
+        self.mpl_connect('draw_event', self._onDraw)
+
+    # %%BLITTING OF THE PER-SHOT ARTISTS
+    def _onDraw(self, event):
+        """After every full draw, cache the static decorations (axes, grid,
+        labels, ticks) and put the animated lines and title back on top."""
+        self._background = self.copy_from_bbox(self.fig.bbox)
+        self._drawAnimated()
+
+    def _drawAnimated(self):
+        self.fig.draw_artist(self.title)
+        for line in self.lines:
+            if line is not None:
+                line.axes.draw_artist(line)
+
+    def _blit(self):
+        """Redraw only the lines and title over the cached background."""
+        if self._background is None:
+            self.draw_idle()
+            return
+        self.restore_region(self._background)
+        self._drawAnimated()
+        self.blit(self.fig.bbox)
+
+    # %%UPDATE THE CANVAS FOR A NEW SHOT
+    def setTitle(self, text, redraw=False):
+        """Change the figure title. showTraces redraws it with the lines;
+        redraw blits it on its own, for a title that changes between
+        shots."""
+        self.title.set_text(text)
+        if redraw:
+            self._blit()
+
+    def showTraces(self, pyramids):
+        """Show one waveform per displayed channel. Existing lines are
+        reused through set_data; axis limits only change when the new shot
+        no longer fits them, otherwise just the lines are blitted over the
+        cached decorations.
+
+        Args:
+           pyramids (list): The :class:`EnvelopePyramid` of each waveform,
+           one per entry of channelAxes; see :meth:`RunSession.pyramids`.
+
+        Kwargs:
+           None
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        fullDraw = self._background is None
+        for k, (ax, pyramid) in enumerate(zip(self.channelAxes, pyramids)):
+            if len(pyramid) == 0:
+                if self.lines[k] is not None:
+                    self.lines[k].set_data([], [])
+                continue
+            if self.lines[k] is None:
+                self.lines[k], = ax.plot([], [], markersize=.5, lw=.5,
+                                         animated=True)
+                ax.callbacks.connect('xlim_changed', self._refineLOD)
+            line = self.lines[k]
+            line.pyramid = pyramid
+            fullDraw |= self._autoscale(ax, pyramid)
+            xmin, xmax = ax.get_xlim()
+            line.set_data(*pyramid.select(xmin, xmax, ax.bbox.width))
+        if fullDraw:
+            self.draw_idle()
+        else:
+            self._blit()
+
+    def _autoscale(self, ax, pyramid):
+        """Fit ax to the pyramid's data range, keeping the current limits
+        when the data still fills most of them. Returns True if the limits
+        changed and the decorations have to be redrawn."""
+        # The coarsest envelope level holds the global extremes
+        lo = float(pyramid.yMin[-1].min())
+        hi = float(pyramid.yMax[-1].max())
+        pad = 0.05 * (hi - lo) if hi > lo else max(abs(hi), 1.0) * 0.05
+        lo, hi = lo - pad, hi + pad
+        x0, x1 = float(pyramid.x[0]), float(pyramid.x[-1])
+
+        changed = False
+        if ax.get_xlim() != (x0, x1):
+            ax.set_xlim(x0, x1)
+            changed = True
+        yLo, yHi = ax.get_ylim()
+        if lo < yLo or hi > yHi or (hi - lo) < 0.5 * (yHi - yLo):
+            ax.set_ylim(lo, hi)
+            changed = True
+        return changed
+
+    def _refineLOD(self, ax):
+        """Redraw the lines of ax at the level of detail of its new x-range."""
+        xmin, xmax = ax.get_xlim()
+        for line in self.lines:
+            if line is not None and line.axes is ax:
+                line.set_data(*line.pyramid.select(xmin, xmax,
+                                                   ax.bbox.width))
+        self.draw_idle()
 
 
 # %%SET UP QT WINDOW OBJECT
 # Subclass QMainWindow to customize your application's main window
 class MainWindow(QMainWindow):
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, session=None):
         """A class to set up the main pyQT user interface.
 
         Args:
            None
 
         Kwargs:
-           None
+           parent (QWidget): The Qt parent.
+
+           session (RunSession): An already opened run to view. If None, the
+           user is asked for a folder of trace files.
 
         Returns:
            None
@@ -315,125 +420,52 @@ class MainWindow(QMainWindow):
            """
         super(MainWindow, self).__init__(parent)
 
-        global channelNames
-        global nChannels
-        global times
-        global amps
-        global metas
-        global traceList
-        global traceNumber
-        global numDisplay
-        global displayDex
-        global mass
-        global velocity
-        global trcdir
-
         self.renderPlot = False
         self.setWindowTitle("SpectrumPY Beta Main Window")
-        trcdir = QFileDialog.getExistingDirectory(self, ''''Please Select A
-                                                  Folder Containing Trace
-                                                  Files''')
-        times, amps, metas = generalReadTRC(trcdir)
-
-
-        self.timeStamps = []
-
-        for k in range(len(metas)-1):
-
-            timeArr = metas[k][0]['TRIGGER_TIME']
-            # print(*timeArr)
-            date_time = datetime.datetime(*timeArr)
-            date_time = date_time.timestamp()
-            # date_time = dt.replace(tzinfo=datetime.timezone.utc).timestamp()
-            # date_time = datetime.datetime.strptime(datetime.datetime(*timeArr, '%Y %m %d %h %s %ms')).timestamp()
-
-            # print(date_time)
-            # this is in yyyymmddhhmmss.ms format
-            self.timeStamps.append(1000*int(date_time))
-        self.sql_win = SQLWindow(self.timeStamps)
-
-
-        # Associate all SQL quantities, remember:
-        # ||"Estimate Quality",
-        # ||"Time",
-        # ||"Velocity (km/s)",
-        # ||"Mass (kg)",
-        # ||"Charge (C)",
-        # ||"Radius (m)"
-        self.Mass = self.sql_win.df["Mass (kg)"]
-        self.Velocity = self.sql_win.df["Velocity (km/s)"]
-        self.Charge = self.sql_win.df["Charge (C)"]
-        self.Size = self.sql_win.df["Radius (m)"]
-        mass = self.sql_win.df["Mass (kg)"]
-        velocity = self.sql_win.df["Velocity (km/s)"]
-
-        channelNames = []
-
-        # Check to see if the channels are predefined
-        if(os.path.exists(trcdir + "/settings.txt")):
-            settingsFile = open(trcdir + '/settings.txt', 'r')
-            Lines = settingsFile.readlines()
+        self.session = session if session is not None else RunSession(self)
+        self.session.shotChanged.connect(self.showTrace)
+        self.session.displayChanged.connect(self._replaceCanvas)
+        self.session.sqlMatched.connect(self._sqlMatched)
+        self.session.sqlFailed.connect(self._sqlFailed)
+        self.session.shotReady.connect(self._shotPrefetched)
+        self.ionFitter = IonFitWorker(self)
+        self.ionFitter.shotFitted.connect(self._ionShotFitted)
+        self.ionFitter.shotFailed.connect(self._ionShotFailed)
+        self.ionFitter.finished.connect(self._ionFitFinished)
+        self.ionFitter.failed.connect(self._ionFitFailed)
+        self.qdAnalyzer = QDWorker(self)
+        self.qdAnalyzer.finished.connect(self._qdFinished)
+        self.qdAnalyzer.failed.connect(self._qdFailed)
+        self.exporter = ExportWorker(self)
+        self.exporter.finished.connect(self._exportFinished)
+        self.exporter.failed.connect(self._exportFailed)
+
+        if self.session.run is None:
+            trcdir = QFileDialog.getExistingDirectory(self, ''''Please Select A
+                                                      Folder Containing Trace
+                                                      Files''')
+            self.session.open(trcdir)
+        self.sql_win = SQLWindow()
+        self._matchSQL()
+
+        self._loadChannelNames()
 
-            for line in Lines:
-                channelNames.append(str(line))
-        else:
-            # If there is no settings file, prompt the user to enter
-            # the channel name(s)
-            prompter = ("No settings.txt file found. {}"
-                        " channels detected, ").format(str(nChannels))
-            #            "please enter the name of "
-            #            "Channel 1".format(str(nChannels)))
-            for chan in range(int(nChannels)):
-                le, done = QInputDialog.getText(self, 'Input Dialog',
-                                                      (prompter +
-                                                       "please enter the name"
-                                                       " of Channel {}"
-                                                       ).format(str(chan+1)))
-                if done:
-                    channelNames.append(le)
-
-            dlg = QMessageBox(self)
-            dlg.setWindowTitle("Save channel settings")
-            dlg.setText(("Would you like to save these channel names for"
-                        " future use?"))
-            dlg.setStandardButtons(QMessageBox.StandardButton.Yes |
-                                   QMessageBox.StandardButton.No)
-            dlg.setIcon(QMessageBox.Icon.Question)
-            button = dlg.exec()
-
-            if button == QMessageBox.StandardButton.Yes:
-                # writing user-provided settings to a file
-                settingsFile = open(trcdir+'/settings.txt', 'w')
-                for name in channelNames:
-                    settingsFile.write("%s\n" % str(name))
-                settingsFile.close()
-
-        # Call channel choosing window
-        numDisplay = 4
-        displayDex = [0, 1, 2, 3]
-        # print("numDisplay: ", numDisplay)
         self.tracelist_widget = QListWidget()
-
-        for trace in traceList:
-            self.tracelist_widget.insertItem(int(trace), str(trace))
+        self._fillTraceList()
 
         self.v_layout = QVBoxLayout()
         self.tracelist_widget.clicked.connect(self.updatePlot)
-        self.tracelist_widget.setCurrentRow(traceNumber)
+        self.tracelist_widget.setCurrentRow(self.session.traceNumber)
         self._createMenuBar()
         self._createActions()
 
-        # print(self.renderPlot)
-
-        # if(self.channelWin.complete):
-        self.sc = MplCanvas(self, width=16, height=12, dpi=100)
-        displayTRC(times[traceNumber], amps[traceNumber], self.sc)
+        self.sc = MplCanvas(self.session, self, width=16, height=12, dpi=100)
         self.toolbar = NavigationToolbar(self.sc, self)
         self.setCentralWidget(self.sc)
         self.v_layout.addStretch()
         self.v_layout.addWidget(self.toolbar)
         self.sc.setLayout(self.v_layout)
-
+        self.session.setTraceNumber(self.session.traceNumber)
 
         self.show()
 
@@ -449,19 +481,113 @@ class MainWindow(QMainWindow):
         button = dlg.exec()
 
         if button == QMessageBox.StandardButton.Yes:
-            global times
-            global amps
-            global traceNumber
             import pandas as pd
-            a = times[traceNumber]
-            b = amps[traceNumber]
+            a, b = self.session.shot()
             df = pd.DataFrame({"Time (s)": a, "Amplitude": b})
             df.to_csv("Specoutput.csv", index=False)
+            self.ionFitter.shutdown()
+            self.qdAnalyzer.shutdown()
+            self.exporter.shutdown()
+            self.session.close()
             event.accept()
 
         else:
             event.ignore()
 
+# %%FOLLOW THE SESSION
+    def _matchSQL(self):
+        """Start matching the session's traces against the accelerator
+        database. The query runs on the session's worker thread; the table
+        and the plot title are filled in by :meth:`_sqlMatched`."""
+        self.sql_win.setStatus("Querying the accelerator database...")
+        self.session.matchSQL()
+
+    def _loadChannelNames(self):
+        """Ask for the channel names if the run folder has no settings.txt,
+        and offer to save them there for next time.
+
+        Args:
+           None
+
+        Kwargs:
+           None
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        if self.session.channelNames:
+            return
+        nChannels = self.session.nChannels
+        trcdir = self.session.trcdir
+        channelNames = []
+        # If there is no settings file, prompt the user to enter
+        # the channel name(s)
+        prompter = ("No settings.txt file found. {}"
+                    " channels detected, ").format(str(nChannels))
+        for chan in range(int(nChannels)):
+            le, done = QInputDialog.getText(self, 'Input Dialog',
+                                                  (prompter +
+                                                   "please enter the name"
+                                                   " of Channel {}"
+                                                   ).format(str(chan+1)))
+            if done:
+                channelNames.append(le)
+        self.session.setChannelNames(channelNames)
+
+        dlg = QMessageBox(self)
+        dlg.setWindowTitle("Save channel settings")
+        dlg.setText(("Would you like to save these channel names for"
+                    " future use?"))
+        dlg.setStandardButtons(QMessageBox.StandardButton.Yes |
+                               QMessageBox.StandardButton.No)
+        dlg.setIcon(QMessageBox.Icon.Question)
+        button = dlg.exec()
+
+        if button == QMessageBox.StandardButton.Yes:
+            # writing user-provided settings to a file
+            settingsFile = open(trcdir+'/settings.txt', 'w')
+            for name in channelNames:
+                settingsFile.write("%s\n" % str(name))
+            settingsFile.close()
+
+    def _fillTraceList(self):
+        self.tracelist_widget.clear()
+        for trace in self.session.traceList:
+            # Shot index k is listed as Trace Number k + 1
+            self.tracelist_widget.insertItem(int(trace), str(trace + 1))
+
+    def _replaceCanvas(self):
+        """Slot for :attr:`RunSession.displayChanged`. The number of axes is
+        fixed when a canvas is built, so a new channel selection gets a new
+        canvas."""
+        self.sc = MplCanvas(self.session, self, width=16, height=12, dpi=100)
+        self.toolbar.setParent(None)
+        self.setCentralWidget(self.sc)
+        self.v_layout.addStretch()
+        self.toolbar = NavigationToolbar(self.sc, self)
+        self.v_layout.addWidget(self.toolbar)
+        self.sc.setLayout(self.v_layout)
+        self.showTrace()
+
+    def _sqlMatched(self):
+        self.sql_win.setData(self.session.sqlMatch)
+        if hasattr(self, "sc"):
+            self.sc.setTitle(self.session.title(), redraw=True)
+
+    def _sqlFailed(self, message):
+        self.sql_win.setStatus("Accelerator database query failed: "
+                               + message)
+        self.statusBar().showMessage("Accelerator database query failed",
+                                     5000)
+
+    def _shotPrefetched(self, shotIdx):
+        """Slot for :attr:`RunSession.shotReady`, runs on the Qt thread once
+        a neighbouring shot is sitting in the cache."""
+        self.statusBar().showMessage("Trace {} ready".format(shotIdx + 1), 2000)
+
 # %%CREATE MENU BAR AND FILE DROP DOWN OPTIONS
     def _createMenuBar(self):
         """This function sets up the toolbar options located above the
@@ -514,8 +640,8 @@ class MainWindow(QMainWindow):
         toolbar.addSeparator()
 
 
-        button_action2 = QAction(scopecsvIcon, "&Export Scope Data to .csv", self)
-        button_action2.setStatusTip("Export Dataset (*.csv)")
+        button_action2 = QAction(scopecsvIcon, "&Export Scope Data to .h5", self)
+        button_action2.setStatusTip("Export Dataset (*.h5)")
         button_action2.triggered.connect(self.exportScopeData)
         # button_action2.setCheckable(True)
         toolbar.addAction(button_action2)
@@ -528,6 +654,10 @@ class MainWindow(QMainWindow):
         listTraces = QAction(traceIcon, "&Choose Trace", self)
         listTraces.triggered.connect(self.chooseTrace)
 
+        timeIcon = qta.icon("mdi.clock-outline")
+        goToTime = QAction(timeIcon, "&Go to Trigger Time", self)
+        goToTime.triggered.connect(self.jumpToTime)
+
         helpIcon = qta.icon("mdi.help-circle-outline")
         getHelp = QAction(helpIcon, "&Read the Docs", self)
         getHelp.triggered.connect(self.helpPage)
@@ -586,6 +716,7 @@ class MainWindow(QMainWindow):
 
         view_menu = menu.addMenu("&View")
         view_menu.addAction(listTraces)
+        view_menu.addAction(goToTime)
         view_menu.addAction(changeChannels)
         view_menu.addAction(trace_up)
         view_menu.addAction(trace_down)
@@ -646,7 +777,11 @@ class MainWindow(QMainWindow):
         Raises:
            None
            """
-        global trcdir
+        if self.session.sqlMatch is None:
+            self.statusBar().showMessage("The accelerator data has not "
+                                         "arrived yet", 5000)
+            return
+        trcdir = self.session.trcdir
         traceName = os.path.basename(os.path.normpath(trcdir))
         folder = os.path.join(trcdir, "SQL_{}".format(str(traceName)))
 
@@ -656,22 +791,23 @@ class MainWindow(QMainWindow):
             shutil.rmtree(folder)           # Removes all the subdirectories!
             os.mkdir(folder)
 
-        self.sql_win.df.to_csv(os.path.join(folder, "{}_SQL.csv".format(str(traceName))))
+        self.session.sqlMatch.to_csv(os.path.join(folder, "{}_SQL.csv".format(str(traceName))))
 
 
 
-# %%WRITE TIMES AND AMPS TO CSV
+# %%EXPORT EVERY SHOT OF THE RUN
     def exportScopeData(self, s):
-        """Action associated with the "export data" option. Pandas is imported
-        alone here since it can be time consuming. It takes the time and
-        amplitude arrays from the current trace shot being viewed and writes
-        them both as a two column csv.
+        """Action associated with the "export data" option. Every shot of the
+        run is written to SPY_OUT_<run> as one HDF5 file, with the channel
+        names from settings.txt. Only shots that are new or changed since the
+        last export are written, see :func:`runExport.exportRun`, on a
+        worker thread.
 
         Args:
            None
 
         Kwargs:
-           s (str): The destination filename for the csv data.
+           s (bool): The checked state passed by the triggered signal.
 
         Returns:
            None
@@ -679,41 +815,16 @@ class MainWindow(QMainWindow):
         Raises:
            None
            """
-        global times
-        global amps
-        global traceNumber
-        global displayDex
-        global trcdir
-        import pandas as pd
-        dec = 1  # The factor of decimation (Makes plotting faster)
-        # dec = 312  # for low rate ADC's  (1/sampling rate)
-        # dec = 38 for high rate ADC's
-        i = dec*np.array(range(int(len(times[int(traceNumber)][displayDex[0]])/dec)))
-        # print(i)
-        traceName = os.path.basename(os.path.normpath(trcdir))
-        folder = os.path.join(trcdir, "SPY_OUT_{}".format(str(traceName)))
-        if not os.path.exists(folder):
-            os.mkdir(folder)
-        else:
-            shutil.rmtree(folder)           # Removes all the subdirectories!
-            os.mkdir(folder)
-
-        for count, tracenum in enumerate(amps):
-            Time = times[int(count)][0][i]  # Assume this is the same for each channel
-            QDLowAmp = amps[int(count)][0][i]
-            QDHighAmp = amps[int(count)][1][i]
-            TOFLowAmp = amps[int(count)][2][i]
-            TOFMidAmp = amps[int(count)][3][i]
-            TOFHighAmp = amps[int(count)][4][i]
-            IonGridAmp = amps[int(count)][5][i]
-            TargetLowAmp = amps[int(count)][6][i]
-            TargetHighAmp = amps[int(count)][7][i]
-            df = pd.DataFrame({"Time (s)": Time, "QD Pickup Tube Low Amplitude (V)": QDLowAmp, "QD Pickup Tube High Amplitude (V)": QDHighAmp, "TOF Low Amplitude (V)": TOFLowAmp, "TOF Mid Amplitude (V)": TOFMidAmp, "TOF High Amplitude (V)": TOFHighAmp,  "Ion Grid Amplitude (V)": IonGridAmp, "Target Low Amplitude (V)": TargetLowAmp, "Target High Amplitude (V)": TargetHighAmp})
-            df.to_csv(os.path.join(folder, "{}.csv".format(str(count))), index=False)
-
+        self.exporter.start(self.session.trcdir)
+        self.statusBar().showMessage("Exporting shots...")
 
+    def _exportFinished(self, written, folder):
+        self.statusBar().showMessage("Exported {} shot(s) to {}".format(
+            written, folder), 5000)
 
-        # self.sql_win.df.to_csv("Accelerator_SQL_Output.csv")
+    def _exportFailed(self, message):
+        print("Export failed: {}".format(message))
+        self.statusBar().showMessage("Export failed: " + message)
 
 
 # %%CHANGE SHOT BEING VIEWED
@@ -733,71 +844,9 @@ class MainWindow(QMainWindow):
         Raises:
            None
            """
-        global traceNumber
-        self.tracelist_widget.setCurrentRow(traceNumber)
-        print("Trace Number = {}".format(traceNumber))
-
-        for i in range(self.tracelist_widget.count()):
-            if((traceNumber+1) == i+1):
-                print("Shifting trace up.")
-                traceNumber += 1
-
-        global displayDex
-        global times
-        global amps
-        global metas
-        global mass
-        global velocity
-        global numDisplay
-    
-
-        if(displayDex == []):
-            displayDex = [0, 1, 2, 3]
-            numDisplay = 4
-        # print("Updating Plot...")
-
-        self.sc.fig.suptitle("Trace Number " + str(traceNumber) + ": {:.2e} kg Particle @ {:.2e} km/s".format(mass[traceNumber-1],
-                             velocity[traceNumber-1]),
-                             fontsize=20)
-
-        if hasattr(self.sc, 'ax1'):
-            self.sc.ax1.cla()
-            self.sc.ax1.grid(True)
-            self.sc.ax1.set_ylabel(str(channelNames[displayDex[0]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax2'):
-            self.sc.ax2.cla()
-            self.sc.ax2.grid(True)
-            self.sc.ax2.set_ylabel(str(channelNames[displayDex[1]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax3'):
-            self.sc.ax3.cla()
-            self.sc.ax3.grid(True)
-            self.sc.ax3.set_ylabel(str(channelNames[displayDex[2]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax4'):
-            self.sc.ax4.cla()
-            self.sc.ax4.grid(True)
-            self.sc.ax4.set_xticks([])
-            self.sc.ax4.set_ylabel(str(channelNames[displayDex[3]]),
-                                   labelpad=4)
-
-        self.setCentralWidget(self.sc)
-        self.v_layout.addStretch()
-        self.v_layout.addWidget(self.toolbar)
-        self.sc.setLayout(self.v_layout)
-
-        # Load new data into the interactive plot.
-        displayTRC(times[traceNumber], amps[traceNumber], self.sc)
-
-        # Get rid of the trace choosing widget
-        self.tracelist_widget.setParent(None)
-        self.tracelist_widget.setParent(self)
-        self.sc.draw()
-        self.show()
+        print("Trace Number = {}".format(self.session.traceNumber + 1))
+        print("Shifting trace up.")
+        self.session.step(1)
 
 # %%CHANGE SHOT BEING VIEWED
     def downTrace(self, s):
@@ -816,70 +865,75 @@ class MainWindow(QMainWindow):
         Raises:
            None
            """
-        global traceNumber
-        for i in range(self.tracelist_widget.count()):
-            if((traceNumber-1) == i+1):
-                print("Shifting trace down.")
-                traceNumber -= 1
-
-        global displayDex
-        global times
-        global amps
-        global metas
-        global mass
-        global velocity
-        global numDisplay
-    
-
-        if(displayDex == []):
-            displayDex = [0, 1, 2, 3]
-            numDisplay = 4
-        # print("Updating Plot...")
-
-
-        # self.sc = MplCanvas(self, width=16, height=12, dpi=100)
-        self.sc.fig.suptitle("Trace Number " + str(traceNumber) + ": {:.2e} kg Particle @ {:.2e} km/s".format(mass[traceNumber-1],
-                             velocity[traceNumber-1]),
-                             fontsize=20)
-
-        if hasattr(self.sc, 'ax1'):
-            self.sc.ax1.cla()
-            self.sc.ax1.grid(True)
-            self.sc.ax1.set_ylabel(str(channelNames[displayDex[0]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax2'):
-            self.sc.ax2.cla()
-            self.sc.ax2.grid(True)
-            self.sc.ax2.set_ylabel(str(channelNames[displayDex[1]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax3'):
-            self.sc.ax3.cla()
-            self.sc.ax3.grid(True)
-            self.sc.ax3.set_ylabel(str(channelNames[displayDex[2]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax4'):
-            self.sc.ax4.cla()
-            self.sc.ax4.grid(True)
-            self.sc.ax4.set_xticks([])
-            self.sc.ax4.set_ylabel(str(channelNames[displayDex[3]]),
-                                   labelpad=4)
+        print("Shifting trace down.")
+        self.session.step(-1)
 
-        self.setCentralWidget(self.sc)
-        self.v_layout.addStretch()
-        self.v_layout.addWidget(self.toolbar)
-        self.sc.setLayout(self.v_layout)
+# %%DRAW THE CURRENT SHOT
+    def showTrace(self, traceNumber=None):
+        """Put the session's current trace on the canvas. Connected to
+        :attr:`RunSession.shotChanged`. The canvas keeps its axes, labels and
+        lines between shots and only swaps the line data, see
+        :meth:`MplCanvas.showTraces`.
+
+        Args:
+           None
 
-        # Load new data into the interactive plot.
-        displayTRC(times[traceNumber], amps[traceNumber], self.sc)
+        Kwargs:
+           None
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.sc.setTitle(self.session.title())
+        self.tracelist_widget.setCurrentRow(self.session.traceNumber)
+
+        # Load new data into the interactive plot, from the envelopes
+        # cached with the shot when it was shown before
+        self.sc.showTraces(self.session.pyramids(
+            self.session.displayDex[:len(self.sc.channelAxes)]))
 
         # Get rid of the trace choosing widget
         self.tracelist_widget.setParent(None)
         self.tracelist_widget.setParent(self)
-        self.sc.draw()
-        self.show()
+
+# %%CHANGE SHOT BEING VIEWED
+    def jumpToTime(self, s):
+        """Ask for a trigger time and show the trace that was triggered
+        closest to it.
+
+        Args:
+           None
+
+        Kwargs:
+           s (bool): The checked state passed by the triggered signal.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        text, done = QInputDialog.getText(self, 'Go to Trigger Time',
+                                          ("Trigger time (YYYY-MM-DD hh:mm:ss"
+                                           " or epoch ms):"))
+        if not done or not text.strip():
+            return
+        try:
+            ms = int(text)
+        except ValueError:
+            try:
+                ms = int(1000 * datetime.datetime.fromisoformat(
+                    text.strip()).timestamp())
+            except ValueError:
+                self.statusBar().showMessage("Not a time: {}".format(text),
+                                             5000)
+                return
+        shotIdx = self.session.shotAtTime(ms)
+        if shotIdx is not None:
+            self.session.setTraceNumber(shotIdx)
 
 # %%CHANGE SHOT BEING VIEWED
     def chooseTrace(self, s):
@@ -955,34 +1009,36 @@ class MainWindow(QMainWindow):
         Raises:
            None
            """
-        global channelNames
-        global amps
-        global times
-        global displayDex
-        global trcdir
+        trcdir = self.session.trcdir
 
         print("Fitting Ion Grid Waveforms")
-        import pandas as pd
-        from SudaIonTarget import ImpactEvent
-        traceName = os.path.basename(os.path.normpath(trcdir))
-        folder = os.path.join(trcdir, "{}_IonGridFits".format(str(traceName)))
-        if not os.path.exists(folder):
-            os.mkdir(folder)
-        else:
-            shutil.rmtree(folder)           # Removes all the subdirectories!
-            os.mkdir(folder)
-        os.chdir(folder)
-        dec = 1  # The factor of decimation (Makes plotting faster)
-        i = dec*np.array(range(int(len(times[0][displayDex[0]])/dec)))
-
-        for count, traceNumber in enumerate(amps):
-            Time = pd.Series(times[int(count)][0][i])  # Assume this is the same for each channel
-            IonGridAmp = pd.Series(amps[int(count)][5][i])
-            IonEvent = ImpactEvent(Time, IonGridAmp, str(count))
-            IonEvent.fitIonSignal()
-            IonEvent.plotIonSignalFit()
-        
-        
+        folder = fitFolder(trcdir)
+        os.makedirs(folder, exist_ok=True)
+        # Every shot is fitted in a process pool; results arrive by signal.
+        # The earlier fits of this run are dropped from the store, not the
+        # whole folder, once the previous job has stopped
+        self._ionFitCount = 0
+        self.ionFitter.start(trcdir, folder, fresh=True)
+        self.statusBar().showMessage("Fitting ion grid waveforms...")
+
+    def _ionShotFitted(self, shotIdx, params):
+        self._ionFitCount += 1
+        self.statusBar().showMessage("Fitted trace {} ({} of {})".format(
+            shotIdx + 1, self._ionFitCount, len(self.session.traceList)))
+
+    def _ionShotFailed(self, shotIdx, message):
+        self._ionFitCount += 1
+        print("Ion grid fit of trace {} failed: {}".format(shotIdx + 1,
+                                                           message))
+
+    def _ionFitFinished(self, nFitted, nFailed):
+        self.statusBar().showMessage(
+            "Ion grid fits done: {} fitted, {} failed".format(nFitted,
+                                                              nFailed))
+
+    def _ionFitFailed(self, message):
+        print("Ion grid fitting failed: {}".format(message))
+        self.statusBar().showMessage("Ion grid fitting failed: " + message)
 
 
 # %%FIT EXISTING QD WAVEFORMS
@@ -1002,6 +1058,22 @@ class MainWindow(QMainWindow):
            None
            """
         print("Fitting QD Waveforms")
+        # Every shot at once on a worker thread; the table arrives by signal
+        self.qdAnalyzer.start(self.session.trcdir)
+        self.statusBar().showMessage("Analysing QD waveforms...")
+
+    def _qdFinished(self, df, path):
+        message = "QD: {} of {} shots detected, median {:.2f} km/s".format(
+            int(df["Detected"].sum()), len(df), df["Velocity (km/s)"].median())
+        if "Velocity Ratio" in df:
+            message += ", {:.2f} x the accelerator".format(
+                df["Velocity Ratio"].median())
+        print("{} ({})".format(message, path))
+        self.statusBar().showMessage(message)
+
+    def _qdFailed(self, message):
+        print("QD analysis failed: {}".format(message))
+        self.statusBar().showMessage("QD analysis failed: " + message)
 
 # %%BRING UP MATCHED SQL DATA
     def viewSQLWindow(self, s):
@@ -1041,70 +1113,10 @@ class MainWindow(QMainWindow):
         Raises:
            None
            """
-        global traceNumber
-        global displayDex
-        global times
-        global amps
-        global metas
-        global mass
-        global velocity
-        global numDisplay
-    
-
-        if(displayDex == []):
-            displayDex = [0, 1, 2, 3]
-            numDisplay = 4
         print("Updating Plot...")
         content = str(self.tracelist_widget.currentItem().text())
         # print(content)
-        traceNumber = int(content)
-
-        # self.sc = MplCanvas(self, width=16, height=12, dpi=100)
-        self.sc.fig.suptitle("Trace Number " + str(traceNumber) + ": {:.2e} kg Particle @ {:.2e} km/s".format(mass[traceNumber-1],
-                             velocity[traceNumber-1]),
-                             fontsize=20)
-        # Clear all axes
-        # self.sc.ax.cla()
-        # if(numDisplay == 1):
-        #     self.sc.ax.cla()
-        if hasattr(self.sc, 'ax1'):
-            self.sc.ax1.cla()
-            self.sc.ax1.grid(True)
-            self.sc.ax1.set_ylabel(str(channelNames[displayDex[0]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax2'):
-            self.sc.ax2.cla()
-            self.sc.ax2.grid(True)
-            self.sc.ax2.set_ylabel(str(channelNames[displayDex[1]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax3'):
-            self.sc.ax3.cla()
-            self.sc.ax3.grid(True)
-            self.sc.ax3.set_ylabel(str(channelNames[displayDex[2]]),
-                                   labelpad=4)
-
-        if hasattr(self.sc, 'ax4'):
-            self.sc.ax4.cla()
-            self.sc.ax4.grid(True)
-            self.sc.ax4.set_xticks([])
-            self.sc.ax4.set_ylabel(str(channelNames[displayDex[3]]),
-                                   labelpad=4)
-
-        self.setCentralWidget(self.sc)
-        self.v_layout.addStretch()
-        self.v_layout.addWidget(self.toolbar)
-        self.sc.setLayout(self.v_layout)
-
-        # Load new data into the interactive plot.
-        displayTRC(times[int(content)], amps[int(content)], self.sc)
-
-        # Get rid of the trace choosing widget
-        self.tracelist_widget.setParent(None)
-        self.tracelist_widget.setParent(self)
-        self.sc.draw()
-        self.show()
+        self.session.setTraceNumber(int(content) - 1)
 
 # %%OPEN A FILE DIALOG TO IMPORT SCOPE DATA
     def importScopeData(self, s):
@@ -1122,91 +1134,17 @@ class MainWindow(QMainWindow):
         Raises:
            None
            """
-        global channelNames
-        global traceList
-        global times
-        global amps
-        global metas
-        global displayDex
-        global mass
-        global velocity
-        global trcdir
         trcdir = QFileDialog.getExistingDirectory(self, ''''Please select a
                                                  folder containing trace
                                                  files.''')
-        times = None
-        amps = None
-        metas = None
-        channelNames = []
-        displayDex = [0, 1, 2, 3]
-        times, amps, metas = generalReadTRC(trcdir)
-
-        self.timeStamps = []
-
-        for k in range(len(metas)-1):
-
-            timeArr = metas[k][0]['TRIGGER_TIME']
-            # print(timeArr)
-
-            date_time = 1000 * \
-                datetime.datetime.timestamp(datetime.datetime(*timeArr))
-
-
-            # this is in yyyymmddhhmmss.ms format
-            self.timeStamps.append(int(date_time))
-
-        channelNames = []
-        # Check to see if the channels are predefined
-        if(os.path.exists(trcdir + "/settings.txt")):
-            settingsFile = open(trcdir + '/settings.txt', 'r')
-            Lines = settingsFile.readlines()
-
-            for line in Lines:
-                channelNames.append(str(line))
-        else:
-            # If there is no settings file, prompt the user to enter
-            # the channel name(s)
-            prompter = ("No settings.txt file found. {}"
-                        " channels detected, ").format(str(nChannels))
-            #            "please enter the name of "
-            #            "Channel 1".format(str(nChannels)))
-            for chan in range(int(nChannels)):
-                le, done = QInputDialog.getText(self, 'Input Dialog',
-                                                      (prompter +
-                                                       "please enter the name"
-                                                       " of Channel {}"
-                                                       ).format(str(chan+1)))
-                if done:
-                    channelNames.append(le)
-
-            dlg = QMessageBox(self)
-            dlg.setWindowTitle("Save channel settings")
-            dlg.setText(("Would you like to save these channel names for"
-                        " future use?"))
-            dlg.setStandardButtons(QMessageBox.StandardButton.Yes |
-                                   QMessageBox.StandardButton.No)
-            dlg.setIcon(QMessageBox.Icon.Question)
-            button = dlg.exec()
-
-            if button == QMessageBox.StandardButton.Yes:
-                # writing user-provided settings to a file
-                settingsFile = open(trcdir+'/settings.txt', 'w')
-                for name in channelNames:
-                    settingsFile.write("%s\n" % str(name))
-                settingsFile.close()
-
-        # Call channel choosing window
-        # self.show_new_window()
-
-        self.tracelist_widget = QListWidget()
-
-        for trace in traceList:
-            self.tracelist_widget.insertItem(int(trace), str(trace))
-        self.tracelist_widget.clicked.connect(self.updatePlot)
-        self.updatePlot
-        self.sql_win = SQLWindow(self.timeStamps)
-        mass = self.sql_win.df["Mass (kg)"]
-        velocity = self.sql_win.df["Velocity (km/s)"]
+        self.ionFitter.cancel()
+        self.qdAnalyzer.cancel()
+        self.session.open(trcdir)
+        self.sql_win.setData(None)
+        self._loadChannelNames()
+        self._fillTraceList()
+        self._matchSQL()
+        self._replaceCanvas()
         self.sql_win.show()
 
 
@@ -1219,12 +1157,8 @@ class ChannelChoosingWindow(QWidget):
 
     def __init__(self, MainWindow):
         super(ChannelChoosingWindow, self).__init__()
-        global channelNames
-        global numDisplay
-        global displayDex
-        displayDex = []
+        self.displayDex = []
         self.displayChannels = []
-        numDisplay = 0
         # super(ChannelChoosingWindow, self).__init__(parent)
         self.complete = False
         self.parent = MainWindow
@@ -1249,7 +1183,7 @@ class ChannelChoosingWindow(QWidget):
         # Create as many checkboxes as channels
         ySpacing = 100
         cB = {}
-        for name in channelNames:
+        for name in MainWindow.session.channelNames:
             cB[name] = QCheckBox('{}'.format(name), self)
             cB[name].move(20, ySpacing)
             cB[name].toggled.connect(self.Selected_Value)
@@ -1266,25 +1200,19 @@ class ChannelChoosingWindow(QWidget):
 
     # %%DEFINE FUNCTION TO READ THE USER'S INPUT
     def Selected_Value(self):
-        global numDisplay
-        global displayDex
-        global channelNames
+        channelNames = self.parent.session.channelNames
 
         # print("Selected: ", self.sender().isChecked(),
         #      "  Name: ", self.sender().text())
 
         if(self.sender().isChecked()):
             self.lblText += self.sender().text()
-            numDisplay += 1
             # self.displayChannels.append(self.sender().text())
-            displayDex.append(channelNames.index(self.sender().text()))
+            self.displayDex.append(channelNames.index(self.sender().text()))
         else:
             self.lblText.replace(self.sender().text(), '')
-            numDisplay -= 1
-            displayDex.remove(channelNames.index(self.sender().text()))
+            self.displayDex.remove(channelNames.index(self.sender().text()))
             # self.displayChannels.remove(self.sender().text())
-        # print("Number of displays: ", numDisplay)
-        # super().numDisplay = numDisplay
         if self.lblText :
             self.label.setText('You have selected \n' + self.lblText)
         # for disp in self.displayChannels:
@@ -1292,43 +1220,15 @@ class ChannelChoosingWindow(QWidget):
         # self.parent.updatePlot
         # print(self.parent.__dict__)
         # self.parent.updatePlot
-        print(displayDex)
+        print(self.displayDex)
 
 # %%DEFINE FUNCTION TO READ THE USER'S INPUT
     def Submit_Plot(self):
-        global traceNumber
-        global times
-        global amps
-        global metas
-        global mass
-        global velocity
-
-        self.parent.sc = MplCanvas(self.parent, width=16, height=12, dpi=100)
-        self.parent.toolbar.setParent(None)
-        self.parent.setCentralWidget(self.parent.sc)
-        self.parent.v_layout.addStretch()
-        self.parent.toolbar = NavigationToolbar(self.parent.sc, self.parent)
-        self.parent.v_layout.addWidget(self.parent.toolbar)
-        self.parent.sc.setLayout(self.parent.v_layout)
-
-        traceNumber = 2
-        displayTRC(times[int(traceNumber)], amps[int(traceNumber)],
-                   self.parent.sc)
-        self.parent.sc.fig.suptitle("Trace Number " + str(traceNumber) + ": {:.2e} kg Particle @ {:.2e} km/s".format(mass[traceNumber-1],
-                             velocity[traceNumber-1]),
-                             fontsize=20)
-        self.parent.updatePlot
-        self.parent.sc.draw()
+        # The main window rebuilds its canvas on displayChanged
+        self.parent.session.setDisplay(self.displayDex)
 
     # %%HANDLER FUNCTION TO TRIGGER MAIN WINDOW UPON CLOSE
     def closeEvent(self, event):
-        global numDisplay
-        global displayDex
-
-        if(numDisplay <= 0 or numDisplay > 4):
-            numDisplay = 4
-        if(displayDex == []):
-            displayDex = [0, 1, 2, 3]
         dlg = QMessageBox(self)
         dlg.setWindowTitle("Close window")
         dlg.setText(("Are you sure you want to close the channel window?"))
@@ -1352,7 +1252,7 @@ class ChannelChoosingWindow(QWidget):
 
 
 # %%GENERAL TRACE READER
-def generalReadTRC(dataDir, verbose=False):
+def generalReadTRC(dataDir, verbose=False, pattern=DEFAULT_PATTERN):
     """A function to read in the binary trace files from the oscilloscopes. It
     is general for different instruments and scope configurations. The number
     of channels and shots is automatically detected and sorted.
@@ -1368,6 +1268,9 @@ def generalReadTRC(dataDir, verbose=False):
            or not they want real-time print statements of all relevant
            quantities.
 
+           pattern (str): The file name pattern handed to
+           :func:`trcIndex.indexRun`.
+
         Returns:
            times (list): A 2 dimensional list containing the time arrays for
            each shot.
@@ -1379,72 +1282,41 @@ def generalReadTRC(dataDir, verbose=False):
            for each shot. **TODO** Figure out this format and make it a dict.
 
         Exceptions:
-           FileNotFoundError: The cue to stop parsing the user-provuded
-           directory for any more trace files.
-
-            ZeroDivisionError: This will be reaised if there are no files
-            detected at all.
+           None. Missing channels are reported and left as empty arrays with
+           None metadata so that channel columns stay aligned.
            """
     # __author__= Ethan Ayari
-    # Iterate through all files in the folder and attempt to sort them
-    parse = True
-
-    global times
-    global amps
-    global metas
-    global nChannels
-    global traceList
     times = []
     amps = []
     metas = []
-    shotKey = "00000"
-    nChannels = 0
-    while parse:
-        # Shot number must be given as a 5 digit number
-        # Initialize empty scope object
-        trc = Trc()
+
+    # Scan the folder once instead of once per shot
+    index = indexRun(dataDir, pattern=pattern, verbose=verbose)
+    index.report()
+    if index.nShots == 0:
+        print("No data was detected.")
+
+    trc = Trc()
+    for row in index.paths:
         tmpTime = []
         tmpAmp = []
         tmpMeta = []
-        # Iterate through all files in passed directory
-        parsetwo = False
-        # for filename in os.scandir(dataDir):
-        directoryList = sorted(os.scandir(dataDir), key=lambda e: e.name)
-        for filename in directoryList:
-            # print(str(filename))
-            # Gather all channels for shotKey
-            if(str(filename).find(shotKey) != -1):
-                parsetwo = True
-                if verbose:
-                    print(str(filename.path))
-                try:
-                    t, y, meta = trc.open(str(filename.path))
-                    # t, y, meta = trc.open(str(filename))
-                    tmpTime.append(t)
-                    tmpAmp.append(y)
-                    tmpMeta.append(meta)
-                    nChannels += 1
-                except FileNotFoundError:
-                    # We've found everything
-                    parse = False
-        if not parsetwo:
-            parse = False
-
+        for path in row:
+            if path is None:
+                tmpTime.append(np.empty(0))
+                tmpAmp.append(np.empty(0))
+                tmpMeta.append(None)
+                continue
+            if verbose:
+                print(path)
+            t, y, meta = trc.open(path)
+            tmpTime.append(t)
+            tmpAmp.append(y)
+            tmpMeta.append(meta)
         times.append(tmpTime)
         amps.append(tmpAmp)
         metas.append(tmpMeta)
-        i = int(shotKey) + 1
-        shotKey = f'{i:05d}'
-    shotKey = int(shotKey)-1  # Get rid of extra shot count
-    try:
-        nChannels = int(int(nChannels) / int(shotKey))
-    except ZeroDivisionError:
-        print("No data was detected.")
 
-    traceList = list(range(1, len(times)-1))
-    if verbose:
-        print(r"{} channels detected.".format(nChannels))
-        print(r"{} shots detected per each channel.".format(int(shotKey)))
     return times, amps, metas
 
 
@@ -1458,9 +1330,6 @@ def readTRC(dataDir):
     trcName4 = '/C4Fe'  # Look at the name of the files (Before the num)
     number = -1  # Starts on this number +1
     trcS = '.trc'
-    global times
-    global amps
-    global metas
     times = []
     amps = []
     metas = []
@@ -1490,14 +1359,11 @@ def readTRC(dataDir):
         except FileNotFoundError:
             parse = False
 
-    # Update trace list
-    global traceList
-    traceList = list(range(1, len(times)+1))
     return times, amps, metas
 
 
 # %%TRACE FILE DISPLAY
-def displayTRC(times, amps, sc):
+def displayTRC(times, amps, sc, displayDex=(0, 1, 2, 3)):
     """Update the matplotlib canvas with the user-provided choice of trace.
 
         Args:
@@ -1511,7 +1377,7 @@ def displayTRC(times, amps, sc):
            defined above.
 
         Kwargs:
-           None
+           displayDex (list): The channel indices to show, one per axis.
 
         Returns:
            None
@@ -1519,57 +1385,15 @@ def displayTRC(times, amps, sc):
         Raises:
            None
            """
-    global channelNames
-    global nChannels
-    global numDisplay
-    global displayDex
     # print("amps: ", len(amps))
     # print(displayDex)
     # print("Displaying oscilloscope output")
-    if(displayDex == []):
+    if(len(displayDex) == 0):
         displayDex = [0, 1, 2, 3]
-    dec = 1  # The factor of decimation (Makes plotting faster)
-    i = dec*np.array(range(int(len(times[displayDex[0]])/dec)))
-
-    # Format the channel properly if it is a TOF channel
-    for name in range(len(channelNames)):
-        if('Low' in channelNames[name] or 'High' in channelNames[name] or 'Mid' in channelNames[name]):
-            # amps[name] = -1*amps[name]
-            pass
-            for k in range(len(amps[name])):
-                if(amps[name][k] <= 10**-4):
-                    # amps[name][k] = 10**-4
-                    pass
 
     # ONE AXIS FOR REACH CHANNEL
-    if(numDisplay == 1):
-        sc.ax.plot(times[displayDex[0]][i], amps[displayDex[0]][i],
-                   markersize=.5, lw=.5)
-
-    if(numDisplay == 2):
-        sc.ax1.plot(times[displayDex[0]][i], amps[displayDex[0]][i],
-                    markersize=.5, lw=.5)
-        sc.ax2.plot(times[displayDex[1]][i], amps[displayDex[1]][i],
-                    markersize=.5, lw=.5)
-
-    if(numDisplay == 3):
-        sc.ax1.plot(times[displayDex[0]][i], amps[displayDex[0]][i],
-                    markersize=.5, lw=.5)
-        sc.ax2.plot(times[displayDex[1]][i], amps[displayDex[1]][i],
-                    markersize=.5, lw=.5)
-        sc.ax3.plot(times[displayDex[2]][i], amps[displayDex[2]][i],
-                    markersize=.5, lw=.5)
-
-    if(numDisplay == 4):
-        sc.ax1.plot(times[displayDex[0]][i], amps[displayDex[0]][i],
-                    markersize=.5, lw=.5)
-        sc.ax2.plot(times[displayDex[1]][i], amps[displayDex[1]][i],
-                    markersize=.5, lw=.5)
-        sc.ax3.plot(times[displayDex[2]][i], amps[displayDex[2]][i],
-                    markersize=.5, lw=.5)
-        sc.ax4.plot(times[displayDex[3]][i], amps[displayDex[3]][i],
-                    markersize=.5, lw=.5)
-    sc.draw()
+    sc.showTraces([EnvelopePyramid(times[dex], amps[dex])
+                   for dex in displayDex[:len(sc.channelAxes)]])
 
 
 # %%NECESSARY WAITING FUNCION
@@ -9,11 +9,18 @@ Works with Python 3.9
 """
 
 # %%DEPENDENCIES
-from decimal import DivisionByZero
+import os
+
 from scipy.optimize import curve_fit
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from fitStore import ION_GRID_MODEL, TARGET_MODEL, fitRecord
+from waveformDefaults import IMAGE_START, ONSET_SIGMA, SMOOTH_FRACTION
+from waveformStats import waveformStats
 
 # %%DEPENDENCIES
 plt.style.use('seaborn-white')
@@ -30,15 +37,321 @@ plt.rcParams['legend.fontsize'] = 10
 plt.rcParams['figure.titlesize'] = 12
 plt.rcParams['agg.path.chunksize'] = 10_000
 
+# %%SHARED PIECES OF THE ION GRID AND TARGET MODELS
+def _pulseTerms(x, P0, P3, P5, P6):
+    # Each exponential is only evaluated on its own side of the impact
+    # time, so none can overflow however the solver moves the parameters
+    d = x - P0
+    pre = d < 0.0                       # heaviside(P0-x, 0)
+    post = d > 0.0                      # heaviside(x-P0, 0)
+    dPre = np.where(pre, d, 0.0)
+    dPost = np.where(post, d, 0.0)
+    image = np.where(pre, np.exp(-dPre**2.0 / P3**2.0), 0.0)
+    rise = np.exp(-dPost / P5)
+    riseFrac = np.where(post, 1.0 - rise, 0.0)
+    decay = np.where(post, np.exp(-dPost / P6), 0.0)
+    return dPre, dPost, post, image, rise, riseFrac, decay
+
+
+def _pulseJacobian(x, P0, P2, P3, P4, P5, P6):
+    # Closed-form partial derivatives, one column per parameter P0..P6
+    dPre, dPost, post, image, rise, riseFrac, decay = _pulseTerms(
+        x, P0, P3, P5, P6)
+    jac = np.empty((len(x), 7))
+    jac[:, 0] = (-P2 * image * 2.0 * dPre / P3**2.0
+                 + P4 * decay * (riseFrac / P6 - np.where(post, rise, 0.0)
+                                 / P5))
+    jac[:, 1] = 1.0
+    jac[:, 2] = -image - post
+    jac[:, 3] = -P2 * image * 2.0 * dPre**2.0 / P3**3.0
+    jac[:, 4] = riseFrac * decay
+    jac[:, 5] = -P4 * decay * np.where(post, rise, 0.0) * dPost / P5**2.0
+    jac[:, 6] = P4 * riseFrac * decay * dPost / P6**2.0
+    return jac
+
+
 # %%ALTERNATE ION GRID FUNCTION DEFINITON
 def AlterIDEXIonGrid(x, P0, P1, P2, P3, P4, P5, P6):
-    return P1 - np.heaviside(P0-x, 0) * P2 * np.exp(-(((x-P0)**2.0)/P3**2.0) ) + np.heaviside(x-P0, 0) * ( P4 * (1.0 - np.exp(-(x-P0)/P5)) * np.exp( -(x-P0)/P6) - P2)
+    dPre, dPost, post, image, rise, riseFrac, decay = _pulseTerms(
+        np.asarray(x, dtype=float), P0, P3, P5, P6)
+    return P1 - P2 * image + np.where(post, P4 * riseFrac * decay - P2, 0.0)
+
+
+def ionGridJacobian(x, P0, P1, P2, P3, P4, P5, P6):
+    """The (len(x), 7) Jacobian of AlterIDEXIonGrid, for curve_fit's jac."""
+    return _pulseJacobian(np.asarray(x, dtype=float), P0, P2, P3, P4, P5, P6)
+
 
 # %%ALTERNATE ION GRID FUNCTION DEFINITON
 def IDEXTarget(x, P0, P1, P2, P3, P4, P5, P6):
-    P2 = 0.0
-    print(P1)
-    return P1 - np.heaviside(P0-x, 0) * P2 * np.exp(-(((x-P0)**2.0)/P3**2.0) ) + np.heaviside(x-P0, 0) * ( P4 * (1.0 - np.exp(-(x-P0)/P5)) * np.exp( -(x-P0)/P6) - P2)
+    # The target sees no image charge
+    return AlterIDEXIonGrid(x, P0, P1, 0.0, P3, P4, P5, P6)
+
+
+def targetJacobian(x, P0, P1, P2, P3, P4, P5, P6):
+    """The Jacobian of IDEXTarget; P2 and P3 have no effect on it."""
+    jac = _pulseJacobian(np.asarray(x, dtype=float), P0, 0.0, P3, P4, P5, P6)
+    jac[:, 2] = 0.0
+    return jac
+
+
+# The parameters of [t0, c, b, s, A, t1, t2] that IDEXTarget depends on;
+# the image charge b and width s are held fixed when fitting it
+TARGET_FREE = [0, 1, 4, 5, 6]
+
+
+# %%PHYSICAL LIMITS OF THE FIT PARAMETERS
+MAX_DECAY_RECORDS = 100  # Longest discharge time, in record lengths
+
+
+def pulseBounds(x):
+    """(lower, upper) bounds of [t0, c, b, s, A, t1, t2] for a record with
+    times x: the impact inside the record, the image width and rise time
+    between one sample and the record length, the discharge time between
+    one sample and MAX_DECAY_RECORDS record lengths. Offsets and
+    amplitudes are free."""
+    start, end = float(np.min(x)), float(np.max(x))
+    span = end - start
+    step = span / max(len(x) - 1, 1)
+    lower = [start, -np.inf, -np.inf, step, -np.inf, step, step]
+    upper = [end, np.inf, np.inf, span, np.inf, span,
+             MAX_DECAY_RECORDS * span]
+    return np.array(lower), np.array(upper)
+
+
+def _boundedFit(model, jac, x, y, p0, full_output=False, free=None):
+    # Trust-region reflective fit with the analytic Jacobian, from p0
+    # moved inside the bounds. Only the parameters at the indices free are
+    # fitted, the others keep their p0 values and get a NaN covariance.
+    # full_output adds the covariance diagonal, the residual RMS and the
+    # number of model evaluations
+    lower, upper = pulseBounds(x)
+    p0 = np.clip(np.asarray(p0, dtype=float), lower, upper)
+    if free is None:
+        fitted, cov, info, mesg, ier = curve_fit(
+            model, x, y, p0=p0, jac=jac, bounds=(lower, upper),
+            method="trf", full_output=True)
+        param, covDiag = fitted, np.diag(cov)
+    else:
+        free = np.asarray(free)
+
+        def full(p):
+            param = p0.copy()
+            param[free] = p
+            return param
+
+        fitted, cov, info, mesg, ier = curve_fit(
+            lambda x, *p: model(x, *full(p)), x, y, p0=p0[free],
+            jac=lambda x, *p: jac(x, *full(p))[:, free],
+            bounds=(lower[free], upper[free]), method="trf",
+            full_output=True)
+        param = full(fitted)
+        covDiag = np.full(len(p0), np.nan)
+        covDiag[free] = np.diag(cov)
+    if not full_output:
+        return param
+    rms = float(np.sqrt(np.mean(info["fvec"]**2)))
+    return param, covDiag, rms, int(info["nfev"])
+
+
+# %%FIT AN ION GRID WAVEFORM FROM PLAIN ARRAYS
+def _smoothed(y, width):
+    # Centred moving average by cumulative sums, same length as y
+    if width <= 1:
+        return y
+    total = np.concatenate([[0.0], np.cumsum(y)])
+    lo = np.clip(np.arange(len(y)) - width // 2, 0, len(y))
+    hi = np.clip(lo + width, 0, len(y))
+    return (total[hi] - total[lo]) / (hi - lo)
+
+
+def pulseGuess(x, y, pre=IMAGE_START, image=True, nSigma=ONSET_SIGMA):
+    """Starting values [t0, c, b, s, A, t1, t2] for AlterIDEXIonGrid or
+    IDEXTarget, read off the waveform with a few whole-array operations:
+    the baseline c and noise from the pre-trigger window, the pulse
+    polarity and height from the extremum after it, the onset t0 where the
+    pulse last left the noise before its extremum, t1 and t2 from the
+    10-90% rise and 90-10% fall times, and the image charge b and width s
+    from the dip between the pre-trigger window and the onset. Levels are
+    read from a moving average over SMOOTH_FRACTION of the record, so
+    single noisy samples do not move them.
+
+        Args:
+           x (np.ndarray): The time (s), increasing.
+
+           y (np.ndarray): The amplitude (V).
+
+        Kwargs:
+           pre (float): The end of the pre-trigger window. If fewer than two
+           samples come before it, the first tenth of the record is used.
+
+           image (bool): Estimate an image charge; False (the target) sets
+           b to 0.
+
+           nSigma (float): The onset threshold in baseline standard
+           deviations.
+
+        Returns:
+           p0 (np.ndarray): The seven starting parameters, inside
+           :func:`pulseBounds`.
+
+        Raises:
+           None
+           """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    lower, upper = pulseBounds(x)
+
+    # Baseline and noise before the trigger
+    baseline = x < pre
+    if np.count_nonzero(baseline) < 2 or baseline.all():
+        baseline = x <= x[0] + 0.1 * (x[-1] - x[0])
+    c = y[baseline].mean()
+    signal = _smoothed(y - c, int(SMOOTH_FRACTION * len(y)))
+    noise = signal[baseline].std()
+
+    # The extremum after the trigger sets polarity and height
+    after = np.flatnonzero(~baseline)
+    k = after[np.argmax(np.abs(signal[after]))]
+    polarity = 1.0 if signal[k] >= 0.0 else -1.0
+    z = polarity * signal
+    peak = z[k]
+
+    # Onset: the last sample before the extremum still within the noise of
+    # the lowest level since the trigger, the bottom of any image dip
+    floor = min(0.0, z[after[0]:k + 1].min())
+    quiet = np.flatnonzero(z[:k] <= floor + min(nSigma * noise,
+                                                 0.5 * (peak - floor)))
+    i0 = quiet[-1] if len(quiet) else 0
+    t0 = x[i0]
+
+    # 10-90% rise, t1 = rise / ln 9 for 1 - exp(-t / t1)
+    below10 = np.flatnonzero(z[:k + 1] < 0.1 * peak)
+    i10 = below10[-1] if len(below10) else i0
+    i90 = i10 + np.argmax(z[i10:k + 1] >= 0.9 * peak)
+    t1 = (x[i90] - x[i10]) / np.log(9.0)
+
+    # 90-10% fall, or the fraction left at the end of the record
+    tail = z[k:]
+    fell90, fell10 = tail < 0.9 * peak, tail < 0.1 * peak
+    if fell10.any() and np.argmax(fell10) > np.argmax(fell90):
+        t2 = (x[k + np.argmax(fell10)] - x[k + np.argmax(fell90)]) / np.log(9.0)
+    else:
+        left = np.clip(tail[-1] / peak, 0.01, 0.99) if peak > 0 else 0.5
+        t2 = (x[-1] - x[k]) / -np.log(left)
+
+    # Image charge: the dip between the trigger window and the onset
+    b, s = 0.0, 4.e-6
+    window = (x >= pre) & (x < t0)
+    if image and window.any():
+        b = max(0.0, -signal[window].min())
+        if b < 2.0 * noise:
+            b = 0.0
+        else:
+            halfDip = np.flatnonzero(window & (-signal >= 0.5 * b))
+            if x[halfDip[0]] < t0:
+                s = (t0 - x[halfDip[0]]) / np.sqrt(np.log(2.0))
+
+    # A such that the peak of A (1 - exp(-t/t1)) exp(-t/t2) - b is the
+    # extremum; that peak is A t2/(t1+t2) (t1/(t1+t2))^(t1/t2)
+    t1 = np.clip(t1, lower[5], upper[5])
+    t2 = np.clip(t2, lower[6], upper[6])
+    shape = t2 / (t1 + t2) * (t1 / (t1 + t2))**(t1 / t2)
+    A = (polarity * peak + b) / shape
+    return np.clip(np.array([t0, c, b, s, A, t1, t2]), lower, upper)
+
+
+def fitIonGrid(x, y, p0=None, previous=None, full_output=False):
+    """Fit AlterIDEXIonGrid to one ion grid waveform. Works on NumPy arrays
+    only, so it can run in a pool process.
+
+        Args:
+           x (np.ndarray): The ion grid time (s).
+
+           y (np.ndarray): The ion grid amplitude (V).
+
+        Kwargs:
+           p0 (np.ndarray): The starting parameters, :func:`pulseGuess`
+           by default.
+
+           previous (np.ndarray): The solution of the previous shot. Its
+           time constants (s, t1, t2) replace those of p0, which still
+           supplies this shot's onset, levels and amplitude; if that warm
+           start does not converge the fit is retried from p0 alone.
+
+           full_output (bool): Also return how good the fit is.
+
+        Returns:
+           param (np.ndarray): The fitted [t0, c, b, s, A, t1, t2], inside
+           :func:`pulseBounds`.
+
+           covDiag (np.ndarray): With full_output, the diagonal of the
+           parameter covariance.
+
+           rms (float): With full_output, the residual RMS (V).
+
+           nfev (int): With full_output, the model evaluations of the
+           solver.
+
+        Raises:
+           RuntimeError: curve_fit did not converge.
+
+           ValueError: The record is empty or holds non-finite samples.
+           """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if p0 is None:
+        p0 = pulseGuess(x, y)
+    if previous is not None:
+        warm = np.array(p0, dtype=float)
+        warm[[3, 5, 6]] = np.asarray(previous, dtype=float)[[3, 5, 6]]
+        try:
+            return _boundedFit(AlterIDEXIonGrid, ionGridJacobian, x, y, warm,
+                               full_output)
+        except RuntimeError:
+            pass
+    return _boundedFit(AlterIDEXIonGrid, ionGridJacobian, x, y, p0,
+                       full_output)
+
+
+def drawIonGridFit(fig, x, y, param, traceNum):
+    """Draw an ion grid waveform and its fit on fig, the plot that
+    IonGrid<n>.png has always held. Only fig is touched, not the pyplot
+    state, so figures can be drawn in any thread or process.
+
+        Args:
+           fig (Figure): An empty matplotlib figure.
+
+           x (np.ndarray): The ion grid time (s).
+
+           y (np.ndarray): The ion grid amplitude (V).
+
+           param (np.ndarray): The fitted [t0, c, b, s, A, t1, t2].
+
+           traceNum (int): The 0-based trace number, shown 1-based.
+
+        Kwargs:
+           None
+
+        Returns:
+           ax (Axes): The axes drawn on.
+
+        Raises:
+           None
+           """
+    ax = fig.add_subplot(111)
+    ax.set_xlabel("Time (s)", fontsize=15)
+    ax.set_ylabel("Voltage (V)", fontsize=15)
+    ax.plot(x, y, label="Ion Grid (V)")
+    ax.plot(x, AlterIDEXIonGrid(x, *param), label="Fit (V)")
+    fig.text(0.5, 0.2, r"Amplitude: %.2e V, $\tau_{Rise}$: %.2e s, "
+             r"$\tau_{Discharge}$: %.2e s" % (param[4], param[5], param[6]),
+             horizontalalignment="center", verticalalignment="center",
+             wrap=True, fontsize=14, color="orange")
+    ax.set_title("Ion Grid Signal Fit number {}".format(traceNum + 1),
+                 fontweight='bold', fontsize=20)
+    ax.legend(loc='best')
+    return ax
 
 
 # %%SET UP INTERACTIVE PLOT
@@ -66,35 +379,35 @@ class ImpactEvent:
            """
         self.x, self.y = ionGridTime, ionGridAmp
         self.traceNum = int(traceNum)
-        self.pre = -3.0e-5  # Before image charge
-        self.yBaseline = self.y.where(self.x < self.pre)
-        self.yImage = self.y[(self.x.values >= self.pre) & (self.x.values < 0.0)]
-        self.ionError = self.yBaseline.std()
-        self.ionErrorVector = pd.DataFrame([np.nan] * len(self.yBaseline))
-        self.ionMean = self.yBaseline.mean()
-        self.yBaseline -= self.ionMean
+        self.pre = IMAGE_START  # Before image charge
+
+        # %% Baseline, noise, image charge, peak, rise and decay in one
+        # pass over the plain arrays, see waveformStats
+        x = np.asarray(self.x, dtype=float)
+        y = np.asarray(self.y, dtype=float)
+        self.stats = {name: value[0] for name, value in waveformStats(
+            y, x[0], (x[-1] - x[0]) / max(len(x) - 1, 1),
+            pre=self.pre).items()}
+        self.ionMean = self.stats["baseline"]
+        self.ionError = self.stats["noise"]
+        self.riseTime = self.stats["rise"]
+        self.decayTime = self.stats["decay"]
+        self.yBaseline = np.where(x < self.pre, y - self.ionMean, np.nan)
+        self.yImage = y[(x >= self.pre) & (x < 0.0)]
+        self.ionErrorVector = np.full(len(y), np.nan)
         self.parameters = []
 
     # %%
     def fitIonSignal(self):
 
-        # %% Initial Guess for the parameters of the ion grid signal
-        t0 = 0.0                         # P[0] time of impact
-        c = 0.                           # P[1] Constant offset
-        b = np.abs(min(self.yImage))     # P[2] Image amplitude
-        # b = .01
-        s = 4.e-6                        # P[3] Image pulse width
-        A  = np.abs(min(self.y) - max(self.y))     # P[4] amplitude (v)
-        # A = .05
-        t1 = 4.3e-5                      # P[5] rise  time (s)
-        t2 = 4.3e-4                      # P[6] discharge time (s)
-        c = 0
+        # %% Initial guess and fit, see pulseGuess and fitIonGrid
+        ionTime = np.asarray(self.x, dtype=float)
+        ionAmp = np.asarray(self.y, dtype=float)
 
-
-        ionTime = np.array(self.x.apply(lambda x: float(x)))
-        ionAmp = np.array(self.y.apply(lambda x: float(x)))
-
-        param, param_cov = curve_fit(AlterIDEXIonGrid, ionTime, ionAmp, p0=[t0, c, b, s, A, t1, t2])
+        param, self.covDiag, self.rms, self.nfev = fitIonGrid(
+            ionTime, ionAmp, pulseGuess(ionTime, ionAmp, self.pre),
+            full_output=True)
+        self.model = ION_GRID_MODEL
         self.parameters = param
         self.IonAmp = param[4]
         self.IontRise = param[5]
@@ -105,31 +418,17 @@ class ImpactEvent:
     # %%
     def fitTargetSignal(self):
 
-        # %% Initial Guess for the parameters of the target signal
-        t0 = 0.0                          # P[0] time of impact
-        c = self.yBaseline + self.ionMean # P[1] Constant offset
-        b = np.abs(min(self.yImage))      # P[2] Image amplitude
-        # b = .01
-        s = 4.e-6                         # P[3] Image pulse width
-        A  = np.abs(min(self.y) - max(self.y))      # P[4] amplitude (v)
-        # A = .05
-        t1 = 4.3e-5                       # P[5] rise  time (s)
-        t2 = 4.3e-4                       # P[6] discharge time (s)
-        c = 0
-
-        try:
-            if(b/self.ionError < 2.0):
-                b = 0.0
-        except DivisionByZero:
-            if(b <= .0001):
-                b = 0.0
-
-
-
-        ionTime = np.array(self.x.apply(lambda x: float(x)))
-        ionAmp = np.array(self.y.apply(lambda x: float(x)))
-
-        param, param_cov = curve_fit(IDEXTarget, ionTime, ionAmp, p0=[t0, c, b, s, A, t1, t2])
+        # %% Initial guess from the waveform; the target has no image charge
+        ionTime = np.asarray(self.x, dtype=float)
+        ionAmp = np.asarray(self.y, dtype=float)
+
+        # b and s do not change IDEXTarget, so only TARGET_FREE are fitted;
+        # they keep their starting values (b = 0) and a NaN covariance
+        param, self.covDiag, self.rms, self.nfev = _boundedFit(
+            IDEXTarget, targetJacobian, ionTime, ionAmp,
+            pulseGuess(ionTime, ionAmp, self.pre, image=False),
+            full_output=True, free=TARGET_FREE)
+        self.model = TARGET_MODEL
         self.parameters = param
 
         self.TargetAmp = param[4]
@@ -139,32 +438,24 @@ class ImpactEvent:
         self.result = IDEXTarget(ionTime, param[0], param[1], param[2], param[3], param[4], param[5], param[6])
 
     # %%
-    def plotIonSignalFit(self):
-        # plt.plot(wave_6["Time (s)"].head(len(self.yBaseline)), self.yBaseline, label="Ion Baseline")
-        # plt.plot(wave_6["Time (s)"].head(len(self.yBaseline)), targetBaseline, label="Target Baseline")
-        # plt.plot(wave_6["Time (s)"], AlterIDEXIonGrid(ionTime, t0, c, b, s, A, t1, t2), label="First Guess")
-        # plt.plot(timeSlice, ampSlice)
-        plt.style.use('seaborn-pastel')
-        # fig = plt.figure(dpi=2000)
-        plt.cla()
-        plt.clf()
-        plt.xlabel("Time (s)", fontsize=15)
-        plt.ylabel("Voltage (V)", fontsize=15)
-        plt.plot(self.x, self.y, label="Ion Grid (V)")
-        plt.plot(self.x, self.result, label = "Fit (V)")
-        plt.figtext(0.5, 0.2,
-            r"Amplitude: %.2e V, $\tau_{Rise}$: %.2e s, $\tau_{Discharge}$: %.2e s"%(self.IonAmp, self.IontRise, self.IontDecay),
-            horizontalalignment ="center", 
-            verticalalignment ="center", 
-            wrap = True, fontsize = 14, 
-            color ="orange")
-        plt.title("Ion Grid Signal Fit number {}".format(str(self.traceNum+1)), fontweight='bold', fontsize=20)
-        plt.legend(loc='best')
-        plt.savefig("IonGrid{}.png".format(str(self.traceNum+1)))
-        print(self.parameters)
-        with open("IonFitResults.txt", "a") as f1:
-            f1.write("Trace {}: t0={} s, c={} V, b={} V, s={} s, A={} V, t1={} s, t2={} s \n".format(str(self.traceNum+1), self.parameters[0], self.parameters[1], self.parameters[2], self.parameters[3], self.parameters[4], self.parameters[5], self.parameters[6]))
-            f1.write('\n')
+    def plotIonSignalFit(self, folder="."):
+        """Draw the ion grid fit to <folder>/IonGrid<n>.png on a figure of
+        its own. The parameters are not written anywhere, see
+        :meth:`fitRecord` and :class:`fitStore.FitStore`."""
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        drawIonGridFit(fig, np.asarray(self.x, dtype=float),
+                       np.asarray(self.y, dtype=float), self.parameters,
+                       self.traceNum)
+        path = os.path.join(folder, "IonGrid{}.png".format(self.traceNum + 1))
+        fig.savefig(path)
+        return path
+
+    # %%
+    def fitRecord(self, run, channel):
+        """The last fit as a :func:`fitStore.fitRecord` row of run."""
+        return fitRecord(run, self.traceNum, channel, self.model,
+                         self.parameters, self.covDiag, self.rms, self.nfev)
 
     # %%
     def plotTargetSignalFit(self):
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless, resumable batch processing of accelerator run folders.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import argparse
+import functools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from fitStore import ION_GRID_MODEL, STATUS_OK, FitStore, storeFile
+from runExport import DEFAULT_FORMAT, FORMATS, exportShot, planExport
+from runFits import ION_GRID_CHANNEL, fitShot, renderShot
+from runStore import consolidate, storePath
+from triggerCatalog import TriggerCatalog, catalogPath
+from trcIndex import DEFAULT_PATTERN, indexRun, readChannelNames
+
+# %%DEFAULTS
+STAGES = ("index", "consolidate", "export", "fit", "render", "qd", "stats",
+          "noise", "match")
+PROGRESS_NAME = "spectrumpy-progress.json"
+SAVE_INTERVAL = 2.0  # Seconds between progress file writes
+
+
+# %%OUTPUT FOLDERS, NAMED AS IN THE QUICKLOOK VIEWER
+def runName(dataDir):
+    return os.path.basename(os.path.normpath(dataDir))
+
+
+def stageFolder(dataDir, stage):
+    """The folder a stage writes into, the same one the quicklook menu
+    action for that stage uses."""
+    name = runName(dataDir)
+    folder = {"fit": "{}_IonGridFits",
+              "render": "{}_IonGridFits",
+              "qd": "{}_QD",
+              "stats": "{}_Stats",
+              "noise": "{}_Noise",
+              "match": "SQL_{}"}[stage].format(name)
+    return os.path.join(dataDir, folder)
+
+
+# %%RESUMABLE PROGRESS
+class RunProgress:
+
+    def __init__(self, dataDir):
+        """What has already been done to a run folder, kept in a JSON file
+        inside it so an interrupted batch picks up where it stopped.
+
+        Args:
+           dataDir (str): The run folder.
+
+        Kwargs:
+           None
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.path = os.path.join(dataDir, PROGRESS_NAME)
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as progressFile:
+                self.stages = json.load(progressFile).get("stages", {})
+        self._saved = time.monotonic()
+
+    def isComplete(self, stage):
+        return self.stages.get(stage, {}).get("complete", False)
+
+    def doneShots(self, stage):
+        return set(self.stages.get(stage, {}).get("done", []))
+
+    def markShot(self, stage, shotIdx):
+        entry = self.stages.setdefault(stage, {"done": []})
+        entry.setdefault("done", []).append(int(shotIdx))
+        if time.monotonic() - self._saved > SAVE_INTERVAL:
+            self.save()
+
+    def complete(self, stage, **info):
+        entry = self.stages.setdefault(stage, {})
+        entry.update(info)
+        entry["complete"] = True
+        self.save()
+
+    def reset(self, stage):
+        self.stages.pop(stage, None)
+        self.save()
+
+    def save(self):
+        # Write then rename, so a kill mid-write never leaves half a file
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as progressFile:
+            json.dump({"stages": self.stages}, progressFile, indent=1)
+        os.replace(tmpPath, self.path)
+        self._saved = time.monotonic()
+
+
+# %%WORK DONE IN THE POOL PROCESSES
+def _consolidateRun(dataDir, pattern):
+    return consolidate(dataDir, pattern=pattern)
+
+
+def _qdRun(dataDir, pattern, catalogFile):
+    # Cross-checked against the accelerator only from a local mirror, a
+    # batch does not wait on the network
+    from dbConnection import mirrorPath
+    from qdAnalysis import analyzeRun, crossCheck, resultsPath
+    df = analyzeRun(dataDir, pattern=pattern)
+    if os.path.exists(mirrorPath()):
+        df = crossCheck(df, dataDir,
+                        db="sqlite:///" + os.path.abspath(mirrorPath()),
+                        pattern=pattern, catalogFile=catalogFile)
+    df.to_csv(resultsPath(dataDir), index=False)
+    return int(df["Detected"].sum())
+
+
+def _statsRun(dataDir, pattern):
+    from waveformStats import resultsPath, statsRun
+    df = statsRun(dataDir, pattern=pattern)
+    df.to_csv(resultsPath(dataDir), index=False)
+    return len(df)
+
+
+def _noiseRun(dataDir, pattern):
+    # Already inside a pool process, so the shots are read right here
+    from noiseDiagnostics import diagnoseRun, resultsPath, summaryTable
+    stats, _ = diagnoseRun(dataDir, workers=1, pattern=pattern)
+    summaryTable(stats, readChannelNames(dataDir)).to_csv(
+        resultsPath(dataDir), index=False)
+    return len(stats)
+
+
+def _matchRun(dataDir, pattern, folder, catalogFile):
+    from dustEvents import matchDustEvents
+    catalog = TriggerCatalog(catalogFile or catalogPath(dataDir))
+    catalog.addRun(dataDir, pattern=pattern)
+    shots, triggerMs = catalog.shotTimes(dataDir)
+    catalog.close()
+    df = matchDustEvents(triggerMs.tolist())
+    df.to_csv(os.path.join(folder, "{}_SQL.csv".format(runName(dataDir))))
+    return len(df)
+
+
+# %%DRIVE THE STAGES
+def processRuns(dataDirs, stages=STAGES, workers=None,
+                pattern=DEFAULT_PATTERN, restart=False,
+                ionChannel=ION_GRID_CHANNEL, exportFormat=DEFAULT_FORMAT,
+                catalogFile=None, verbose=False):
+    """Run the selected stages over a list of run folders. Each stage is
+    fanned out over a process pool, per shot for export and fit and per run
+    otherwise, so one pool keeps every core busy across all runs. Finished
+    work is recorded in each run's progress file and skipped when the batch
+    is started again.
+
+        Args:
+           dataDirs (list): The run folders to process.
+
+        Kwargs:
+           stages (tuple): Any of :data:`STAGES`; always run in that order.
+
+           workers (int): Pool size, defaults to the number of cores.
+
+           pattern (str): The trace file name pattern handed to
+           :func:`trcIndex.indexRun`.
+
+           restart (bool): Forget earlier progress of the selected stages.
+
+           ionChannel (int): The channel column fitted by the fit stage.
+
+           exportFormat (str): The file format of the export stage, see
+           :data:`runExport.FORMATS`.
+
+           catalogFile (str): A trigger-time catalog shared by all the runs.
+           By default each run folder gets its own.
+
+           verbose (bool): Print every finished task.
+
+        Returns:
+           failed (int): The number of tasks that raised. They are not
+           recorded, so the next invocation retries them.
+
+        Raises:
+           ValueError: An unknown stage was requested.
+           """
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError("Unknown stage(s): {}".format(", ".join(unknown)))
+
+    # Pool workers get absolute paths, whatever their working directory
+    dataDirs = [os.path.abspath(dataDir) for dataDir in dataDirs]
+    progress = {dataDir: RunProgress(dataDir) for dataDir in dataDirs}
+    if restart:
+        for dataDir in dataDirs:
+            for stage in stages:
+                progress[dataDir].reset(stage)
+            if "fit" in stages:
+                FitStore(storeFile(stageFolder(dataDir, "fit"))).remove(
+                    dataDir, ION_GRID_MODEL, ionChannel)
+
+    # Indexing only lists the folder, the pool would cost more than it saves
+    indexes = {}
+    for dataDir in dataDirs:
+        indexes[dataDir] = indexRun(dataDir, pattern=pattern)
+        if "index" in stages:
+            if verbose:
+                indexes[dataDir].report()
+            catalog = TriggerCatalog(catalogFile or catalogPath(dataDir))
+            catalog.addRun(dataDir, pattern=pattern, verbose=verbose)
+            catalog.close()
+            progress[dataDir].complete(
+                "index", shots=indexes[dataDir].nShots,
+                channels=indexes[dataDir].nChannels,
+                missing=len(indexes[dataDir].missing))
+            print("{}: {} shots, {} channels".format(
+                runName(dataDir), indexes[dataDir].nShots,
+                indexes[dataDir].nChannels))
+
+    # Export keeps its own manifest and is incremental, so it is never
+    # marked complete for good: new shots in a run get exported next time
+    manifests = {}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for stage in stages:
+            if stage == "index":
+                continue
+            futures = {}
+            for dataDir in dataDirs:
+                if stage != "export" and progress[dataDir].isComplete(stage):
+                    print("{}: {} already done".format(runName(dataDir),
+                                                       stage))
+                    continue
+                submitted = _submitStage(pool, stage, dataDir, pattern,
+                                         indexes[dataDir], progress[dataDir],
+                                         ionChannel, exportFormat, manifests,
+                                         restart, catalogFile)
+                if not submitted:
+                    _finishStage(stage, dataDir, progress[dataDir], 0, None)
+                futures.update(submitted)
+
+            remaining = {}
+            for dataDir, shotIdx, onDone in futures.values():
+                remaining[dataDir] = remaining.get(dataDir, 0) + 1
+            stageFailed = dict.fromkeys(remaining, 0)
+            for future in as_completed(futures):
+                dataDir, shotIdx, onDone = futures[future]
+                remaining[dataDir] -= 1
+                error = future.exception()
+                if error is not None:
+                    stageFailed[dataDir] += 1
+                    where = "" if shotIdx is None else " on shot {}".format(
+                        shotIdx)
+                    print("{}: {} failed{}: {}".format(runName(dataDir), stage,
+                                                       where, error))
+                elif shotIdx is not None:
+                    problem = onDone(future.result())
+                    if problem:
+                        stageFailed[dataDir] += 1
+                        print("{}: {} failed on shot {}: {}".format(
+                            runName(dataDir), stage, shotIdx, problem))
+                    elif verbose:
+                        print("{}: {} shot {}".format(runName(dataDir), stage,
+                                                      shotIdx))
+                if remaining[dataDir] == 0:
+                    _finishStage(stage, dataDir, progress[dataDir],
+                                 stageFailed[dataDir], future)
+            failed += sum(stageFailed.values())
+
+    for manifest in manifests.values():
+        manifest.save()
+
+    for dataDir in dataDirs:
+        progress[dataDir].save()
+    return failed
+
+
+def _submitStage(pool, stage, dataDir, pattern, index, progress, ionChannel,
+                 exportFormat, manifests, restart, catalogFile):
+    # Returns {future: (dataDir, shotIdx or None, call on success)}; the
+    # call gets the task's result and returns why it failed after all, if
+    # it did
+    if stage == "consolidate":
+        return {pool.submit(_consolidateRun, dataDir, pattern):
+                (dataDir, None, None)}
+
+    if stage == "export":
+        manifest, source, channelNames, jobs = planExport(
+            dataDir, fmt=exportFormat, pattern=pattern,
+            incremental=not restart)
+        manifests[dataDir] = manifest
+        return {pool.submit(exportShot, source, pattern, shotIdx, path,
+                            channelNames, exportFormat):
+                (dataDir, shotIdx,
+                 functools.partial(_exported, manifest, shot,
+                                   os.path.basename(path), sources))
+                for shotIdx, shot, path, sources in jobs}
+
+    folder = stageFolder(dataDir, stage)
+    os.makedirs(folder, exist_ok=True)
+    if stage == "match":
+        return {pool.submit(_matchRun, dataDir, pattern, folder,
+                            catalogFile):
+                (dataDir, None, None)}
+    if stage == "qd":
+        return {pool.submit(_qdRun, dataDir, pattern, catalogFile):
+                (dataDir, None, None)}
+    if stage == "stats":
+        return {pool.submit(_statsRun, dataDir, pattern):
+                (dataDir, None, None)}
+    if stage == "noise":
+        return {pool.submit(_noiseRun, dataDir, pattern):
+                (dataDir, None, None)}
+
+    done = progress.doneShots(stage)
+    store = FitStore(storeFile(folder))
+    if stage == "render":
+        # Drawn from the fit store, so only shots the fit stage got through
+        fits = store.fits(dataDir, ION_GRID_MODEL, ionChannel)
+        return {pool.submit(renderShot, dataDir, pattern, shotIdx, params,
+                            folder, ionChannel):
+                (dataDir, shotIdx,
+                 functools.partial(_rendered, progress, shotIdx))
+                for shotIdx, params in fits.items() if shotIdx not in done}
+
+    return {pool.submit(fitShot, dataDir, pattern, shotIdx, ionChannel):
+            (dataDir, shotIdx,
+             functools.partial(_fitted, store, progress, shotIdx))
+            for shotIdx in range(index.nShots) if shotIdx not in done}
+
+
+def _exported(manifest, shot, fileName, sources, path):
+    manifest.record(shot, fileName, sources)
+
+
+def _fitted(store, progress, shotIdx, record):
+    # Failed fits are kept in the store too, but the shot is tried again by
+    # the next batch
+    store.append([record])
+    if record["status"] != STATUS_OK:
+        return record["message"]
+    progress.markShot("fit", shotIdx)
+
+
+def _rendered(progress, shotIdx, path):
+    progress.markShot("render", shotIdx)
+
+
+def _finishStage(stage, dataDir, progress, nFailed, lastFuture):
+    if nFailed:
+        progress.save()
+        print("{}: {} incomplete, {} task(s) failed".format(runName(dataDir),
+                                                           stage, nFailed))
+        return
+    if stage == "render" and not progress.isComplete("fit"):
+        # Shots still to be fitted will need drawing too
+        progress.save()
+        print("{}: {} waits for the fit stage".format(runName(dataDir),
+                                                      stage))
+        return
+    if stage == "consolidate":
+        progress.complete(stage, store=storePath(dataDir))
+    elif stage == "match":
+        progress.complete(stage, events=lastFuture.result())
+    elif stage == "qd":
+        progress.complete(stage, detected=lastFuture.result())
+    elif stage == "stats":
+        progress.complete(stage, waveforms=lastFuture.result())
+    elif stage == "noise":
+        progress.complete(stage, channels=lastFuture.result())
+    else:
+        progress.complete(stage)
+    print("{}: {} done".format(runName(dataDir), stage))
+
+
+# %%COMMAND LINE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="spectrumpy-run",
+        description="Process accelerator run folders without the GUI.")
+    parser.add_argument("dataDirs", nargs="+", metavar="RUN",
+                        help="run folder containing .trc files")
+    parser.add_argument("-s", "--stage", action="append", choices=STAGES,
+                        dest="stages",
+                        help="stage to run, may be repeated (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="trace file name regular expression")
+    parser.add_argument("--ion-channel", type=int, default=ION_GRID_CHANNEL,
+                        help="channel column fitted by the fit stage")
+    parser.add_argument("-f", "--format", choices=sorted(FORMATS),
+                        default=DEFAULT_FORMAT,
+                        help="file format of the export stage")
+    parser.add_argument("-c", "--catalog", default=None,
+                        help="trigger-time catalog shared by all runs "
+                        "(default: one per run)")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore recorded progress and redo the stages")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    stages = [stage for stage in STAGES
+              if args.stages is None or stage in args.stages]
+    failed = processRuns(args.dataDirs, stages, workers=args.jobs,
+                         pattern=args.pattern, restart=args.restart,
+                         ionChannel=args.ion_channel,
+                         exportFormat=args.format, catalogFile=args.catalog,
+                         verbose=args.verbose)
+    return 1 if failed else 0
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    raise SystemExit(main())
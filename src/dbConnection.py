@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Configured, pooled connections to the accelerator database.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import configparser
+import os
+import threading
+
+from sqlalchemy import create_engine
+
+# %%WHERE THE DATABASE URL COMES FROM
+# Checked in this order; the first one that is set wins
+URL_ENV = "SPECTRUMPY_DB_URL"
+CONFIG_ENV = "SPECTRUMPY_CONFIG"
+CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".spectrumpy",
+                           "database.ini")
+
+# The local copy of dust_event kept by dustMirror
+MIRROR_ENV = "SPECTRUMPY_DUST_MIRROR"
+MIRROR_PATH = os.path.join(os.path.expanduser("~"), ".spectrumpy",
+                           "dust_event.sqlite")
+
+POOL_RECYCLE = 3600  # Seconds before a pooled MySQL connection is replaced
+
+
+def databaseUrl(section="accelerator"):
+    """The SQLAlchemy URL of the accelerator database.
+
+        Args:
+           None
+
+        Kwargs:
+           section (str): The section of the config file to read, so one
+           file can describe several databases.
+
+        Returns:
+           url (str): $SPECTRUMPY_DB_URL if set, else the url entry of the
+           config file ($SPECTRUMPY_CONFIG or ~/.spectrumpy/database.ini).
+           For offline work point it at a local copy, e.g.
+           sqlite:////data/impact.sqlite.
+
+        Raises:
+           RuntimeError: Neither the variable nor the config file sets a
+           URL; credentials are never built in.
+           """
+    if os.environ.get(URL_ENV):
+        return os.environ[URL_ENV]
+    configPath = os.environ.get(CONFIG_ENV, CONFIG_PATH)
+    config = _readConfig()
+    if config.has_option(section, "url"):
+        return config.get(section, "url")
+    raise RuntimeError(
+        "No accelerator database configured: set ${} or a url entry in "
+        "the [{}] section of {}".format(URL_ENV, section, configPath))
+
+
+def mirrorPath(section="accelerator"):
+    """The local mirror of the dust_event table: $SPECTRUMPY_DUST_MIRROR if
+    set, else the mirror entry of the config file, else
+    ~/.spectrumpy/dust_event.sqlite."""
+    if os.environ.get(MIRROR_ENV):
+        return os.environ[MIRROR_ENV]
+    config = _readConfig()
+    if config.has_option(section, "mirror"):
+        return os.path.expanduser(config.get(section, "mirror"))
+    return MIRROR_PATH
+
+
+def dustEventUrl():
+    """Where dust events are read from: the local mirror once it has been
+    synced, otherwise the live database of :func:`databaseUrl` (which raises
+    if none is configured). Setting $SPECTRUMPY_DB_URL always wins, so a
+    session can be pointed at another database without moving the
+    mirror."""
+    path = mirrorPath()
+    if not os.environ.get(URL_ENV) and os.path.exists(path):
+        return "sqlite:///" + os.path.abspath(path)
+    return databaseUrl()
+
+
+def _readConfig():
+    config = configparser.ConfigParser()
+    config.read(os.environ.get(CONFIG_ENV, CONFIG_PATH))
+    return config
+
+
+# %%ONE POOLED ENGINE PER URL
+_engines = {}
+_enginesLock = threading.Lock()
+
+
+def getEngine(url=None):
+    """The shared engine for url (the configured :func:`databaseUrl` by
+    default). Engines are created once per process and keep a connection
+    pool, so repeated queries do not reconnect.
+
+        Args:
+           None
+
+        Kwargs:
+           url (str): A SQLAlchemy database URL.
+
+        Returns:
+           engine (sqlalchemy.engine.Engine): The pooled engine.
+
+        Raises:
+           RuntimeError: No url is given and none is configured.
+           """
+    url = url or databaseUrl()
+    with _enginesLock:
+        if url not in _engines:
+            if url.startswith("sqlite"):
+                # File databases have nothing to recycle; allow the engine
+                # to be used from the query worker thread
+                _engines[url] = create_engine(
+                    url, connect_args={"check_same_thread": False})
+            else:
+                _engines[url] = create_engine(url, pool_pre_ping=True,
+                                              pool_recycle=POOL_RECYCLE)
+        return _engines[url]
+
+
+def disposeEngines():
+    """Close every pooled connection, e.g. before the process exits."""
+    with _enginesLock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Queries against the IMPACT accelerator dust_event table, without Qt.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import text
+
+from dbConnection import dustEventUrl, getEngine
+
+# %%ACCELERATOR DATABASE
+# Display names of the selected dust_event columns, in query order
+COLUMNS = ["Estimate Quality", "Time", "Velocity (km/s)", "Mass (kg)",
+           "Charge (C)", "Radius (m)"]
+
+# Largest trace to event clock difference still accepted as a match
+DEFAULT_TOLERANCE_MS = 1000
+
+_CANDIDATES = text(
+    "SELECT estimate_quality, integer_timestamp, velocity, mass, charge, "
+    "radius FROM dust_event WHERE mass != -1 AND integer_timestamp "
+    "BETWEEN :lo AND :hi ORDER BY integer_timestamp")
+
+# The whole table, for the calibration plot
+_HISTORY = text(
+    "SELECT estimate_quality, integer_timestamp, velocity, mass, charge, "
+    "radius FROM dust_event WHERE mass != -1 ORDER BY integer_timestamp")
+
+
+def _connectable(db):
+    # None (the mirror or the configured database), a URL, or an
+    # Engine/Connection
+    if db is None:
+        return getEngine(dustEventUrl())
+    return getEngine(db) if isinstance(db, str) else db
+
+
+# %%FETCH THE CANDIDATE EVENTS OF A RUN
+def queryDustEvents(startMs, endMs, db=None):
+    """Fetch every dust_event with a valid mass in [startMs, endMs] with one
+    range query on integer_timestamp, oldest first.
+
+        Args:
+           startMs (int): The start of the range in epoch ms.
+
+           endMs (int): The end of the range in epoch ms.
+
+        Kwargs:
+           db (str or Engine): The SQLAlchemy database URL, or an engine or
+           connection to use; by default the local mirror kept by
+           :mod:`dustMirror`, or the live database before the first sync
+           (see :func:`dbConnection.dustEventUrl`). Any database with a
+           dust_event table works.
+
+        Returns:
+           df (pd.DataFrame): The raw rows, with the :data:`COLUMNS` names and
+           velocity still in m/s.
+
+        Raises:
+           None
+           """
+    df = pd.read_sql(_CANDIDATES, con=_connectable(db),
+                     params={"lo": int(startMs), "hi": int(endMs)})
+    df.columns = COLUMNS
+    return df
+
+
+# %%FETCH EVERY EVENT
+def queryAllDustEvents(db=None):
+    """Fetch every dust_event with a valid mass, the whole accelerator
+    history, e.g. for the calibration plot. Read it from the local mirror
+    (the default once it is synced) rather than over the network.
+
+        Args:
+           None
+
+        Kwargs:
+           db (str or Engine): See :func:`queryDustEvents`.
+
+        Returns:
+           df (pd.DataFrame): The :data:`COLUMNS`, oldest first, with
+           velocity in km/s and Time as datetimes like
+           :func:`matchDustEvents`.
+
+        Raises:
+           None
+           """
+    df = pd.read_sql(_HISTORY, con=_connectable(db))
+    df.columns = COLUMNS
+    df["Velocity (km/s)"] /= 1000.0
+    df["Time"] = pd.to_datetime(df["Time"], unit="ms")
+    return df
+
+
+# %%MATCH TRACES TO DUST EVENTS
+def matchDustEvents(timebase, db=None, toleranceMs=DEFAULT_TOLERANCE_MS,
+                    unique=True):
+    """Pair every trace with the dust event closest to its trigger time. The
+    candidates come from a single range query spanning the run, and the
+    pairing is done on sorted arrays with np.searchsorted, so the cost grows
+    with the size of the run and not of the dust_event table.
+
+        Args:
+           timebase (list): The trigger times of the traces in epoch ms, in
+           trace order.
+
+        Kwargs:
+           db (str or Engine): See :func:`queryDustEvents`.
+
+           toleranceMs (float): A trace with no event within this many ms is
+           left unmatched.
+
+           unique (bool): Give each event to at most one trace, the closest;
+           any other trace that picked it is left unmatched.
+
+        Returns:
+           df (pd.DataFrame): One row per trace, in trace order: the
+           :data:`COLUMNS` of the matched event (velocity in km/s, Time as
+           datetimes), a 1-based Trace Number, the Trigger Time, Offset (ms)
+           (event minus trigger) and Matched. Unmatched rows hold NaN/NaT.
+
+        Raises:
+           None
+           """
+    triggerMs = np.asarray(timebase, dtype=np.int64).ravel()
+    if len(triggerMs):
+        events = queryDustEvents(triggerMs.min() - toleranceMs,
+                                 triggerMs.max() + toleranceMs, db=db)
+    else:
+        events = pd.DataFrame(columns=COLUMNS)
+    eventMs = events["Time"].to_numpy(dtype=np.int64)
+
+    # Nearest neighbour among the events either side of each trigger
+    best = np.full(len(triggerMs), -1)
+    if len(eventMs):
+        right = np.searchsorted(eventMs, triggerMs)
+        left = np.clip(right - 1, 0, len(eventMs) - 1)
+        right = np.clip(right, 0, len(eventMs) - 1)
+        useRight = (np.abs(eventMs[right] - triggerMs)
+                    < np.abs(eventMs[left] - triggerMs))
+        best = np.where(useRight, right, left)
+        distance = np.abs(eventMs[best] - triggerMs)
+        best[distance > toleranceMs] = -1
+
+        if unique:
+            # Order claims by distance; the first claim on an event wins
+            claimed = np.flatnonzero(best >= 0)
+            order = claimed[np.argsort(distance[claimed], kind="stable")]
+            _, first = np.unique(best[order], return_index=True)
+            losers = np.setdiff1d(order, order[first])
+            best[losers] = -1
+
+    matched = best >= 0
+    df = pd.DataFrame(np.nan, index=range(len(triggerMs)), columns=COLUMNS)
+    if matched.any():
+        df.loc[matched, COLUMNS] = events.iloc[best[matched]].to_numpy(
+            dtype=float)
+    df["Velocity (km/s)"] /= 1000.0
+    df["Time"] = pd.to_datetime(df["Time"], unit="ms")
+    df["Trace Number"] = range(1, len(df) + 1)
+    df["Trigger Time"] = pd.to_datetime(triggerMs, unit="ms")
+    offset = np.full(len(triggerMs), np.nan)
+    offset[matched] = eventMs[best[matched]] - triggerMs[matched]
+    df["Offset (ms)"] = offset
+    df["Matched"] = matched
+    return df
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A local, incrementally synced SQLite mirror of the accelerator dust_event
+table.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+from sqlalchemy import text
+
+from dbConnection import databaseUrl, getEngine, mirrorPath
+
+# %%DEFAULTS
+MIRROR_VERSION = 1
+CHUNK_ROWS = 50000  # Rows fetched from the server per round trip
+
+# The mirrored columns, named as on the server so dustEvents queries the
+# mirror and the live database alike
+_FIELDS = ["estimate_quality", "integer_timestamp", "velocity", "mass",
+           "charge", "radius"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dust_event (
+    estimate_quality INTEGER,
+    integer_timestamp INTEGER NOT NULL,
+    velocity REAL,
+    mass REAL,
+    charge REAL,
+    radius REAL
+);
+CREATE INDEX IF NOT EXISTS dust_event_integer_timestamp
+    ON dust_event (integer_timestamp);
+CREATE TABLE IF NOT EXISTS sync (
+    source TEXT NOT NULL,
+    high_water_ms INTEGER,
+    synced_at REAL
+);
+"""
+
+_NEWER = text(
+    "SELECT " + ", ".join(_FIELDS) + " FROM dust_event "
+    "WHERE integer_timestamp >= :hwm ORDER BY integer_timestamp")
+
+
+# %%SYNC
+def syncMirror(source=None, path=None, verbose=False):
+    """Copy the dust events the mirror does not have yet. Only rows at or
+    above the stored high-water mark (the newest integer_timestamp already
+    copied) are fetched; rows at the mark itself are replaced, so events
+    sharing a timestamp with the last sync are neither lost nor doubled.
+    The whole sync is one transaction, an interrupted one leaves the
+    previous mirror intact.
+
+        Args:
+           None
+
+        Kwargs:
+           source (str or Engine): The live database, the configured one of
+           :func:`dbConnection.databaseUrl` by default.
+
+           path (str): The mirror file, :func:`dbConnection.mirrorPath` by
+           default. It is created on the first sync.
+
+           verbose (bool): Print how many rows were copied.
+
+        Returns:
+           added (int): The number of rows fetched.
+
+        Raises:
+           None
+           """
+    path = path or mirrorPath()
+    if source is None or isinstance(source, str):
+        source = getEngine(source or databaseUrl())
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    mirror = sqlite3.connect(path)
+    try:
+        # Readers (the viewer, a batch) keep working during a sync
+        mirror.execute("PRAGMA journal_mode=WAL")
+        mirror.executescript(_SCHEMA)
+        mirror.execute("PRAGMA user_version={}".format(MIRROR_VERSION))
+        hwm = highWaterMark(mirror)
+
+        added = 0
+        newest = hwm
+        with mirror, source.connect() as conn:
+            if hwm is not None:
+                mirror.execute("DELETE FROM dust_event WHERE "
+                               "integer_timestamp = ?", (hwm,))
+            result = conn.execution_options(stream_results=True).execute(
+                _NEWER, {"hwm": -1 if hwm is None else hwm})
+            while True:
+                rows = result.fetchmany(CHUNK_ROWS)
+                if not rows:
+                    break
+                mirror.executemany(
+                    "INSERT INTO dust_event VALUES (?, ?, ?, ?, ?, ?)",
+                    [tuple(row) for row in rows])
+                added += len(rows)
+                newest = rows[-1][1]
+                if verbose:
+                    print("{} rows copied".format(added))
+            mirror.execute("DELETE FROM sync")
+            mirror.execute("INSERT INTO sync VALUES (?, ?, ?)",
+                           (_sourceName(source), newest, time.time()))
+    finally:
+        mirror.close()
+    if verbose:
+        print("{}: {} row(s) fetched, high-water mark {}".format(
+            path, added, newest))
+    return added
+
+
+def highWaterMark(mirror):
+    """The newest integer_timestamp in an open mirror, None if empty."""
+    return mirror.execute("SELECT MAX(integer_timestamp) FROM "
+                          "dust_event").fetchone()[0]
+
+
+def mirrorStatus(path=None):
+    """(rows, high-water mark, source, time of the last sync) of a mirror,
+    or None if it has never been synced."""
+    path = path or mirrorPath()
+    if not os.path.exists(path):
+        return None
+    mirror = sqlite3.connect(path)
+    try:
+        rows, = mirror.execute("SELECT COUNT(*) FROM dust_event").fetchone()
+        last = mirror.execute("SELECT source, synced_at FROM "
+                              "sync").fetchone() or (None, None)
+        return rows, highWaterMark(mirror), last[0], last[1]
+    finally:
+        mirror.close()
+
+
+def _sourceName(engine):
+    # The server URL without its password
+    try:
+        return engine.url.render_as_string(hide_password=True)
+    except AttributeError:
+        return str(engine)
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Mirror the accelerator dust_event table locally.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sync = commands.add_parser("sync", help="fetch the new dust events")
+    sync.add_argument("-s", "--source", default=None,
+                      help="database URL (default: the configured one)")
+    sync.add_argument("-m", "--mirror", default=None,
+                      help="mirror file (default: {})".format(mirrorPath()))
+    sync.add_argument("-v", "--verbose", action="store_true")
+    status = commands.add_parser("status", help="describe the mirror")
+    status.add_argument("-m", "--mirror", default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == "sync":
+        added = syncMirror(args.source, args.mirror, verbose=args.verbose)
+        print("Fetched {} dust event(s)".format(added))
+    else:
+        state = mirrorStatus(args.mirror)
+        if state is None:
+            print("No mirror at {}".format(args.mirror or mirrorPath()))
+            return
+        rows, hwm, source, syncedAt = state
+        print("{} dust events up to {} from {}, synced {}".format(
+            rows, hwm, source,
+            time.ctime(syncedAt) if syncedAt is not None else "never"))
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
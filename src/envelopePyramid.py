@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Min/max envelope level-of-detail pyramid for plotting long waveforms.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import numpy as np
+
+# %%DEFAULTS
+BUCKET_FACTOR = 4      # Samples merged per bucket from one level to the next
+MIN_LEVEL_POINTS = 1024  # Stop building levels below this many buckets
+
+
+# %%LEVEL OF DETAIL PYRAMID
+class EnvelopePyramid:
+
+    def __init__(self, x, y, factor=BUCKET_FACTOR,
+                 minPoints=MIN_LEVEL_POINTS):
+        """Per-bucket min/max envelopes of one waveform at successively
+        coarser resolutions. Unlike plain decimation, every level keeps the
+        extremes of the samples it covers, so narrow TOF peaks stay visible
+        however far the plot is zoomed out.
+
+        Args:
+           x (np.ndarray): The sorted time array.
+
+           y (np.ndarray): The amplitude array.
+
+        Kwargs:
+           factor (int): How many buckets of one level make a bucket of the
+           next one.
+
+           minPoints (int): The coarsest level has at least this many
+           buckets.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        # Level k covers bucketSizes[k] raw samples per bucket. Level 0 is
+        # the raw waveform and has no envelope arrays.
+        self.bucketSizes = [1]
+        self.xStart = [self.x]
+        self.yMin = [self.y]
+        self.yMax = [self.y]
+
+        yMin, yMax = self.y, self.y
+        size = 1
+        while len(yMin) > factor * minPoints:
+            starts = np.arange(0, len(yMin), factor)
+            yMin = np.minimum.reduceat(yMin, starts)
+            yMax = np.maximum.reduceat(yMax, starts)
+            size *= factor
+            self.bucketSizes.append(size)
+            self.xStart.append(self.x[::size])
+            self.yMin.append(yMin)
+            self.yMax.append(yMax)
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def nbytes(self):
+        """Bytes held, the waveform it was built from included; the coarse
+        xStart levels are views of x."""
+        return self.x.nbytes + sum(a.nbytes for a in
+                                   self.yMin + self.yMax[1:])
+
+    def level(self, nVisible, pixels):
+        """The coarsest level that still gives at least one bucket per
+        pixel for nVisible raw samples."""
+        perPixel = nVisible / max(pixels, 1)
+        k = 0
+        while (k + 1 < len(self.bucketSizes)
+               and self.bucketSizes[k + 1] <= perPixel):
+            k += 1
+        return k
+
+    def select(self, xmin, xmax, pixels):
+        """Return the points to draw for the x-range [xmin, xmax] on a plot
+        that is pixels wide.
+
+        Args:
+           xmin (float): The left edge of the visible range.
+
+           xmax (float): The right edge of the visible range.
+
+           pixels (int): The width of the axes in screen pixels.
+
+        Kwargs:
+           None
+
+        Returns:
+           xs (np.ndarray): The x values to plot.
+
+           ys (np.ndarray): The y values to plot. At coarse levels every
+           bucket contributes its minimum and its maximum at the bucket's
+           start time.
+
+        Raises:
+           None
+           """
+        if len(self.x) == 0:
+            return self.x, self.y
+        i0 = max(np.searchsorted(self.x, xmin, side="left") - 1, 0)
+        i1 = min(np.searchsorted(self.x, xmax, side="right") + 1,
+                 len(self.x))
+        k = self.level(i1 - i0, pixels)
+        if k == 0:
+            return self.x[i0:i1], self.y[i0:i1]
+
+        size = self.bucketSizes[k]
+        j0 = i0 // size
+        j1 = -(-i1 // size)
+        xs = np.repeat(self.xStart[k][j0:j1], 2)
+        ys = np.empty(len(xs), dtype=self.y.dtype)
+        ys[0::2] = self.yMin[k][j0:j1]
+        ys[1::2] = self.yMax[k][j0:j1]
+        return xs, ys
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar store of waveform fit results: one row per fit, one HDF5 dataset
+per column.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+Layout of a store (n fits, appended as they finish):
+    /run          (n,) str      the run key, the absolute run folder
+    /shot         (n,) int32    0-based shot index
+    /channel      (n,) int16    channel column of the fitted waveform
+    /model        (n,) str      :data:`ION_GRID_MODEL` or :data:`TARGET_MODEL`
+    /params       (n, 7) float  [t0, c, b, s, A, t1, t2], NaN if failed
+    /cov_diag     (n, 7) float  diagonal of the parameter covariance
+    /rms          (n,) float    residual RMS (V)
+    /nfev         (n,) int32    model evaluations of the solver
+    /status       (n,) int8     :data:`STATUS_OK` or :data:`STATUS_FAILED`
+    /message      (n,) str      why a fit failed, empty otherwise
+    /fitted_at    (n,) float    epoch seconds the row was written
+
+Usage:
+    python fitStore.py show <store.h5> [--run <run folder>] [--failed]
+"""
+
+import argparse
+import os
+import time
+
+import h5py
+import numpy as np
+
+# %%STORE CONSTANTS
+STORE_NAME = "fit-results.h5"
+STORE_VERSION = 1
+N_PARAMS = 7  # [t0, c, b, s, A, t1, t2] of SudaIonTarget.AlterIDEXIonGrid
+PARAM_NAMES = ("t0", "c", "b", "s", "A", "t1", "t2")
+PARAM_UNITS = ("s", "V", "V", "s", "V", "s", "s")
+
+ION_GRID_MODEL = "ion_grid"  # SudaIonTarget.AlterIDEXIonGrid
+TARGET_MODEL = "target"  # SudaIonTarget.IDEXTarget
+
+STATUS_OK = 0
+STATUS_FAILED = 1
+
+# Column name: (dtype, shape of one row)
+_STR = h5py.string_dtype()
+COLUMNS = {"run": (_STR, ()),
+           "shot": (np.int32, ()),
+           "channel": (np.int16, ()),
+           "model": (_STR, ()),
+           "params": (np.float64, (N_PARAMS,)),
+           "cov_diag": (np.float64, (N_PARAMS,)),
+           "rms": (np.float64, ()),
+           "nfev": (np.int32, ()),
+           "status": (np.int8, ()),
+           "message": (_STR, ()),
+           "fitted_at": (np.float64, ())}
+
+# The columns that identify a fit; a later row replaces an earlier one
+_KEY = ("run", "model", "channel", "shot")
+
+
+# %%DEFAULT STORE LOCATION
+def storeFile(folder):
+    """The store kept in a fit output folder: <folder>/fit-results.h5"""
+    return os.path.join(folder, STORE_NAME)
+
+
+# %%ONE ROW
+def fitRecord(run, shot, channel, model, params=None, covDiag=None,
+              rms=np.nan, nfev=0, message=""):
+    """A row for :meth:`FitStore.append`. Plain builtins and NumPy arrays
+    only, so pool workers can return it to the process that writes.
+
+        Args:
+           run (str): The run key, the absolute path of the run folder.
+
+           shot (int): The 0-based shot index.
+
+           channel (int): The channel column of the fitted waveform.
+
+           model (str): :data:`ION_GRID_MODEL` or :data:`TARGET_MODEL`.
+
+        Kwargs:
+           params (np.ndarray): The fitted parameters; None for a failed
+           fit.
+
+           covDiag (np.ndarray): The diagonal of their covariance.
+
+           rms (float): The residual RMS of the fit.
+
+           nfev (int): How many times the solver evaluated the model.
+
+           message (str): Why the fit failed.
+
+        Returns:
+           record (dict): One value per :data:`COLUMNS` entry.
+
+        Raises:
+           None
+           """
+    missing = np.full(N_PARAMS, np.nan)
+    return {"run": os.path.abspath(run),
+            "shot": int(shot),
+            "channel": int(channel),
+            "model": model,
+            "params": missing if params is None else np.asarray(
+                params, dtype=float),
+            "cov_diag": missing if covDiag is None else np.asarray(
+                covDiag, dtype=float),
+            "rms": float(rms),
+            "nfev": int(nfev),
+            "status": STATUS_OK if params is not None else STATUS_FAILED,
+            "message": str(message),
+            "fitted_at": time.time()}
+
+
+# %%THE STORE
+class FitStore:
+
+    def __init__(self, path):
+        """Fit results of any number of runs, channels and models in one
+        HDF5 file, created on the first append. Rows are only ever added:
+        refitting a shot appends a new row, and :meth:`load` returns the
+        newest row of every (run, model, channel, shot). HDF5 allows one
+        writer at a time, so pool workers return :func:`fitRecord` rows and
+        the process driving the pool appends them.
+
+        Args:
+           path (str): The HDF5 file.
+
+        Kwargs:
+           None
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.path = path
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        with h5py.File(self.path, "r") as f:
+            return len(f["shot"])
+
+    # %%APPEND
+    def append(self, records):
+        """Add rows at the end of every column, in one write per column.
+
+        Args:
+           records (list): :func:`fitRecord` dicts.
+
+        Kwargs:
+           None
+
+        Returns:
+           n (int): The number of rows in the store afterwards.
+
+        Raises:
+           None
+           """
+        records = list(records)
+        with h5py.File(self.path, "a") as f:
+            if "shot" not in f:
+                f.attrs["version"] = STORE_VERSION
+                for name, (dtype, shape) in COLUMNS.items():
+                    f.create_dataset(name, (0,) + shape, dtype=dtype,
+                                     maxshape=(None,) + shape,
+                                     chunks=(1024,) + shape)
+            start = len(f["shot"])
+            for name, (dtype, shape) in COLUMNS.items():
+                column = f[name]
+                column.resize(start + len(records), axis=0)
+                if records:
+                    column[start:] = [record[name] for record in records]
+            return start + len(records)
+
+    # %%LOAD AS ARRAYS
+    def load(self, run=None, model=None, channel=None, okOnly=False,
+             latest=True):
+        """Read the store as one NumPy array per column.
+
+        Args:
+           None
+
+        Kwargs:
+           run (str): Only this run folder.
+
+           model (str): Only this model.
+
+           channel (int): Only this channel.
+
+           okOnly (bool): Drop the failed fits.
+
+           latest (bool): Keep only the newest row of each fit, the default;
+           False returns every row ever appended.
+
+        Returns:
+           columns (dict): {column name: np.ndarray}, rows in the order
+           they were appended. Strings come back as object arrays.
+
+        Raises:
+           None
+           """
+        if not os.path.exists(self.path):
+            return {name: np.empty((0,) + shape, dtype=object if dtype is
+                                   _STR else dtype)
+                    for name, (dtype, shape) in COLUMNS.items()}
+        with h5py.File(self.path, "r") as f:
+            columns = {name: (f[name].asstr()[()] if dtype is _STR
+                              else f[name][()])
+                       for name, (dtype, shape) in COLUMNS.items()}
+
+        if latest and len(columns["shot"]):
+            keys = np.stack([np.unique(columns[name], return_inverse=True)[1]
+                             .ravel() for name in _KEY], axis=1)
+            _, last = np.unique(keys[::-1], axis=0, return_index=True)
+            columns = _take(columns, np.sort(len(keys) - 1 - last))
+
+        keep = np.ones(len(columns["shot"]), dtype=bool)
+        if run is not None:
+            keep &= columns["run"] == os.path.abspath(run)
+        if model is not None:
+            keep &= columns["model"] == model
+        if channel is not None:
+            keep &= columns["channel"] == channel
+        if okOnly:
+            keep &= columns["status"] == STATUS_OK
+        return _take(columns, np.flatnonzero(keep))
+
+    def fits(self, run, model=ION_GRID_MODEL, channel=None):
+        """{shot: params} of the converged fits of one run."""
+        columns = self.load(run=run, model=model, channel=channel,
+                            okOnly=True)
+        return dict(zip(columns["shot"].tolist(), columns["params"]))
+
+    # %%FORGET A RUN
+    def remove(self, run, model=None, channel=None):
+        """Drop every row of a run (of one model, one channel) for good, e.g.
+        before fitting it again from scratch.
+
+        Args:
+           run (str): The run folder.
+
+        Kwargs:
+           model (str): Only the rows of this model.
+
+           channel (int): Only the rows of this channel.
+
+        Returns:
+           n (int): The number of rows removed.
+
+        Raises:
+           None
+           """
+        if not os.path.exists(self.path):
+            return 0
+        columns = self.load(latest=False)
+        drop = columns["run"] == os.path.abspath(run)
+        if model is not None:
+            drop &= columns["model"] == model
+        if channel is not None:
+            drop &= columns["channel"] == channel
+        if not drop.any():
+            return 0
+        kept = _take(columns, np.flatnonzero(~drop))
+        with h5py.File(self.path, "a") as f:
+            for name in COLUMNS:
+                f[name].resize(len(kept["shot"]), axis=0)
+                if len(kept["shot"]):
+                    f[name][:] = kept[name]
+        return int(drop.sum())
+
+
+def _take(columns, rows):
+    return {name: values[rows] for name, values in columns.items()}
+
+
+# %%READABLE SUMMARY
+def describe(columns, row):
+    """One line per fit, in the words of the old IonFitResults.txt."""
+    head = "Trace {} ({}, channel {}):".format(
+        columns["shot"][row] + 1, columns["model"][row],
+        columns["channel"][row])
+    if columns["status"][row] != STATUS_OK:
+        return "{} failed, {}".format(head, columns["message"][row])
+    values = ", ".join("{}={} {}".format(name, value, unit) for
+                       name, value, unit in zip(PARAM_NAMES,
+                                                columns["params"][row],
+                                                PARAM_UNITS))
+    return "{} {}, rms={} V, {} evaluations".format(
+        head, values, columns["rms"][row], columns["nfev"][row])
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Inspect a store of waveform fit results.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    show = commands.add_parser("show", help="print the fits of a store")
+    show.add_argument("store", help="fit-results.h5 file")
+    show.add_argument("-r", "--run", default=None,
+                      help="only the fits of this run folder")
+    show.add_argument("--failed", action="store_true",
+                      help="only the fits that failed")
+    args = parser.parse_args(argv)
+
+    columns = FitStore(args.store).load(run=args.run)
+    order = np.lexsort((columns["shot"], columns["channel"],
+                        columns["model"].astype(str),
+                        columns["run"].astype(str)))
+    run = None
+    for row in order:
+        if args.failed and columns["status"][row] == STATUS_OK:
+            continue
+        if columns["run"][row] != run:
+            run = columns["run"][row]
+            print(run)
+        print(describe(columns, row))
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ion grid fitting, QD analysis and export of a whole run, driven from
+worker threads.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import glob
+import os
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from fitStore import ION_GRID_MODEL, STATUS_OK, FitStore, storeFile
+from runFits import ION_GRID_CHANNEL, fitRun, renderFits
+from trcIndex import DEFAULT_PATTERN
+
+
+# %%RUN FITTER
+class IonFitWorker(QObject):
+
+    # Emitted from the worker thread, delivered queued to the Qt thread
+    shotFitted = pyqtSignal(int, object)   # (shot index, parameters)
+    shotFailed = pyqtSignal(int, str)      # (shot index, error)
+    finished = pyqtSignal(int, int)        # (fitted, failed) shots
+    failed = pyqtSignal(str)               # The run could not be fitted
+
+    def __init__(self, parent=None):
+        """Fits every shot of a run in a process pool (see
+        :func:`runFits.fitRun`) without blocking the viewer. Each result is
+        appended to the fit store of the output folder and signalled as it
+        arrives; if asked for, the plots are drawn from the store once all
+        shots are fitted. Starting another run
+        or calling :meth:`cancel` abandons the current one.
+
+        Args:
+           None
+
+        Kwargs:
+           parent (QObject): The Qt parent, usually the main window.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        super().__init__(parent)
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="ionfit")
+        self._lock = threading.Lock()
+        self._current = 0
+
+    def start(self, dataDir, folder, plot=True, ionChannel=ION_GRID_CHANNEL,
+              pattern=DEFAULT_PATTERN, fresh=False):
+        """Fit every shot of dataDir, writing into folder. The job in
+        progress is cancelled first; this one runs once it has stopped, so
+        the two never write to the store at the same time.
+
+        Args:
+           dataDir (str): The run folder.
+
+           folder (str): Where fit-results.h5 and the plots go.
+
+        Kwargs:
+           plot (bool): Draw an IonGrid<n>.png per fitted shot.
+
+           ionChannel (int): The channel column of the ion grid.
+
+           pattern (str): The trace file name pattern.
+
+           fresh (bool): Drop the run's earlier ion grid rows from the store
+           (see :meth:`fitStore.FitStore.remove`) and its IonGrid<n>.png
+           plots before fitting. Other runs, models and channels in the
+           store are kept.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        with self._lock:
+            self._current += 1
+            job = self._current
+        self._executor.submit(self._fit, job, dataDir, folder, plot,
+                              ionChannel, pattern, fresh)
+
+    def _isCurrent(self, job):
+        with self._lock:
+            return job == self._current
+
+    def _fit(self, job, dataDir, folder, plot, ionChannel, pattern, fresh):
+        # Runs on the worker thread, after the previous job has returned;
+        # the fits themselves run in the pool
+        if not self._isCurrent(job):
+            return
+        store = FitStore(storeFile(folder))
+        try:
+            if fresh:
+                store.remove(dataDir, ION_GRID_MODEL, ionChannel)
+                for path in glob.glob(os.path.join(folder, "IonGrid*.png")):
+                    os.remove(path)
+            results = fitRun(dataDir, ionChannel=ionChannel, pattern=pattern)
+        except (ValueError, OSError) as error:
+            self.failed.emit(str(error))
+            return
+        nFitted, nFailed = 0, 0
+        with closing(results):
+            for record in results:
+                if not self._isCurrent(job):
+                    return
+                store.append([record])
+                if record["status"] == STATUS_OK:
+                    nFitted += 1
+                    self.shotFitted.emit(record["shot"], record["params"])
+                else:
+                    nFailed += 1
+                    self.shotFailed.emit(record["shot"], record["message"])
+
+        if plot:
+            fits = store.load(run=dataDir, model=ION_GRID_MODEL,
+                              channel=ionChannel, okOnly=True)
+            with closing(renderFits(fits, folder,
+                                    pattern=pattern)) as rendered:
+                for row, path, error in rendered:
+                    if not self._isCurrent(job):
+                        return
+        self.finished.emit(nFitted, nFailed)
+
+    def cancel(self):
+        """Abandon the run being fitted. Shots already in the pool finish,
+        queued ones are dropped."""
+        with self._lock:
+            self._current += 1
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+
+# %%QD ANALYSIS
+class QDWorker(QObject):
+
+    finished = pyqtSignal(object, str)  # (QD table, CSV written)
+    failed = pyqtSignal(str)            # The run could not be analysed
+
+    def __init__(self, parent=None):
+        """Runs :func:`qdAnalysis.analyzeRun` on a worker thread and writes
+        the table to :func:`qdAnalysis.resultsPath`. The shots are
+        cross-checked against the accelerator when a local dust_event
+        mirror exists, so no query waits on the network. Starting another
+        run or calling :meth:`cancel` drops the current result.
+
+        Args:
+           None
+
+        Kwargs:
+           parent (QObject): The Qt parent, usually the main window.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        super().__init__(parent)
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="qd")
+        self._lock = threading.Lock()
+        self._current = 0
+
+    def start(self, dataDir, pattern=DEFAULT_PATTERN):
+        with self._lock:
+            self._current += 1
+            job = self._current
+        self._executor.submit(self._analyze, job, dataDir, pattern)
+
+    def _isCurrent(self, job):
+        with self._lock:
+            return job == self._current
+
+    def _analyze(self, job, dataDir, pattern):
+        # Runs on the worker thread
+        from dbConnection import mirrorPath
+        from qdAnalysis import analyzeRun, crossCheck, resultsPath
+        try:
+            df = analyzeRun(dataDir, pattern=pattern)
+            if os.path.exists(mirrorPath()):
+                df = crossCheck(df, dataDir, db="sqlite:///" +
+                                os.path.abspath(mirrorPath()),
+                                pattern=pattern)
+            path = resultsPath(dataDir)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_csv(path, index=False)
+        except Exception as error:
+            if self._isCurrent(job):
+                self.failed.emit(str(error))
+            return
+        if self._isCurrent(job):
+            self.finished.emit(df, path)
+
+    def cancel(self):
+        """Drop the result of the run being analysed."""
+        with self._lock:
+            self._current += 1
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+
+# %%EXPORT
+class ExportWorker(QObject):
+
+    finished = pyqtSignal(int, str)  # (shots written, export folder)
+    failed = pyqtSignal(str)         # The run could not be exported
+
+    def __init__(self, parent=None):
+        """Runs :func:`runExport.exportRun`, and the process pool it starts,
+        from a worker thread so the viewer stays responsive. Starting
+        another export or calling :meth:`cancel` drops the current result;
+        shots already written stay in the manifest.
+
+        Args:
+           None
+
+        Kwargs:
+           parent (QObject): The Qt parent, usually the main window.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        super().__init__(parent)
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="export")
+        self._lock = threading.Lock()
+        self._current = 0
+
+    def start(self, dataDir, pattern=DEFAULT_PATTERN):
+        with self._lock:
+            self._current += 1
+            job = self._current
+        self._executor.submit(self._export, job, dataDir, pattern)
+
+    def _isCurrent(self, job):
+        with self._lock:
+            return job == self._current
+
+    def _export(self, job, dataDir, pattern):
+        # Runs on the worker thread; the shots are written in the pool
+        from runExport import exportFolder, exportRun
+        try:
+            written = exportRun(dataDir, pattern=pattern)
+        except Exception as error:
+            if self._isCurrent(job):
+                self.failed.emit(str(error))
+            return
+        if self._isCurrent(job):
+            self.finished.emit(written, exportFolder(dataDir))
+
+    def cancel(self):
+        """Drop the result of the export in progress."""
+        with self._lock:
+            self._current += 1
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Joint fit of the QD, ion grid and target waveforms of one impact, with the
+impact time, velocity and image charge width shared between them.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+The particle crosses the QD pickup tube, drifts to the target and hits it
+at t0. With speed v, the tube of length L at a drift distance D before
+the target sees a trapezoid from t0 - (D + L)/v to t0 - D/v, its edges
+ramping over R/v (R the fringe length of the tube ends). The ion grid and
+target pulses are SudaIonTarget.AlterIDEXIonGrid and IDEXTarget at the
+same t0, the ion grid image charge width s being shared with the target.
+So the QD timing pins v, the pulses pin t0, and each helps the other.
+
+Parameters, in order (:data:`PARAM_NAMES`):
+    t0, v, q, cQD          impact time (s), speed (m/s), QD plateau and
+                           baseline (V)
+    s                      image charge width (s)
+    cI, bI, AI, t1I, t2I   ion grid baseline, image charge, amplitude, rise
+                           and discharge times
+    cT, AT, t1T, t2T       target baseline, amplitude, rise and discharge
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+
+from runFits import ION_GRID_CHANNEL, _streamed, fitFolder
+from runStore import sharedRun
+from SudaIonTarget import AlterIDEXIonGrid, IDEXTarget, _pulseJacobian, \
+    _smoothed, pulseBounds, pulseGuess
+from trcIndex import DEFAULT_PATTERN, indexRun, readChannelNames
+from waveformDefaults import IMAGE_START, QD_GEOMETRY
+
+# %%DEFAULTS
+SPEED_LIMITS = (100.0, 1.0e5)  # Slowest and fastest particle (m/s)
+MAX_FIT_SAMPLES = 20000  # Per channel; longer records are block averaged
+WORKER_CACHE_BYTES = 0  # Each shot is fitted once, nothing to cache
+RESULTS_NAME = "joint-fits.csv"
+
+PARAM_NAMES = ("t0", "v", "q", "cQD", "s", "cI", "bI", "AI", "t1I", "t2I",
+               "cT", "AT", "t1T", "t2T")
+N_PARAMS = len(PARAM_NAMES)
+
+# Columns of the full parameter vector that feed each pulse model, in
+# AlterIDEXIonGrid order [t0, c, b, s, A, t1, t2]; -1 is a fixed zero
+_ION_COLUMNS = np.array([0, 5, 6, 4, 7, 8, 9])
+_TARGET_COLUMNS = np.array([0, 10, -1, 4, 11, 12, 13])
+
+
+# %%THE QD TRAPEZOID
+def _qdEdges(t0, v, geometry):
+    # Entry and exit times of the tube and the duration of an edge
+    entry = t0 - (geometry["drift"] + geometry["length"]) / v
+    exit = t0 - geometry["drift"] / v
+    return entry, exit, geometry["ramp"] / v
+
+
+def qdTrapezoid(x, t0, v, q, cQD, geometry=QD_GEOMETRY):
+    """The QD pickup tube signal of a particle hitting the target at t0
+    with speed v: cQD, plus q while the particle is inside the tube, with
+    linear edges.
+
+        Args:
+           x (np.ndarray): The time (s).
+
+           t0 (float): The impact time (s).
+
+           v (float): The speed (m/s).
+
+           q (float): The plateau height (V).
+
+           cQD (float): The baseline (V).
+
+        Kwargs:
+           geometry (dict): See :data:`QD_GEOMETRY`.
+
+        Returns:
+           y (np.ndarray): The QD signal (V).
+
+        Raises:
+           None
+           """
+    entry, exit, ramp = _qdEdges(t0, v, geometry)
+    inside = (np.clip((x - entry) / ramp + 0.5, 0.0, 1.0)
+              - np.clip((x - exit) / ramp + 0.5, 0.0, 1.0))
+    return cQD + q * inside
+
+
+def _qdJacobian(x, t0, v, q, geometry):
+    # Columns t0, v, q, cQD; the edges move with t0 and with 1/v
+    entry, exit, ramp = _qdEdges(t0, v, geometry)
+    uIn, uOut = (x - entry) / ramp + 0.5, (x - exit) / ramp + 0.5
+    onIn, onOut = (uIn > 0.0) & (uIn < 1.0), (uOut > 0.0) & (uOut < 1.0)
+    dEntry = np.where(onIn, -1.0 / ramp, 0.0)
+    dExit = np.where(onOut, 1.0 / ramp, 0.0)
+    dRamp = (np.where(onIn, -(x - entry), 0.0)
+             + np.where(onOut, x - exit, 0.0)) / ramp**2
+    jac = np.empty((len(x), 4))
+    jac[:, 0] = q * (dEntry + dExit)
+    jac[:, 1] = q * ((geometry["drift"] + geometry["length"]) * dEntry
+                     + geometry["drift"] * dExit
+                     - geometry["ramp"] * dRamp) / v**2
+    jac[:, 2] = (np.clip(uIn, 0.0, 1.0) - np.clip(uOut, 0.0, 1.0))
+    jac[:, 3] = 1.0
+    return jac
+
+
+# %%THE JOINT MODEL OVER STACKED CHANNELS
+def jointModel(x, params, geometry=QD_GEOMETRY):
+    """The QD, ion grid and target signals of one impact.
+
+        Args:
+           x (np.ndarray): The time (s), shared by the three channels.
+
+           params (np.ndarray): The :data:`PARAM_NAMES` vector.
+
+        Kwargs:
+           geometry (dict): See :data:`QD_GEOMETRY`.
+
+        Returns:
+           y (np.ndarray): (3, len(x)) QD, ion grid and target (V).
+
+        Raises:
+           None
+           """
+    p = np.append(np.asarray(params, dtype=float), 0.0)
+    return np.stack([qdTrapezoid(x, *p[:4], geometry=geometry),
+                     AlterIDEXIonGrid(x, *p[_ION_COLUMNS]),
+                     IDEXTarget(x, *p[_TARGET_COLUMNS])])
+
+
+def jointJacobian(x, params, geometry=QD_GEOMETRY):
+    """The (3 len(x), N_PARAMS) Jacobian of :func:`jointModel`, channel
+    rows stacked like jointModel(...).ravel()."""
+    p = np.append(np.asarray(params, dtype=float), 0.0)
+    n = len(x)
+    jac = np.zeros((3 * n, N_PARAMS))
+    jac[:n, :4] = _qdJacobian(x, *p[:3], geometry=geometry)
+    ion = _pulseJacobian(x, *p[_ION_COLUMNS[[0, 2, 3, 4, 5, 6]]])
+    jac[n:2 * n, _ION_COLUMNS] = ion
+    target = _pulseJacobian(x, *p[_TARGET_COLUMNS[[0, 2, 3, 4, 5, 6]]])
+    keep = _TARGET_COLUMNS >= 0
+    jac[2 * n:, _TARGET_COLUMNS[keep]] = target[:, keep]
+    return jac
+
+
+def jointBounds(x):
+    """(lower, upper) of the joint parameters: the pulse limits of
+    :func:`SudaIonTarget.pulseBounds` and a speed within
+    :data:`SPEED_LIMITS`."""
+    lower, upper = pulseBounds(x)
+    lo = np.full(N_PARAMS, -np.inf)
+    hi = np.full(N_PARAMS, np.inf)
+    lo[_ION_COLUMNS], hi[_ION_COLUMNS] = lower, upper
+    lo[_TARGET_COLUMNS[[0, 3, 5, 6]]] = lower[[0, 3, 5, 6]]
+    hi[_TARGET_COLUMNS[[0, 3, 5, 6]]] = upper[[0, 3, 5, 6]]
+    lo[1], hi[1] = SPEED_LIMITS
+    return lo, hi
+
+
+# %%STARTING VALUES
+def qdGuess(x, y, t0, geometry=QD_GEOMETRY):
+    """[v, q, cQD] read off a QD waveform given the impact time: the
+    baseline after the impact, when the particle has left the tube, the
+    plateau at the extremum before it, and the speed from the time between
+    the half-height crossings either side of the extremum."""
+    after = x >= t0
+    if np.count_nonzero(after) < 2:
+        after = x >= x[int(0.9 * len(x))]
+    cQD = np.median(y[after])
+    signal = _smoothed(y - cQD, max(int(1e-3 * len(y)), 1))
+    before = np.flatnonzero(~after)
+    k = before[np.argmax(np.abs(signal[before]))] if len(before) else 0
+    q = signal[k]
+    half = np.abs(signal) >= 0.5 * abs(q)
+    lo = k - np.argmax(~half[k::-1]) if not half[:k + 1].all() else 0
+    hi = k + np.argmax(~half[k:]) if not half[k:].all() else len(x) - 1
+    transit = x[hi] - x[lo]
+    v = geometry["length"] / transit if transit > 0 else SPEED_LIMITS[1]
+    return np.array([np.clip(v, *SPEED_LIMITS), q, cQD])
+
+
+def jointGuess(x, y, pre=IMAGE_START, geometry=QD_GEOMETRY):
+    """Starting values for :func:`fitJoint`: the ion grid and target from
+    :func:`SudaIonTarget.pulseGuess`, the impact time from the ion grid,
+    and the QD from :func:`qdGuess` at that time."""
+    ion = pulseGuess(x, y[1], pre)
+    target = pulseGuess(x, y[2], pre, image=False)
+    params = np.empty(N_PARAMS)
+    params[_ION_COLUMNS] = ion
+    params[_TARGET_COLUMNS[[1, 4, 5, 6]]] = target[[1, 4, 5, 6]]
+    params[1:4] = qdGuess(x, y[0], ion[0], geometry)
+    lo, hi = jointBounds(x)
+    return np.clip(params, lo, hi)
+
+
+# %%FIT ONE IMPACT
+def _blockAverage(x, y, maxSamples):
+    # Average blocks of samples so no channel has more than maxSamples
+    block = int(np.ceil(x.shape[-1] / maxSamples))
+    if block <= 1:
+        return x, y
+    n = x.shape[-1] // block * block
+    return (x[:n].reshape(-1, block).mean(axis=1),
+            y[:, :n].reshape(len(y), -1, block).mean(axis=2))
+
+
+def fitJoint(x, y, p0=None, geometry=QD_GEOMETRY, pre=IMAGE_START,
+             maxSamples=MAX_FIT_SAMPLES):
+    """Fit the QD, ion grid and target of one impact at once. Every channel
+    is weighted by the inverse of its pre-trigger noise, so channels with
+    different gains count alike.
+
+        Args:
+           x (np.ndarray): The time (s), shared by the three channels.
+
+           y (np.ndarray): (3, len(x)) QD, ion grid and target (V).
+
+        Kwargs:
+           p0 (np.ndarray): Starting values, :func:`jointGuess` by default.
+
+           geometry (dict): See :data:`QD_GEOMETRY`.
+
+           pre (float): The end of the pre-trigger window.
+
+           maxSamples (int): Longer records are block averaged down to this
+           many samples per channel before fitting.
+
+        Returns:
+           fit (dict): params, the :data:`PARAM_NAMES` vector; sigma, their
+           standard errors; velocity (km/s); charge (C); rms, the residual
+           RMS of each channel (V); nfev.
+
+        Raises:
+           RuntimeError: The solver did not converge.
+           """
+    x = np.asarray(x, dtype=float)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    x, y = _blockAverage(x, y, maxSamples)
+    quiet = x < pre
+    if np.count_nonzero(quiet) < 2:
+        quiet = x <= x[0] + 0.1 * (x[-1] - x[0])
+    # The QD may already be ringing before the trigger; take its noise from
+    # the end of the record
+    noise = np.array([y[0, x >= x[int(0.9 * len(x))]].std(),
+                      y[1, quiet].std(), y[2, quiet].std()])
+    weight = 1.0 / np.where(noise > 0, noise, 1.0)
+
+    lo, hi = jointBounds(x)
+    if p0 is None:
+        p0 = jointGuess(x, y, pre, geometry)
+    p0 = np.clip(np.asarray(p0, dtype=float), lo, hi)
+    rowWeight = np.repeat(weight, len(x))
+    result = least_squares(
+        lambda p: ((jointModel(x, p, geometry) - y) * weight[:, None]).ravel(),
+        p0, jac=lambda p: jointJacobian(x, p, geometry) * rowWeight[:, None],
+        bounds=(lo, hi), method="trf", x_scale="jac")
+    if result.status <= 0:
+        raise RuntimeError("Joint fit did not converge: " + result.message)
+
+    residual = result.fun.reshape(3, -1) / weight[:, None]
+    dof = max(result.fun.size - N_PARAMS, 1)
+    try:
+        cov = np.linalg.pinv(result.jac.T @ result.jac) * (
+            2.0 * result.cost / dof)
+        sigma = np.sqrt(np.abs(np.diag(cov)))
+    except np.linalg.LinAlgError:
+        sigma = np.full(N_PARAMS, np.nan)
+    params = result.x
+    return {"params": params,
+            "sigma": sigma,
+            "velocity": params[1] / 1000.0,
+            "charge": params[2] * geometry["capacitance"],
+            "rms": np.sqrt(np.mean(residual**2, axis=1)),
+            "nfev": int(result.nfev)}
+
+
+# %%CHANNELS OF A RUN
+def jointChannels(names):
+    """(QD, ion grid, target) channel columns picked from the settings.txt
+    names: the first name mentioning QD, Ion and Target, in any case. A
+    channel that is not found is None."""
+    def find(word):
+        for i, name in enumerate(names or []):
+            if word in name.lower():
+                return i
+        return None
+    return find("qd"), find("ion"), find("target")
+
+
+def _stacked(dataDir, pattern, shotIdx, channels):
+    # The shared time base and the (3, samples) QD, ion grid and target
+    run = sharedRun(dataDir, pattern=pattern, cacheBytes=WORKER_CACHE_BYTES)
+    times, amps = run.shot(shotIdx)
+    n = min(len(times[channel]) for channel in channels)
+    return (np.asarray(times[channels[1]][:n], dtype=float),
+            np.stack([np.asarray(amps[channel][:n], dtype=float)
+                      for channel in channels]))
+
+
+def fitJointShot(dataDir, pattern, shotIdx, channels, geometry=QD_GEOMETRY):
+    """Decode one shot and fit it with :func:`fitJoint`, in a pool
+    process.
+
+        Args:
+           dataDir (str): The run folder.
+
+           pattern (str): The trace file name pattern.
+
+           shotIdx (int): The shot to fit.
+
+           channels (tuple): The (QD, ion grid, target) channel columns.
+
+        Kwargs:
+           geometry (dict): See :data:`QD_GEOMETRY`.
+
+        Returns:
+           fit (dict): The :func:`fitJoint` result.
+
+        Raises:
+           RuntimeError: The fit did not converge.
+           """
+    time, amps = _stacked(dataDir, pattern, shotIdx, channels)
+    return fitJoint(time, amps, geometry=geometry)
+
+
+# %%FIT A RUN
+def fitJointRun(dataDir, channels=None, shots=None, geometry=QD_GEOMETRY,
+                workers=None, pattern=DEFAULT_PATTERN, pool=None):
+    """Fit every shot of a run jointly in a process pool, yielding each
+    result as soon as it is ready (in completion order).
+
+        Args:
+           dataDir (str): The run folder.
+
+        Kwargs:
+           channels (tuple): The (QD, ion grid, target) channel columns; by
+           default found in settings.txt with :func:`jointChannels`, the ion
+           grid falling back to runFits.ION_GRID_CHANNEL.
+
+           shots (list): The shot indices to fit, every shot by default.
+
+           geometry (dict): See :data:`QD_GEOMETRY`.
+
+           workers (int): Pool size, defaults to the number of cores.
+
+           pattern (str): The trace file name pattern.
+
+           pool (Executor): A pool to use instead of starting one.
+
+        Returns:
+           results (generator): (shotIdx, fit, error) tuples; fit is None
+           and error the exception when a fit fails.
+
+        Raises:
+           ValueError: A channel is missing from the run.
+           """
+    dataDir = os.path.abspath(dataDir)
+    index = indexRun(dataDir, pattern=pattern)
+    if channels is None:
+        qd, ion, target = jointChannels(readChannelNames(dataDir))
+        channels = (qd, ION_GRID_CHANNEL if ion is None else ion, target)
+    for name, channel in zip(("QD", "ion grid", "target"), channels):
+        if channel is None or not 0 <= channel < index.nChannels:
+            raise ValueError("{}: no {} channel among {} channels".format(
+                dataDir, name, index.nChannels))
+    if shots is None:
+        shots = range(index.nShots)
+    return _streamed(pool, workers, lambda pool: {
+        pool.submit(fitJointShot, dataDir, pattern, shotIdx,
+                    tuple(channels), geometry): shotIdx
+        for shotIdx in shots})
+
+
+def jointTable(results):
+    """One row per shot of (shotIdx, fit, error) results: Trace Number,
+    Velocity (km/s), Charge (C), the parameters and their errors, the RMS
+    of each channel, the evaluations and any error, in shot order."""
+    rows = []
+    for shotIdx, fit, error in results:
+        row = {"Trace Number": shotIdx + 1}
+        if fit is not None:
+            row["Velocity (km/s)"] = fit["velocity"]
+            row["Charge (C)"] = fit["charge"]
+            row.update(zip(PARAM_NAMES, fit["params"]))
+            row.update(zip(["sigma " + name for name in PARAM_NAMES],
+                           fit["sigma"]))
+            row.update(zip(["RMS QD (V)", "RMS Ion Grid (V)",
+                            "RMS Target (V)"], fit["rms"]))
+            row["Evaluations"] = fit["nfev"]
+        row["Error"] = "" if error is None else str(error)
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    return df.sort_values("Trace Number").reset_index(drop=True) if rows \
+        else df
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fit the QD, ion grid and target of every shot of a run "
+        "together, for the velocity and charge of each particle.")
+    parser.add_argument("dataDir", help="run folder containing .trc files")
+    parser.add_argument("-o", "--output", default=None,
+                        help="CSV file (default <run>/<run>_IonGridFits/{})"
+                        .format(RESULTS_NAME))
+    parser.add_argument("--channels", type=int, nargs=3, default=None,
+                        metavar=("QD", "ION", "TARGET"),
+                        help="channel columns (default: from settings.txt)")
+    for key, value in QD_GEOMETRY.items():
+        parser.add_argument("--" + key, type=float, default=value,
+                            help="QD {} (default {})".format(key, value))
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="trace file name regular expression")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    geometry = {key: getattr(args, key) for key in QD_GEOMETRY}
+    results = []
+    for shotIdx, fit, error in fitJointRun(args.dataDir, args.channels,
+                                           geometry=geometry,
+                                           workers=args.jobs,
+                                           pattern=args.pattern):
+        results.append((shotIdx, fit, error))
+        if args.verbose:
+            print("Trace {}: {}".format(shotIdx + 1, error or
+                                        "{:.3f} km/s, {:.3e} C".format(
+                                            fit["velocity"], fit["charge"])))
+    output = args.output or os.path.join(fitFolder(args.dataDir),
+                                         RESULTS_NAME)
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    jointTable(results).to_csv(output, index=False)
+    failed = sum(error is not None for shotIdx, fit, error in results)
+    print("Fitted {} shot(s), {} failed, wrote {}".format(
+        len(results) - failed, failed, output))
+    return 1 if failed else 0
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Noise diagnostics of many records at once: autocorrelation by FFT,
+amplitude histogram with a Gaussian fit, Welch power spectrum and the
+comparison of a reconstructed series with its original, all as arrays,
+and a summary of every channel of a run in one pass. Plots are a
+separate, optional step.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+Usage:
+    python noiseDiagnostics.py <run folder> [--channels 1 2] [--plot]
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.fft import irfft, next_fast_len, rfft
+from scipy.optimize import curve_fit
+
+from runFits import _streamed
+from runStore import RunStore, openRun, sharedRun
+from trcIndex import DEFAULT_PATTERN, readChannelNames
+from waveformDefaults import IMAGE_START
+from welchPSD import NPERSEG, WelchPSD
+
+# %%DEFAULTS
+MAX_LAG = 1000  # Autocorrelation lags kept, in samples
+BINS = 200  # Amplitude histogram bins
+HIST_SIGMAS = 8.0  # Histogram half width, in standard deviations
+CHUNK_SHOTS = 16  # Shots one pool task goes through
+WORKER_CACHE_BYTES = 0  # Each shot is read once, nothing to cache
+
+
+# %%OUTPUT, NEXT TO THE RUN'S NOISE SPECTRA (welchPSD.resultsPath)
+def resultsPath(dataDir):
+    """Where a run's noise summary goes: <run>/<run>_Noise/<run>_Noise.csv"""
+    name = os.path.basename(os.path.normpath(dataDir))
+    return os.path.join(dataDir, "{}_Noise".format(name),
+                        "{}_Noise.csv".format(name))
+
+
+# %%THE ARRAY KERNELS
+def autocorrelation(y, maxLag=MAX_LAG):
+    """The autocorrelation function of every record, through one zero
+    padded FFT per record instead of a sum per lag. It is the biased
+    estimate (every lag divided by the record length) that
+    statsmodels.tsa.stattools.acf returns.
+
+        Args:
+           y (np.ndarray): One record or (records, samples).
+
+        Kwargs:
+           maxLag (int): The last lag kept.
+
+        Returns:
+           acf (np.ndarray): (records, maxLag + 1), 1 at lag 0; lags past
+           the record length are NaN.
+
+        Raises:
+           None
+           """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n = y.shape[1]
+    z = y - y.mean(axis=1, keepdims=True)
+    spectrum = rfft(z, n=next_fast_len(2 * n - 1), axis=1)
+    acov = irfft(spectrum.real**2 + spectrum.imag**2, axis=1)
+    acf = np.full((len(y), maxLag + 1), np.nan)
+    kept = min(maxLag + 1, n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acf[:, :kept] = acov[:, :kept] / acov[:, :1]
+    return acf
+
+
+def gaussian(x, mean, amplitude, sigma):
+    return amplitude * np.exp(-(x - mean)**2 / (2.0 * sigma**2))
+
+
+def gaussFit(counts, edges):
+    """Fit :func:`gaussian` to histogram counts, starting from the moments
+    of the histogram.
+
+        Args:
+           counts (np.ndarray): The counts per bin.
+
+           edges (np.ndarray): The bin edges, one more than counts.
+
+        Kwargs:
+           None
+
+        Returns:
+           fit (dict): mean, amplitude and sigma, NaN if the fit failed.
+
+        Raises:
+           None
+           """
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    total = counts.sum()
+    if total <= 0:
+        return {"mean": np.nan, "amplitude": np.nan, "sigma": np.nan}
+    mean = (counts * centers).sum() / total
+    sigma = np.sqrt((counts * (centers - mean)**2).sum() / total)
+    try:
+        popt, _ = curve_fit(gaussian, centers, counts,
+                            p0=[mean, counts.max(), max(sigma, 1e-300)])
+    except (RuntimeError, ValueError):
+        popt = [np.nan] * 3
+    return {"mean": popt[0], "amplitude": popt[1], "sigma": abs(popt[2])}
+
+
+def histogramEdges(y, bins=BINS, sigmas=HIST_SIGMAS):
+    """Bin edges spanning sigmas standard deviations either side of the
+    mean of y, fixed before a pass so the counts of separate chunks and
+    workers add up. Digitized data get bins a whole number of digitizer
+    steps wide with edges halfway between levels, so no bin is empty
+    because it falls between two levels (there may then be fewer than
+    bins)."""
+    y = np.asarray(y, dtype=float)
+    mean, std = y.mean(), y.std()
+    if not std > 0:
+        std = 1.0
+    lo, hi = mean - sigmas * std, mean + sigmas * std
+    width = (hi - lo) / bins
+    levels = np.unique(y)
+    steps = np.diff(levels)
+    steps = steps[steps > 0]
+    if not len(steps) or steps.min() < width / 2.0:
+        return np.linspace(lo, hi, bins + 1)
+    quantum = steps.min()
+    width = quantum * np.ceil(width / quantum)
+    origin = levels[0] - 0.5 * quantum
+    lo = origin + np.floor((lo - origin) / quantum) * quantum
+    return lo + width * np.arange(int(np.ceil((hi - lo) / width)) + 1)
+
+
+def comparePSD(original, reconstructed, step, nperseg=NPERSEG):
+    """The Welch spectra of an original and a reconstructed series (or
+    batches of records of each) on the same frequencies.
+
+        Args:
+           original (np.ndarray): One record or (records, samples).
+
+           reconstructed (np.ndarray): One record or (records, samples).
+
+           step (float): The sample interval of both (s).
+
+        Kwargs:
+           nperseg (int): Samples per Welch segment, reduced to the
+           shortest record if that is shorter.
+
+        Returns:
+           comparison (dict): freqs (Hz), original and reconstructed
+           densities, their ratio, and medianLogRatio, the median
+           log10 ratio over the non-zero frequencies.
+
+        Raises:
+           None
+           """
+    nperseg = min(nperseg, np.atleast_2d(original).shape[1],
+                  np.atleast_2d(reconstructed).shape[1])
+    freqs, psd = WelchPSD(nperseg, step=step).add(original).psd()
+    _, recon = WelchPSD(nperseg, step=step).add(reconstructed).psd()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = recon / psd
+    return {"freqs": freqs, "original": psd, "reconstructed": recon,
+            "ratio": ratio,
+            "medianLogRatio": np.nanmedian(np.log10(ratio[1:]))}
+
+
+# %%EVERY DIAGNOSTIC OF ONE CHANNEL, MERGEABLE
+class NoiseStats:
+
+    def __init__(self, edges, nperseg=NPERSEG, maxLag=MAX_LAG):
+        """The running noise diagnostics of one channel: Welch PSD, mean
+        autocorrelation, amplitude histogram and moments. Records are added
+        one at a time and only totals are kept; estimates of the same
+        channel made by different workers merge like :class:`WelchPSD`.
+
+        Args:
+           edges (np.ndarray): The histogram bin edges, see
+           :func:`histogramEdges`. Samples outside are counted in
+           outside.
+
+        Kwargs:
+           nperseg (int): Samples per Welch segment.
+
+           maxLag (int): The last autocorrelation lag.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.outside = 0
+        self.welch = WelchPSD(nperseg)
+        self.maxLag = maxLag
+        self.acfSum = np.zeros(maxLag + 1)
+        self.acfRecords = np.zeros(maxLag + 1, dtype=np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.totalSq = 0.0
+
+    def add(self, y, step=None):
+        """Add one record, or each row of (records, samples). The block is
+        reduced whole: one batched autocorrelation and one histogram."""
+        self.welch.add(y, step=step)
+        y = np.atleast_2d(np.asarray(y, dtype=float))
+        if not y.size:
+            return self
+        acf = autocorrelation(y, self.maxLag)
+        valid = np.isfinite(acf)
+        self.acfSum += np.where(valid, acf, 0.0).sum(axis=0)
+        self.acfRecords += valid.sum(axis=0)
+        counts, _ = np.histogram(y, self.edges)
+        self.counts += counts
+        self.outside += y.size - counts.sum()
+        self.n += y.size
+        self.total += y.sum()
+        self.totalSq += (y**2).sum()
+        return self
+
+    def merge(self, other):
+        """Add the totals of another estimate of the same channel."""
+        if not np.array_equal(self.edges, other.edges) or \
+                self.maxLag != other.maxLag:
+            raise ValueError("Cannot merge noise statistics with different "
+                             "bins or lags")
+        self.welch.merge(other.welch)
+        self.counts += other.counts
+        self.outside += other.outside
+        self.acfSum += other.acfSum
+        self.acfRecords += other.acfRecords
+        self.n += other.n
+        self.total += other.total
+        self.totalSq += other.totalSq
+        return self
+
+    __iadd__ = merge
+
+    def acf(self):
+        """(lags in samples, mean autocorrelation over the records)"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (np.arange(self.maxLag + 1),
+                    np.where(self.acfRecords > 0,
+                             self.acfSum / self.acfRecords, np.nan))
+
+    def summary(self):
+        """The one-line diagnostics: records, samples, mean and RMS, the
+        Gaussian fit of the histogram, the RMS from the integrated PSD,
+        the strongest non-zero frequency and the correlation time (the
+        first lag where the autocorrelation falls below 1/e)."""
+        mean = self.total / self.n if self.n else np.nan
+        rms = np.sqrt(max(self.totalSq / self.n - mean**2, 0.0)) \
+            if self.n else np.nan
+        fit = gaussFit(self.counts, self.edges)
+        freqs, psd = self.welch.psd()
+        step = self.welch.step if self.welch.step is not None else np.nan
+        lags, acf = self.acf()
+        below = np.flatnonzero(acf < np.exp(-1.0))
+        return {"Records": self.welch.records + self.welch.skipped,
+                "Samples": self.n,
+                "Mean (V)": mean,
+                "RMS (V)": rms,
+                "Gaussian Mean (V)": fit["mean"],
+                "Gaussian Sigma (V)": fit["sigma"],
+                "Outside Histogram": self.outside,
+                "PSD RMS (V)": np.sqrt(np.nansum(psd[1:]) * freqs[1])
+                if len(freqs) > 1 else np.nan,
+                "Peak Frequency (Hz)": freqs[1 + np.nanargmax(psd[1:])]
+                if np.isfinite(psd[1:]).any() else np.nan,
+                "Correlation Time (s)": lags[below[0]] * step
+                if len(below) else np.nan}
+
+
+# %%A WHOLE RUN IN ONE PASS
+def _noiseRecord(run, shotIdx, channel, pre):
+    # The noise samples of one channel of one shot and their interval
+    times, amps = run.shot(shotIdx)
+    t = np.asarray(times[channel], dtype=float)
+    y = np.asarray(amps[channel], dtype=float)
+    if len(t) < 2:
+        return y[:0], None
+    step = (t[-1] - t[0]) / (len(t) - 1)
+    return (y if pre is None else y[t < pre]), step
+
+
+def _shotsNoise(dataDir, pattern, shotIdxs, edges, nperseg, maxLag, pre):
+    # {channel: NoiseStats} over some shots, in a pool process
+    run = sharedRun(dataDir, pattern=pattern, cacheBytes=WORKER_CACHE_BYTES)
+    stats = {channel: NoiseStats(channelEdges, nperseg, maxLag)
+             for channel, channelEdges in edges.items()}
+    for shotIdx in shotIdxs:
+        for channel in stats:
+            y, step = _noiseRecord(run, shotIdx, channel, pre)
+            stats[channel].add(y, step=step)
+    return stats
+
+
+def diagnoseRun(dataDir, channels=None, shots=None, pre=IMAGE_START,
+                nperseg=NPERSEG, maxLag=MAX_LAG, bins=BINS,
+                chunkShots=CHUNK_SHOTS, workers=None,
+                pattern=DEFAULT_PATTERN, pool=None):
+    """Noise diagnostics of every channel of a run, reading each shot
+    once. The shots are split into chunks that pool processes go through,
+    and their :class:`NoiseStats` merged; the histogram bins are set from
+    the first shot beforehand.
+
+        Args:
+           dataDir (str): The run folder (or its consolidated store).
+
+        Kwargs:
+           channels (list): The channel columns, all of them by default.
+
+           shots (list): The shot indices, every shot by default.
+
+           pre (float): Only the samples before this time (s), the noise
+           ahead of the image charge; None for whole records.
+
+           nperseg (int): Samples per Welch segment.
+
+           maxLag (int): The last autocorrelation lag.
+
+           bins (int): Histogram bins.
+
+           chunkShots (int): Shots one pool task goes through.
+
+           workers (int): Pool size, defaults to the number of cores; 1
+           works through the chunks in this process instead.
+
+           pattern (str): The trace file name pattern.
+
+           pool (Executor): A pool to use instead of starting one.
+
+        Returns:
+           stats (dict): {channel: NoiseStats}.
+
+           errors (list): (shots, error) of the chunks that could not be
+           read; their shots are left out.
+
+        Raises:
+           ValueError: The run has no shots.
+           """
+    dataDir = os.path.abspath(dataDir)
+    # The shots are planned from the run the workers decode, see
+    # runStore.sharedRun
+    run = openRun(dataDir, pattern=pattern, cacheBytes=0)
+    try:
+        if not run.nShots:
+            raise ValueError("{}: no shots".format(dataDir))
+        if channels is None:
+            channels = range(run.nChannels)
+        channels = [c for c in channels if 0 <= c < run.nChannels]
+        if shots is None:
+            shots = range(run.nShots)
+        shots = list(shots)
+        edges = {channel: histogramEdges(
+            _noiseRecord(run, shots[0], channel, pre)[0], bins)
+            for channel in channels}
+    finally:
+        if isinstance(run, RunStore):
+            run.close()
+
+    chunks = [shots[i:i + chunkShots] for i in range(0, len(shots),
+                                                     chunkShots)]
+    task = (lambda chunk: _shotsNoise(dataDir, pattern, chunk, edges,
+                                      nperseg, maxLag, pre))
+    if workers == 1 and pool is None:
+        results = ((chunk, task(chunk), None) for chunk in chunks)
+    else:
+        results = _streamed(pool, workers, lambda pool: {
+            pool.submit(_shotsNoise, dataDir, pattern, chunk, edges, nperseg,
+                        maxLag, pre): chunk for chunk in chunks})
+
+    stats = {channel: NoiseStats(edges[channel], nperseg, maxLag)
+             for channel in channels}
+    errors = []
+    for chunk, part, error in results:
+        if error is not None:
+            errors.append((chunk, error))
+            continue
+        for channel in stats:
+            stats[channel].merge(part[channel])
+    return stats, errors
+
+
+def summaryTable(stats, names=None):
+    """One row per channel of :meth:`NoiseStats.summary`, with the channel
+    names of settings.txt if given."""
+    names = names or []
+    return pd.DataFrame([dict({"Channel": channel,
+                               "Channel Name": names[channel]
+                               if channel < len(names) else ""},
+                              **stats[channel].summary())
+                         for channel in sorted(stats)])
+
+
+# %%PLOTS, A SEPARATE STEP
+def plotNoise(stats, path, title=""):
+    """Draw the PSD, autocorrelation and histogram of one channel side by
+    side to path.
+
+        Args:
+           stats (NoiseStats): The channel's diagnostics.
+
+           path (str): The image file.
+
+        Kwargs:
+           title (str): The figure title.
+
+        Returns:
+           path (str): The image file.
+
+        Raises:
+           None
+           """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(15, 4.5))
+    FigureCanvasAgg(fig)
+    axPSD, axACF, axHist = fig.subplots(1, 3)
+
+    freqs, psd = stats.welch.psd()
+    axPSD.loglog(freqs[1:], psd[1:], "r", lw=1)
+    axPSD.set_xlabel("Frequency (Hz)")
+    axPSD.set_ylabel(r"PSD (V$^2$/Hz)")
+
+    lags, acf = stats.acf()
+    step = stats.welch.step
+    axACF.plot(lags * step if step else lags, acf, "b", lw=1)
+    axACF.axhline(np.exp(-1.0), color="k", ls="dashdot", lw=0.5)
+    axACF.set_xlabel("Lag (s)" if step else "Lag (samples)")
+    axACF.set_ylabel("Autocorrelation")
+
+    centers = 0.5 * (stats.edges[1:] + stats.edges[:-1])
+    axHist.step(centers, stats.counts, "k", where="mid", lw=1)
+    fit = gaussFit(stats.counts, stats.edges)
+    if np.isfinite(fit["sigma"]):
+        axHist.plot(centers, gaussian(centers, fit["mean"], fit["amplitude"],
+                                      fit["sigma"]), "r",
+                    label=r"$\mu$ = {:.3g}, $\sigma$ = {:.3g}".format(
+                        fit["mean"], fit["sigma"]))
+        axHist.legend()
+    axHist.set_xlabel("Amplitude (V)")
+    axHist.set_ylabel("Number of Occurences")
+
+    fig.suptitle(title)
+    fig.tight_layout()
+    fig.savefig(path)
+    return path
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Noise diagnostics of every channel of a run.")
+    parser.add_argument("dataDir", help="run folder containing .trc files")
+    parser.add_argument("-o", "--output", default=None,
+                        help="CSV file (default "
+                        "<run>/<run>_Noise/<run>_Noise.csv)")
+    parser.add_argument("--channels", type=int, nargs="+", default=None,
+                        help="channel columns (default: all)")
+    parser.add_argument("--whole-records", action="store_true",
+                        help="use whole records, not only the samples "
+                        "before the image charge")
+    parser.add_argument("--nperseg", type=int, default=NPERSEG,
+                        help="samples per Welch segment")
+    parser.add_argument("--max-lag", type=int, default=MAX_LAG,
+                        help="last autocorrelation lag in samples")
+    parser.add_argument("--plot", action="store_true",
+                        help="also draw Noise_C<channel>.png per channel")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="pool size (default: number of cores)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="trace file name regular expression")
+    args = parser.parse_args(argv)
+
+    stats, errors = diagnoseRun(args.dataDir, args.channels,
+                                pre=None if args.whole_records
+                                else IMAGE_START, nperseg=args.nperseg,
+                                maxLag=args.max_lag, workers=args.workers,
+                                pattern=args.pattern)
+    for chunk, error in errors:
+        print("Shots {}-{} failed: {}".format(chunk[0] + 1, chunk[-1] + 1,
+                                              error))
+    names = readChannelNames(args.dataDir)
+    df = summaryTable(stats, names)
+    output = args.output or resultsPath(args.dataDir)
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    df.to_csv(output, index=False)
+    print(df.to_string(index=False))
+    print("Wrote {}".format(output))
+
+    if args.plot:
+        folder = os.path.dirname(output) or "."
+        for channel in stats:
+            name = names[channel] if names and channel < len(names) else \
+                "Channel {}".format(channel)
+            print(plotNoise(stats[channel], os.path.join(
+                folder, "Noise_C{}.png".format(channel)), title=name))
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
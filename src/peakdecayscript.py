@@ -7,16 +7,16 @@ __author__      = Ethan Ayari,
 Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
 """
 
-import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 # import matplotlib as mpl
 from scipy.fft import fft, fftfreq
 from scipy.optimize import curve_fit
-from statsmodels.graphics import tsaplots
 from math import factorial
 
+from spectraStore import H5SpectraStore
+
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -92,20 +92,13 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
 
 
 # %%
-def read_hdf5(path):
-
-    keys = []
-    f = h5py.File(path, 'r')  # open file
-
-    f.visit(keys.append)   # append all keys to list
-    for key in keys:
-        print(f[key].name)
-        pass
-
-    # change this to whatever you want to extract
-    mass = f["/Spectra/47: 9CE8F380-E65A-4A40-9BA1-BC5E21778DF5/Time"]
-    amp = f["/Spectra/47: 9CE8F380-E65A-4A40-9BA1-BC5E21778DF5/AmplitudeDenoised"]
-    return mass[()], amp[()]
+def read_hdf5(path, key=47, fields=("Time", "AmplitudeDenoised")):
+    # change key and fields to whatever you want to extract; only those
+    # datasets are read, see spectraStore.H5SpectraStore
+    with H5SpectraStore(path) as store:
+        if(verbose):
+            store.report()
+        return store.spectrum(key, fields)
 
 
 # %%APPEND ALL OF THE PERIDOT SPECTRA INTO MASS AND AMPLITUDE LISTS
@@ -113,19 +106,15 @@ def read_all_hdf5(path):
     amps = []
     masses = []
     times = []
-    keys = []
-    f = h5py.File(path, 'r')  # open file
-
-    f.visit(keys.append)   # append all keys to list
-    for key in keys:
-        # print(f[key].name)
-        if(str(f[key].name).endswith('Mass')):
-            masses.append(f[key][()])
-        if(str(f[key].name).endswith('Amplitude')):
-            amps.append(f[key][()])
-        if(str(f[key].name).endswith('Time')):
-            times.append(f[key][()])
-        pass
+    with H5SpectraStore(path) as store:
+        for key in store:
+            fields = store.fields(key)
+            if("Mass" in fields):
+                masses.append(store.read(key, "Mass"))
+            if("Amplitude" in fields):
+                amps.append(store.read(key, "Amplitude"))
+            if("Time" in fields):
+                times.append(store.read(key, "Time"))
 
     return times, masses, amps
 
@@ -219,49 +208,73 @@ def reconstruct_time_series(psd, n, delta, ax=None, plot=False):
 
 
 # %%
-def generate_noise(axs=None, Plot=False):
+def generate_noise(axs=None, Plot=False, n=None):
     # times, mass, amps = read_all_hdf5("/Users/ethanayari/Desktop/
     # Peridot_Jan_'21/run580(11-10).h5")
-    times, mass, amps = read_all_hdf5("run580(11-10).h5")
-    slices = []
-    for amp in amps:
-        slices.append(amp)
-    delta = float(times[0][1] - times[0][0])  # Time scale value
-    noise = np.concatenate(slices, axis=0)  # Array of all amplitudes
-    n = len(noise)  # Sample size
-    fhat = np.fft.fft(noise)  # computes the fft
-    fft_fre = np.fft.fftfreq(n=noise.size, d=delta)
+    # Welch estimate streamed over the spectra, see welchPSD, instead of
+    # one FFT over all of them joined end to end
+    from welchPSD import exportPSD
+    welch = exportPSD("run580(11-10).h5")
+    delta = welch.step  # Time scale value
+    if(n is None):
+        # Sample size of the series to reconstruct: one record, not the
+        # whole file, so the FFT grid stays the size of a spectrum
+        n = welch.samples // max(welch.records + welch.skipped, 1)
+    n = int(n)
+    freqs, density = welch.psd()
+    fft_fre = np.fft.fftfreq(n=n, d=delta)
+    # On the FFT grid of n samples, scaled like |fft|^2 / n
+    psd = np.interp(np.abs(fft_fre), freqs, density) / (2.0 * delta)
+    if(Plot):
+        ax = axs[1] if axs is not None else plt.gca()
+        ax.plot(freqs, density, 'r', label="Welch Spectral Power Density")
+        plt.xlabel('Frequency (Hz)')
+        plt.ylabel(r"$\frac{ion numer^{2}}{Hz}$")
+        plt.legend()
+        plt.title("Power Spectrum", fontweight='bold', fontsize=20)
+        plt.show()
     if(axs is not None):
-        psd = compute_power_spectrum(fhat, fft_fre, n, axs[1], plot=Plot)
         reco = reconstruct_time_series(psd, n, delta, axs[2], plot=Plot)
     else:
-        psd = compute_power_spectrum(fhat, fft_fre, n, plot=Plot)
         reco = reconstruct_time_series(psd, n, delta, plot=Plot)
     return reco
 
 
 # %%
-def end_to_end_amps(amps, recon):
-    hist, bins = np.histogram(recon, bins=1000)
-    heights, borders, _ = plt.hist(recon, bins, label='Amplitude Histogram')
-    plt.xlabel('Amplitude (ion number)')
-    plt.ylabel('Number of Occurences')
-    plt.title('Reconstructed Noise Amplitudes', fontsize=20, fontweight='bold')
-    gauss_fit(heights, borders, True)
-    plt.show()
-
-    hist, bins = np.histogram(recon, bins=15)
-    heights, borders, _ = plt.hist(amps, bins, label='Amplitude Histogram')
-    plt.xlabel('Amplitude (ion number)')
-    plt.ylabel('Number of Occurences')
-    plt.title('Original Noise Amplitudes', fontsize=20, fontweight='bold')
-    gauss_fit(heights, borders, True)
-    plt.show()
+def end_to_end_amps(amps, recon, plot=True):
+    # Histograms and Gaussian fits as arrays, see noiseDiagnostics; the
+    # plots are optional
+    from noiseDiagnostics import gaussFit, gaussian
+    results = {}
+    for name, values, bins in (("Reconstructed", recon, 1000),
+                               ("Original", amps, 15)):
+        heights, borders = np.histogram(values, bins)
+        fit = gaussFit(heights, borders)
+        results[name] = (heights, borders, fit)
+        if(plot):
+            plt.stairs(heights, borders, fill=True,
+                       label='Amplitude Histogram')
+            x_interval_for_fit = np.linspace(borders[0], borders[-1], 10000)
+            plt.plot(x_interval_for_fit,
+                     gaussian(x_interval_for_fit, fit["mean"],
+                              fit["amplitude"], fit["sigma"]), 'r',
+                     label=r'$\mu = ${:.2f}, A = {:.2f}, $\sigma$ = {:.2f}'
+                     .format(fit["mean"], fit["amplitude"], fit["sigma"]),
+                     lw=3)
+            plt.legend()
+            plt.xlabel('Amplitude (ion number)')
+            plt.ylabel('Number of Occurences')
+            plt.title('{} Noise Amplitudes'.format(name), fontsize=20,
+                      fontweight='bold')
+            plt.show()
+    return results
 
 
 # %%
-def end_to_end_psd(freq, psd, reco, plot=False):
-    delta = float(times[0][1] - times[0][0])  # Time scale value
+def end_to_end_psd(freq, psd, reco, plot=False, delta=None):
+    if(delta is None):
+        # freq is the np.fft.fftfreq grid the original psd was computed on
+        delta = 1.0 / (len(freq) * freq[1])  # Time scale value
     n = len(reco)  # Sample size
     fhat = np.fft.fft(reco)  # computes the fft
     fft_fre = np.fft.fftfreq(n=reco.size, d=delta)
@@ -286,16 +299,24 @@ def end_to_end_psd(freq, psd, reco, plot=False):
         plt.legend()
         plt.title("Power Spectrum Comparison", fontweight='bold', fontsize=20)
         plt.show()
+    return idxs_half, psd_real, recon_idxs_half, recon_psd_real
 
 
 # %%
-def take_autocorr(timeseries, name):
-    # plot autocorrelation function
-    tsaplots.plot_acf(timeseries, lags=1000)
-    plt.xlabel(r'Number of Lags (5ns steps)')
-    plt.ylabel("Correlation")
-    plt.title(name, fontweight='bold', fontsize=20)
-    plt.show()
+def take_autocorr(timeseries, name, lags=1000, plot=True):
+    # autocorrelation function by FFT, see noiseDiagnostics.autocorrelation
+    from noiseDiagnostics import autocorrelation
+    acf = autocorrelation(timeseries, lags)[0]
+    if(plot):
+        # plot it with the 95% band of white noise
+        band = 1.96 / np.sqrt(len(timeseries))
+        plt.vlines(np.arange(len(acf)), 0, acf)
+        plt.fill_between(np.arange(len(acf)), -band, band, alpha=.25)
+        plt.xlabel(r'Number of Lags (5ns steps)')
+        plt.ylabel("Correlation")
+        plt.title(name, fontweight='bold', fontsize=20)
+        plt.show()
+    return acf
 
 
 # %%
@@ -382,8 +403,7 @@ def main():
     np.savetxt("Frequencies.txt", np.real(xf[x2]))
 
     # plot autocorrelation function
-    tsaplots.plot_acf(ampslice, lags=100)
-    plt.show()
+    take_autocorr(ampslice, "Peridot White Noise", lags=100)
 
 
 # %%
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+QD pickup tube analysis of whole runs: entry and exit edges, transit time,
+velocity and charge of every shot from (shots, samples) arrays, with no
+curve fitting.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+A charged particle flying through the tube raises its signal by a plateau
+proportional to its charge for as long as it is inside. Each record is
+run through a step matched filter (the mean of the next m samples minus
+the mean of the previous m): the entry is its strongest response of the
+plateau's polarity, the exit the strongest opposite one after it. Both
+are refined between samples. A shot counts as detected when both stand
+DETECT_SIGMA noise levels clear, and the plateau between them is as high
+as the steps say, MIN_SNR noise levels high and longer than the filter.
+The tube length over the transit time gives the speed, the plateau times
+the charge per volt the charge.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from runStore import RunStore, openRun, triggerTimes
+from trcIndex import DEFAULT_PATTERN, indexRun, readChannelNames
+from waveformDefaults import QD_GEOMETRY
+
+# %%DEFAULTS
+EDGE_WINDOW = 2.0e-6  # Matched filter half width (s)
+DETECT_SIGMA = 6.0  # Edge responses needed to call a shot detected
+MAX_SAMPLES = 50000  # Per record; longer ones are block averaged first
+CHUNK_SHOTS = 64  # Shots decoded and analysed together
+CLIP_SAMPLES = 10  # Samples at the record extreme that mark it clipped
+STEP_AGREEMENT = 0.5  # Least plateau, as a fraction of the edge steps
+MIN_SNR = 3.0  # Least plateau, in sample noise levels
+RESULTS_NAME = "{}_QD.csv"
+
+
+# %%OUTPUT, NAMED AS IN THE QUICKLOOK VIEWER
+def resultsPath(dataDir):
+    """Where a run's QD table goes: <run>/<run>_QD/<run>_QD.csv"""
+    name = os.path.basename(os.path.normpath(dataDir))
+    return os.path.join(dataDir, "{}_QD".format(name),
+                        RESULTS_NAME.format(name))
+
+
+# %%THE KERNEL, ALL SHOTS AT ONCE
+def _rowCumsum(y):
+    # Cumulative sums with a leading zero column, for O(1) window means
+    return np.concatenate([np.zeros((len(y), 1)), np.cumsum(y, axis=1)],
+                          axis=1)
+
+
+def blockRows(y, start, step, maxSamples):
+    """Average blocks of samples so no record of y (shots, samples) is
+    longer than maxSamples, moving each record's first sample time to the
+    middle of its first block. Returns float (y, start, step), start and
+    step as (shots,) arrays."""
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    start = np.broadcast_to(np.asarray(start, dtype=float), len(y))
+    step = np.broadcast_to(np.asarray(step, dtype=float), len(y))
+    block = int(np.ceil(y.shape[1] / maxSamples)) if maxSamples else 1
+    if block > 1:
+        n = y.shape[1] // block * block
+        y = y[:, :n].reshape(len(y), -1, block).mean(axis=2)
+        start = start + 0.5 * (block - 1) * step
+        step = step * block
+    return y, start, step
+
+
+def clippedRows(y, nSamples=CLIP_SAMPLES):
+    """True for the records of y (shots, samples) that sit at their own
+    extreme for more than nSamples samples, i.e. ran into the digitizer
+    range."""
+    y = np.asarray(y)
+    top = np.count_nonzero(y == y.max(axis=1, keepdims=True), axis=1)
+    bottom = np.count_nonzero(y == y.min(axis=1, keepdims=True), axis=1)
+    return np.maximum(top, bottom) > nSamples
+
+
+def analyzeQD(y, start, step, length=QD_GEOMETRY["length"],
+              chargePerVolt=QD_GEOMETRY["capacitance"], window=EDGE_WINDOW,
+              nSigma=DETECT_SIGMA, maxSamples=MAX_SAMPLES):
+    """Find the tube entry and exit of every record and derive the transit
+    time, velocity and charge, with whole-array operations only.
+
+        Args:
+           y (np.ndarray): (shots, samples) QD amplitudes (V).
+
+           start (np.ndarray): (shots,) time of the first sample of each
+           record (s).
+
+           step (np.ndarray): (shots,) sample interval of each record (s).
+
+        Kwargs:
+           length (float): The pickup tube length (m).
+
+           chargePerVolt (float): Charge per plateau volt (C/V).
+
+           window (float): The matched filter half width (s), about the
+           shortest plateau expected.
+
+           nSigma (float): Edge responses, in noise levels, needed for a
+           detection.
+
+           maxSamples (int): Longer records are block averaged down to this
+           many samples first.
+
+        Returns:
+           qd (dict): (shots,) arrays entry, exit and transit (s), velocity
+           (km/s), plateau (V), charge (C), baseline and noise (V), snr and
+           detected. Shots that are not detected hold NaN.
+
+        Raises:
+           None
+           """
+    y, start, step = blockRows(y, start, step, maxSamples)
+    shots, n = y.shape
+    rows = np.arange(shots)
+
+    # Robust level and noise: the median, and the MAD of the differences
+    baseline = np.median(y, axis=1)
+    z = y - baseline[:, None]
+    diff = np.diff(y, axis=1)
+    noise = 1.4826 * np.median(
+        np.abs(diff - np.median(diff, axis=1, keepdims=True)),
+        axis=1) / np.sqrt(2.0)
+
+    # Step matched filter, edge[:, i] between samples i - 1 and i
+    m = int(np.clip(np.round(window / np.median(step)), 1, max(n // 4, 1)))
+    total = _rowCumsum(z)
+    i = np.arange(m, n - m + 1)
+    edge = np.full((shots, n), np.nan)
+    edge[:, i] = ((total[:, i + m] - total[:, i])
+                  - (total[:, i] - total[:, i - m])) / m
+
+    # The plateau's polarity is that of the largest smoothed excursion
+    smooth = (total[:, m:] - total[:, :-m]) / m
+    polarity = np.sign(smooth[rows, np.argmax(np.abs(smooth), axis=1)])
+    polarity[polarity == 0] = 1.0
+    response = polarity[:, None] * edge
+    entry = np.argmax(np.nan_to_num(response, nan=-np.inf), axis=1)
+    later = np.where(np.arange(n)[None, :] > entry[:, None],
+                     np.nan_to_num(response, nan=np.inf), np.inf)
+    exit = np.argmin(later, axis=1)
+
+    edgeNoise = noise * np.sqrt(2.0 / m)
+    detected = ((response[rows, entry] > nSigma * edgeNoise)
+                & (-later[rows, exit] > nSigma * edgeNoise)
+                & (exit > entry))
+
+    # Between samples: the vertex of a parabola through each peak
+    def refine(k):
+        k = np.clip(k, 1, n - 2)
+        a, b, c = (np.nan_to_num(response[rows, k + d]) for d in (-1, 0, 1))
+        curve = a - 2.0 * b + c
+        shift = np.where(curve != 0, 0.5 * (a - c) / np.where(
+            curve != 0, curve, 1.0), 0.0)
+        return k + np.clip(shift, -0.5, 0.5) - 0.5
+
+    tEntry = start + refine(entry) * step
+    tExit = start + refine(exit) * step
+
+    # Plateau: the mean between the edges, a filter half width inside them
+    lo = np.minimum(entry + m // 2, exit)
+    hi = np.maximum(exit - m // 2, lo + 1)
+    hi = np.minimum(hi, n)
+    plateau = (total[rows, hi] - total[rows, lo]) / (hi - lo)
+
+    # A real crossing steps up and back down by the plateau height; edges
+    # of slow baseline wander or ringing do not
+    edgeHeight = np.minimum(response[rows, entry], -later[rows, exit])
+    detected &= polarity * plateau > STEP_AGREEMENT * edgeHeight
+    # ... and stays inside longer than the filter, clear of the noise
+    detected &= (exit - entry > m) & (np.abs(plateau) > MIN_SNR * noise)
+
+    transit = tExit - tEntry
+    with np.errstate(divide="ignore", invalid="ignore"):
+        velocity = np.where(detected & (transit > 0),
+                            length / transit / 1000.0, np.nan)
+        snr = np.abs(plateau) / noise
+    miss = np.where(detected, 1.0, np.nan)
+    return {"entry": tEntry * miss,
+            "exit": tExit * miss,
+            "transit": transit * miss,
+            "velocity": velocity,
+            "plateau": plateau * miss,
+            "charge": plateau * chargePerVolt * miss,
+            "baseline": baseline,
+            "noise": noise,
+            "snr": snr * miss,
+            "detected": detected}
+
+
+# %%CHANNELS OF A RUN
+def qdChannels(names):
+    """The channel columns whose settings.txt name mentions QD (the Low and
+    High gain channels)."""
+    return [i for i, name in enumerate(names or []) if "qd" in name.lower()]
+
+
+def _chunk(run, shotIdxs, channel):
+    # (shots, samples) amplitudes of one channel, trimmed to the shortest
+    # record, with each record's first sample time and interval
+    times, amps = [], []
+    for shotIdx in shotIdxs:
+        t, a = run.shot(shotIdx)
+        times.append(np.asarray(t[channel], dtype=float))
+        amps.append(np.asarray(a[channel]))
+    n = min(len(a) for a in amps)
+    start = np.array([t[0] if len(t) else np.nan for t in times])
+    step = np.array([(t[n - 1] - t[0]) / max(n - 1, 1) if n else np.nan
+                     for t in times])
+    return np.stack([a[:n] for a in amps]), start, step
+
+
+# %%A WHOLE RUN
+def analyzeRun(dataDir, channels=None, pattern=DEFAULT_PATTERN,
+               geometry=QD_GEOMETRY, window=EDGE_WINDOW,
+               chunkShots=CHUNK_SHOTS, verbose=False):
+    """Run :func:`analyzeQD` over every shot of a run, CHUNK_SHOTS shots at
+    a time, and keep for each shot the QD channel with the best
+    signal-to-noise ratio among those that detected the particle without
+    clipping.
+
+        Args:
+           dataDir (str): The run folder (or its consolidated store).
+
+        Kwargs:
+           channels (list): The QD channel columns, by default those named
+           QD in settings.txt (:func:`qdChannels`).
+
+           pattern (str): The trace file name pattern.
+
+           geometry (dict): The tube length and charge per volt, see
+           jointFit.QD_GEOMETRY.
+
+           window (float): See :func:`analyzeQD`.
+
+           chunkShots (int): Shots decoded and analysed together.
+
+           verbose (bool): Print every chunk.
+
+        Returns:
+           df (pd.DataFrame): One row per shot: Trace Number, QD Channel,
+           Entry (s), Exit (s), Transit (s), Velocity (km/s), Plateau (V),
+           Charge (C), SNR, Clipped and Detected.
+
+        Raises:
+           ValueError: The run has no QD channel.
+           """
+    if channels is None:
+        channels = qdChannels(readChannelNames(dataDir))
+
+    # The shots are planned from the run they are decoded from
+    run = openRun(dataDir, pattern=pattern, cacheBytes=0)
+    parts = []
+    try:
+        channels = [c for c in channels if 0 <= c < run.nChannels]
+        if not channels:
+            raise ValueError("{}: no QD channel in settings.txt".format(
+                dataDir))
+        for first in range(0, run.nShots, chunkShots):
+            shotIdxs = range(first, min(first + chunkShots, run.nShots))
+            best = None
+            for channel in channels:
+                y, start, step = _chunk(run, shotIdxs, channel)
+                qd = analyzeQD(y, start, step, length=geometry["length"],
+                               chargePerVolt=geometry["capacitance"],
+                               window=window)
+                qd["clipped"] = clippedRows(y)
+                qd["channel"] = np.full(len(y), channel)
+                score = np.where(qd["detected"] & ~qd["clipped"],
+                                 qd["snr"], -np.inf)
+                if best is None:
+                    best, bestScore = qd, score
+                    continue
+                better = score > bestScore
+                for key in best:
+                    best[key] = np.where(better, qd[key], best[key])
+                bestScore = np.maximum(score, bestScore)
+            best["shot"] = np.asarray(shotIdxs)
+            parts.append(best)
+            if verbose:
+                print("Shots {}-{}: {} detected".format(
+                    first + 1, shotIdxs[-1] + 1, best["detected"].sum()))
+    finally:
+        if isinstance(run, RunStore):
+            run.close()
+
+    columns = {key: np.concatenate([part[key] for part in parts])
+               for key in parts[0]} if parts else {}
+    return pd.DataFrame({
+        "Trace Number": columns.get("shot", np.empty(0, int)) + 1,
+        "QD Channel": columns.get("channel", np.empty(0, int)),
+        "Entry (s)": columns.get("entry", np.empty(0)),
+        "Exit (s)": columns.get("exit", np.empty(0)),
+        "Transit (s)": columns.get("transit", np.empty(0)),
+        "Velocity (km/s)": columns.get("velocity", np.empty(0)),
+        "Plateau (V)": columns.get("plateau", np.empty(0)),
+        "Charge (C)": columns.get("charge", np.empty(0)),
+        "SNR": columns.get("snr", np.empty(0)),
+        "Clipped": columns.get("clipped", np.empty(0, bool)),
+        "Detected": columns.get("detected", np.empty(0, bool))})
+
+
+# %%CROSS-CHECK AGAINST THE ACCELERATOR
+def _triggerTimes(dataDir, pattern, catalogFile):
+    # (shot indices, epoch ms) of the shots with a trigger time: from a
+    # shared catalog, updated for this run when one is given; else from the
+    # run's own catalog, read only, if it has every shot; else from the
+    # trace headers. Nothing is written into the run folder
+    from triggerCatalog import TriggerCatalog, catalogPath
+    shots = np.asarray(indexRun(dataDir, pattern=pattern).shots)
+    if catalogFile or os.path.exists(catalogPath(dataDir)):
+        if catalogFile:
+            catalog = TriggerCatalog(catalogFile)
+        else:
+            catalog = TriggerCatalog(catalogPath(dataDir), readOnly=True)
+        try:
+            if catalogFile:
+                catalog.addRun(dataDir, pattern=pattern)
+            numbers, triggerMs = catalog.shotTimes(dataDir)
+        finally:
+            catalog.close()
+        if catalogFile or np.array_equal(numbers, shots):
+            known = np.isin(numbers, shots)
+            return np.searchsorted(shots, numbers[known]), triggerMs[known]
+
+    run = openRun(dataDir, pattern=pattern, cacheBytes=0)
+    try:
+        shotIdxs = np.array([k for k, row in enumerate(run.metas)
+                             if any(meta is not None for meta in row)],
+                            dtype=int)
+        triggerMs = np.asarray(triggerTimes(run.metas), dtype=np.int64)
+    finally:
+        if isinstance(run, RunStore):
+            run.close()
+    return shotIdxs, triggerMs
+
+
+def crossCheck(df, dataDir, db=None, pattern=DEFAULT_PATTERN,
+               catalogFile=None):
+    """Add the accelerator's velocity and charge of every matched shot, and
+    the ratio of the QD values to them. By default the events come from
+    the local dust_event mirror when there is one (see dustMirror), so no
+    network connection is needed. The events are matched by trigger time
+    and joined to the rows of df by shot, so df may hold any subset of the
+    shots.
+
+        Args:
+           df (pd.DataFrame): The :func:`analyzeRun` table.
+
+           dataDir (str): The run folder.
+
+        Kwargs:
+           db (str or Engine): See dustEvents.queryDustEvents.
+
+           pattern (str): The trace file name pattern.
+
+           catalogFile (str): A shared trigger-time catalog, updated with
+           this run. By default the run's own catalog is only read, if it
+           is current, and the trigger times otherwise come from the trace
+           headers.
+
+        Returns:
+           df (pd.DataFrame): df with SQL Velocity (km/s), SQL Charge (C),
+           Velocity Ratio and Charge Ratio added, NaN for shots that were
+           not matched.
+
+        Raises:
+           None
+           """
+    from dustEvents import matchDustEvents
+    shotIdxs, triggerMs = _triggerTimes(dataDir, pattern, catalogFile)
+    sql = matchDustEvents(triggerMs.tolist(), db=db)
+    sql.index = shotIdxs
+
+    df = df.copy()
+    rows = df["Trace Number"].to_numpy() - 1
+    df["SQL Velocity (km/s)"] = sql["Velocity (km/s)"].reindex(
+        rows).to_numpy()
+    df["SQL Charge (C)"] = sql["Charge (C)"].reindex(rows).to_numpy()
+    df["Velocity Ratio"] = df["Velocity (km/s)"] / df["SQL Velocity (km/s)"]
+    df["Charge Ratio"] = df["Charge (C)"] / df["SQL Charge (C)"]
+    return df
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Velocity and charge of every shot of a run from its QD "
+        "channels.")
+    parser.add_argument("dataDir", help="run folder containing .trc files")
+    parser.add_argument("-o", "--output", default=None,
+                        help="CSV file (default <run>/<run>_QD/<run>_QD.csv)")
+    parser.add_argument("--channels", type=int, nargs="+", default=None,
+                        help="QD channel columns (default: from settings.txt)")
+    parser.add_argument("--length", type=float,
+                        default=QD_GEOMETRY["length"],
+                        help="pickup tube length in m")
+    parser.add_argument("--capacitance", type=float,
+                        default=QD_GEOMETRY["capacitance"],
+                        help="charge per plateau volt in C/V")
+    parser.add_argument("--window", type=float, default=EDGE_WINDOW,
+                        help="matched filter half width in s")
+    parser.add_argument("--sql", action="store_true",
+                        help="cross-check against the accelerator database "
+                        "(the local mirror if there is one)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="trace file name regular expression")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    geometry = dict(QD_GEOMETRY, length=args.length,
+                    capacitance=args.capacitance)
+    df = analyzeRun(args.dataDir, args.channels, pattern=args.pattern,
+                    geometry=geometry, window=args.window,
+                    verbose=args.verbose)
+    if args.sql:
+        df = crossCheck(df, args.dataDir, pattern=args.pattern)
+    output = args.output or resultsPath(args.dataDir)
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    df.to_csv(output, index=False)
+    print("{} of {} shots detected, median {:.3f} km/s, wrote {}".format(
+        int(df["Detected"].sum()), len(df),
+        df["Velocity (km/s)"].median(), output))
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
@@ -74,108 +74,7 @@ class Trc:
             M. Betz 09/2015
         """
         with open(fName, "rb") as f:
-            # Binary file handle
-            self._f = f
-            self._endi = ""
-            temp = f.read(64)
-            # offset to start of WAVEDESC block
-            self._offs = temp.find(b'WAVEDESC')
-
-            # -------------------------------
-            #  Read WAVEDESC block
-            # -------------------------------
-            # Template name
-            self._TEMPLATE_NAME = self._readS("16s", 16)
-            if self._TEMPLATE_NAME != "LECROY_2_3":
-                print(
-                    "Warning, unsupported file template:",
-                    self._TEMPLATE_NAME,
-                    "... trying anyway"
-                )
-            # 16 or 8 bit sample format?
-            if self._readX('H', 32):
-                self._smplFmt = "int16"
-            else:
-                self._smplFmt = "int8"
-            # Endian-ness ("<" or ">")
-            if self._readX('H', 34):
-                self._endi = "<"
-            else:
-                self._endi = ">"
-            #  Get length of blocks and arrays
-            self._lWAVE_DESCRIPTOR = self._readX("l", 36)
-            self._lUSER_TEXT = self._readX("l", 40)
-            self._lTRIGTIME_ARRAY = self._readX("l", 48)
-            self._lRIS_TIME_ARRAY = self._readX("l", 52)
-            self._lWAVE_ARRAY_1 = self._readX("l", 60)
-            self._lWAVE_ARRAY_2 = self._readX("l", 64)
-
-            d = dict()  # Will store all the extracted Metadata
-
-            # ------------------------
-            #  Get Instrument info
-            # ------------------------
-            d["INSTRUMENT_NAME"] = self._readS("16s", 76)
-            d["INSTRUMENT_NUMBER"] = self._readX("l", 92)
-            d["TRACE_LABEL"] = self._readS("16s", 96)
-
-            # ------------------------
-            #  Get Waveform info
-            # ------------------------
-            d["WAVE_ARRAY_COUNT"] = self._readX("l", 116)
-            d["PNTS_PER_SCREEN"] = self._readX("l", 120)
-            d["FIRST_VALID_PNT"] = self._readX("l", 124)
-            d["LAST_VALID_PNT"] = self._readX("l", 128)
-            d["FIRST_POINT"] = self._readX("l", 132)
-            d["SPARSING_FACTOR"] = self._readX("l", 136)
-            d["SEGMENT_INDEX"] = self._readX("l", 140)
-            d["SUBARRAY_COUNT"] = self._readX("l", 144)
-            d["SWEEPS_PER_ACQ"] = self._readX("l", 148)
-            d["POINTS_PER_PAIR"] = self._readX("h", 152)
-            d["PAIR_OFFSET"] = self._readX("h", 154)
-            d["VERTICAL_GAIN"] = self._readX("f", 156)
-            d["VERTICAL_OFFSET"] = self._readX("f", 160)
-            # to get floating values from raw data:
-            # VERTICAL_GAIN * data - VERTICAL_OFFSET
-            d["MAX_VALUE"] = self._readX("f", 164)
-            d["MIN_VALUE"] = self._readX("f", 168)
-            d["NOMINAL_BITS"] = self._readX("h", 172)
-            d["NOM_SUBARRAY_COUNT"] = self._readX("h", 174)
-            # sampling interval for time domain waveforms
-            d["HORIZ_INTERVAL"] = self._readX("f", 176)
-            # trigger offset for the first sweep of the trigger,
-            # seconds between the trigger and the first data point
-            d["HORIZ_OFFSET"] = self._readX("d", 180)
-            d["PIXEL_OFFSET"] = self._readX("d", 188)
-            d["VERTUNIT"] = self._readS("48s", 196)
-            d["HORUNIT"] = self._readS("48s", 244)
-            d["HORIZ_UNCERTAINTY"] = self._readX("f", 292)
-            d["TRIGGER_TIME"] = self._getTimeStamp(296)
-            d["ACQ_DURATION"] = self._readX("f", 312)
-            d["RECORD_TYPE"] = Trc._recTypes[
-                self._readX("H", 316)
-            ]
-            d["PROCESSING_DONE"] = Trc._processings[
-                self._readX("H", 318)
-            ]
-            d["RIS_SWEEPS"] = self._readX("h", 322)
-            d["TIMEBASE"] = Trc._timebases[self._readX("H", 324)]
-            d["VERT_COUPLING"] = Trc._vCouplings[
-                self._readX("H", 326)
-            ]
-            d["PROBE_ATT"] = self._readX("f", 328)
-            d["FIXED_VERT_GAIN"] = Trc._vGains[
-                self._readX("H", 332)
-            ]
-            d["BANDWIDTH_LIMIT"] = bool(self._readX("H", 334))
-            d["VERTICAL_VERNIER"] = self._readX("f", 336)
-            d["ACQ_VERT_OFFSET"] = self._readX("f", 340)
-            d["WAVE_SOURCE"] = self._readX("H", 344)
-            d["USER_TEXT"] = self._readS(
-                "{0}s".format(self._lUSER_TEXT),
-                self._lWAVE_DESCRIPTOR
-            )
-
+            d = self._readWaveDesc(f)
             y = self._readSamples()
             y = d["VERTICAL_GAIN"] * y - d["VERTICAL_OFFSET"]
             x = np.arange(1, len(y) + 1, dtype=float)
@@ -187,6 +86,152 @@ class Trc:
         self.d = d
         return x, y, d
 
+    def readRaw(self, fName):
+        """
+            Read the WAVEDESC block and the undecoded integer samples of a
+            .trc file. Voltages are VERTICAL_GAIN * raw - VERTICAL_OFFSET.
+
+            Parameters
+            -----------
+            fName = filename of the .trc file
+
+            Returns
+            -----------
+            a tuple (raw, d)
+
+            raw: int8 or int16 array with the stored sample codes,
+
+            d: dictionary with metadata, as returned by open()
+        """
+        with open(fName, "rb") as f:
+            d = self._readWaveDesc(f)
+            raw = self._readSamples()
+        self._f = None
+        return raw, d
+
+    def readHeader(self, fName):
+        """
+            Read only the WAVEDESC block of a .trc file. The sample array is
+            not touched, so this is cheap enough to call on every file of a
+            run when it is opened.
+
+            Parameters
+            -----------
+            fName = filename of the .trc file
+
+            Returns
+            -----------
+            d: dictionary with metadata, as returned by open()
+        """
+        with open(fName, "rb") as f:
+            d = self._readWaveDesc(f)
+        self._f = None
+        return d
+
+    def _readWaveDesc(self, f):
+        """ read the WAVEDESC block of the open binary file f into a dict """
+        self._f = f
+        self._endi = ""
+        temp = f.read(64)
+        # offset to start of WAVEDESC block
+        self._offs = temp.find(b'WAVEDESC')
+
+        # -------------------------------
+        #  Read WAVEDESC block
+        # -------------------------------
+        # Template name
+        self._TEMPLATE_NAME = self._readS("16s", 16)
+        if self._TEMPLATE_NAME != "LECROY_2_3":
+            print(
+                "Warning, unsupported file template:",
+                self._TEMPLATE_NAME,
+                "... trying anyway"
+            )
+        # 16 or 8 bit sample format?
+        if self._readX('H', 32):
+            self._smplFmt = "int16"
+        else:
+            self._smplFmt = "int8"
+        # Endian-ness ("<" or ">")
+        if self._readX('H', 34):
+            self._endi = "<"
+        else:
+            self._endi = ">"
+        #  Get length of blocks and arrays
+        self._lWAVE_DESCRIPTOR = self._readX("l", 36)
+        self._lUSER_TEXT = self._readX("l", 40)
+        self._lTRIGTIME_ARRAY = self._readX("l", 48)
+        self._lRIS_TIME_ARRAY = self._readX("l", 52)
+        self._lWAVE_ARRAY_1 = self._readX("l", 60)
+        self._lWAVE_ARRAY_2 = self._readX("l", 64)
+
+        d = dict()  # Will store all the extracted Metadata
+
+        # ------------------------
+        #  Get Instrument info
+        # ------------------------
+        d["INSTRUMENT_NAME"] = self._readS("16s", 76)
+        d["INSTRUMENT_NUMBER"] = self._readX("l", 92)
+        d["TRACE_LABEL"] = self._readS("16s", 96)
+
+        # ------------------------
+        #  Get Waveform info
+        # ------------------------
+        d["WAVE_ARRAY_COUNT"] = self._readX("l", 116)
+        d["PNTS_PER_SCREEN"] = self._readX("l", 120)
+        d["FIRST_VALID_PNT"] = self._readX("l", 124)
+        d["LAST_VALID_PNT"] = self._readX("l", 128)
+        d["FIRST_POINT"] = self._readX("l", 132)
+        d["SPARSING_FACTOR"] = self._readX("l", 136)
+        d["SEGMENT_INDEX"] = self._readX("l", 140)
+        d["SUBARRAY_COUNT"] = self._readX("l", 144)
+        d["SWEEPS_PER_ACQ"] = self._readX("l", 148)
+        d["POINTS_PER_PAIR"] = self._readX("h", 152)
+        d["PAIR_OFFSET"] = self._readX("h", 154)
+        d["VERTICAL_GAIN"] = self._readX("f", 156)
+        d["VERTICAL_OFFSET"] = self._readX("f", 160)
+        # to get floating values from raw data:
+        # VERTICAL_GAIN * data - VERTICAL_OFFSET
+        d["MAX_VALUE"] = self._readX("f", 164)
+        d["MIN_VALUE"] = self._readX("f", 168)
+        d["NOMINAL_BITS"] = self._readX("h", 172)
+        d["NOM_SUBARRAY_COUNT"] = self._readX("h", 174)
+        # sampling interval for time domain waveforms
+        d["HORIZ_INTERVAL"] = self._readX("f", 176)
+        # trigger offset for the first sweep of the trigger,
+        # seconds between the trigger and the first data point
+        d["HORIZ_OFFSET"] = self._readX("d", 180)
+        d["PIXEL_OFFSET"] = self._readX("d", 188)
+        d["VERTUNIT"] = self._readS("48s", 196)
+        d["HORUNIT"] = self._readS("48s", 244)
+        d["HORIZ_UNCERTAINTY"] = self._readX("f", 292)
+        d["TRIGGER_TIME"] = self._getTimeStamp(296)
+        d["ACQ_DURATION"] = self._readX("f", 312)
+        d["RECORD_TYPE"] = Trc._recTypes[
+            self._readX("H", 316)
+        ]
+        d["PROCESSING_DONE"] = Trc._processings[
+            self._readX("H", 318)
+        ]
+        d["RIS_SWEEPS"] = self._readX("h", 322)
+        d["TIMEBASE"] = Trc._timebases[self._readX("H", 324)]
+        d["VERT_COUPLING"] = Trc._vCouplings[
+            self._readX("H", 326)
+        ]
+        d["PROBE_ATT"] = self._readX("f", 328)
+        d["FIXED_VERT_GAIN"] = Trc._vGains[
+            self._readX("H", 332)
+        ]
+        d["BANDWIDTH_LIMIT"] = bool(self._readX("H", 334))
+        d["VERTICAL_VERNIER"] = self._readX("f", 336)
+        d["ACQ_VERT_OFFSET"] = self._readX("f", 340)
+        d["WAVE_SOURCE"] = self._readX("H", 344)
+        d["USER_TEXT"] = self._readS(
+            "{0}s".format(self._lUSER_TEXT),
+            self._lWAVE_DESCRIPTOR
+        )
+        return d
+
     def _readX(self, fmt, adr=None):
         """ extract a byte / word / float / double from the binary file f """
         fmt = self._endi + fmt
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel, incremental binary export of the shots of a run.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+import numpy as np
+
+from runStore import runSource, sharedRun
+from trcIndex import DEFAULT_PATTERN, indexRun, readChannelNames
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None  # Parquet export needs pyarrow, HDF5 export does not
+
+# %%DEFAULTS
+FORMATS = {"hdf5": ".h5", "parquet": ".parquet"}
+DEFAULT_FORMAT = "hdf5"
+MANIFEST_NAME = "export-manifest.json"
+SAVE_INTERVAL = 2.0  # Seconds between manifest writes
+WORKER_CACHE_BYTES = 0  # Each shot is exported once, nothing to cache
+
+
+# %%NAMES
+def exportFolder(dataDir):
+    """The default export folder, the one the quicklook viewer has always
+    written to."""
+    name = os.path.basename(os.path.normpath(dataDir))
+    return os.path.join(dataDir, "SPY_OUT_{}".format(name))
+
+
+def channelNamesFor(dataDir, index):
+    """The settings.txt channel names of a run, one per scope channel: cut
+    to the channels of the run, padded with "Channel <n>" for any channel
+    that has no name."""
+    channelNames = (readChannelNames(dataDir) or [])[:index.nChannels]
+    return channelNames + ["Channel {}".format(chan)
+                           for chan in index.channels[len(channelNames):]]
+
+
+# %%WRITE ONE SHOT
+def writeShot(path, times, amps, channelNames, fmt=DEFAULT_FORMAT):
+    """Write the channels of one shot to a single binary file. Channels are
+    padded with NaN to the longest one, so a missing channel is a column of
+    NaN rather than a shifted column.
+
+        Args:
+           path (str): The output file.
+
+           times (list): The time array of every channel.
+
+           amps (list): The amplitude array of every channel.
+
+           channelNames (list): One name per channel.
+
+        Kwargs:
+           fmt (str): "hdf5" (datasets time, amplitude[channel, sample] and a
+           channel_names attribute) or "parquet" (a Time (s) column and one
+           "<name> Amplitude (V)" column per channel).
+
+        Returns:
+           None
+
+        Raises:
+           ValueError: fmt is unknown, or is "parquet" without pyarrow.
+           """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format: {}".format(fmt))
+    if fmt == "parquet" and pa is None:
+        raise ValueError("Parquet export needs pyarrow")
+
+    nSamples = max((len(amp) for amp in amps), default=0)
+    timeCol = np.full(nSamples, np.nan)
+    first = next((t for t in times if len(t)), np.empty(0))
+    timeCol[:len(first)] = first
+    table = np.full((len(amps), nSamples), np.nan)
+    for chan, amp in enumerate(amps):
+        table[chan, :len(amp)] = amp
+
+    # Written beside the target and renamed, so an interrupted export never
+    # leaves a truncated file that looks finished
+    tmpPath = path + ".tmp"
+    if fmt == "hdf5":
+        with h5py.File(tmpPath, "w") as f:
+            f.create_dataset("time", data=timeCol)
+            f.create_dataset("amplitude", data=table,
+                             chunks=(1, max(nSamples, 1)))
+            f.attrs["channel_names"] = [str(name) for name in channelNames]
+            f.attrs["time_units"] = "s"
+            f.attrs["amplitude_units"] = "V"
+    else:
+        columns = {"Time (s)": timeCol}
+        for name, row in zip(channelNames, table):
+            columns["{} Amplitude (V)".format(name)] = row
+        pq.write_table(pa.table(columns), tmpPath)
+    os.replace(tmpPath, path)
+
+
+def exportShot(source, pattern, shotIdx, path, channelNames,
+               fmt=DEFAULT_FORMAT):
+    """Decode shotIdx of a run and write it with :func:`writeShot`. Runs in
+    the pool processes, which each open a run once. source is the store
+    file or folder :func:`planExport` planned from."""
+    run = sharedRun(source, pattern=pattern, cacheBytes=WORKER_CACHE_BYTES)
+    times, amps = run.shot(shotIdx)
+    writeShot(path, times, amps, channelNames, fmt=fmt)
+
+
+# %%WHAT HAS BEEN EXPORTED
+class ExportManifest:
+
+    def __init__(self, outDir):
+        """A record of the shots in an export folder and the trace files
+        (size and modification time) each one was written from. A shot is
+        only exported again if its trace files changed.
+
+        Args:
+           outDir (str): The export folder.
+
+        Kwargs:
+           None
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.path = os.path.join(outDir, MANIFEST_NAME)
+        self.format = None
+        self.channels = None
+        self.shots = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as manifestFile:
+                saved = json.load(manifestFile)
+            self.format = saved.get("format")
+            self.channels = saved.get("channels")
+            self.shots = saved.get("shots", {})
+        self._saved = time.monotonic()
+
+    def reset(self, fmt, channelNames):
+        self.format = fmt
+        self.channels = list(channelNames)
+        self.shots = {}
+
+    def isCurrent(self, shot, sources):
+        entry = self.shots.get(str(shot))
+        if entry is None or entry["sources"] != sources:
+            return False
+        return os.path.exists(os.path.join(os.path.dirname(self.path),
+                                           entry["file"]))
+
+    def record(self, shot, fileName, sources):
+        self.shots[str(shot)] = {"file": fileName, "sources": sources}
+        if time.monotonic() - self._saved > SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as manifestFile:
+            json.dump({"format": self.format, "channels": self.channels,
+                       "shots": self.shots}, manifestFile, indent=1)
+        os.replace(tmpPath, self.path)
+        self._saved = time.monotonic()
+
+
+def _sources(index, shotIdx):
+    # [file name, size, mtime in ns] of each trace file of a shot
+    sources = []
+    for path in index.paths[shotIdx]:
+        if path is not None:
+            stat = os.stat(path)
+            sources.append([os.path.basename(path), stat.st_size,
+                            stat.st_mtime_ns])
+    return sources
+
+
+# %%PLAN AND RUN AN EXPORT
+def planExport(dataDir, outDir=None, fmt=DEFAULT_FORMAT,
+               pattern=DEFAULT_PATTERN, incremental=True):
+    """Work out which shots of a run need to be written.
+
+        Args:
+           dataDir (str): The run folder.
+
+        Kwargs:
+           outDir (str): The export folder, :func:`exportFolder` by default.
+           It is created if needed; existing files are never deleted.
+
+           fmt (str): One of :data:`FORMATS`.
+
+           pattern (str): The trace file name pattern.
+
+           incremental (bool): Skip shots whose export is up to date. A
+           change of format or channel names always exports everything.
+
+        Returns:
+           manifest (ExportManifest): The export folder's manifest.
+
+           source (str): What the shots are decoded from, the run's store
+           file or the folder itself (see :func:`runStore.runSource`);
+           hand it to :func:`exportShot`.
+
+           channelNames (list): The names written with every shot.
+
+           jobs (list): (shotIdx, shot number, output path, sources) of every
+           shot to write; hand each to :func:`exportShot` and then
+           :meth:`ExportManifest.record`.
+
+        Raises:
+           ValueError: fmt is unknown.
+           """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format: {}".format(fmt))
+    outDir = outDir or exportFolder(dataDir)
+    os.makedirs(outDir, exist_ok=True)
+    index = indexRun(dataDir, pattern=pattern)
+    source = os.path.abspath(runSource(dataDir, pattern=pattern,
+                                       index=index))
+    channelNames = channelNamesFor(dataDir, index)
+
+    manifest = ExportManifest(outDir)
+    if (not incremental or manifest.format != fmt
+            or manifest.channels != channelNames):
+        manifest.reset(fmt, channelNames)
+
+    jobs = []
+    for shotIdx, shot in enumerate(index.shots):
+        sources = _sources(index, shotIdx)
+        if manifest.isCurrent(shot, sources):
+            continue
+        path = os.path.join(outDir, "{:05d}{}".format(shot, FORMATS[fmt]))
+        jobs.append((shotIdx, shot, path, sources))
+    return manifest, source, channelNames, jobs
+
+
+def exportRun(dataDir, outDir=None, fmt=DEFAULT_FORMAT, incremental=True,
+              workers=None, pattern=DEFAULT_PATTERN, verbose=False):
+    """Export every shot of a run, one binary file per shot, written in
+    parallel by a process pool.
+
+        Args:
+           dataDir (str): The run folder.
+
+        Kwargs:
+           outDir (str): The export folder, :func:`exportFolder` by default.
+
+           fmt (str): One of :data:`FORMATS`.
+
+           incremental (bool): Only write shots that are new or changed
+           since the last export.
+
+           workers (int): Pool size, defaults to the number of cores.
+
+           pattern (str): The trace file name pattern.
+
+           verbose (bool): Print every file written.
+
+        Returns:
+           written (int): The number of shots written.
+
+        Raises:
+           ValueError: fmt is unknown, or is "parquet" without pyarrow.
+           """
+    if fmt == "parquet" and pa is None:
+        raise ValueError("Parquet export needs pyarrow")
+    manifest, source, channelNames, jobs = planExport(
+        dataDir, outDir, fmt=fmt, pattern=pattern, incremental=incremental)
+    if not jobs:
+        manifest.save()
+        return 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(exportShot, source, pattern, shotIdx, path,
+                               channelNames, fmt): (shot, path, sources)
+                   for shotIdx, shot, path, sources in jobs}
+        for future in as_completed(futures):
+            shot, path, sources = futures[future]
+            future.result()
+            manifest.record(shot, os.path.basename(path), sources)
+            if verbose:
+                print("Wrote {}".format(path))
+    manifest.save()
+    return len(jobs)
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export the shots of a run folder to HDF5 or Parquet.")
+    parser.add_argument("dataDir", help="run folder containing .trc files")
+    parser.add_argument("-o", "--output", default=None,
+                        help="export folder (default <run>/SPY_OUT_<run>)")
+    parser.add_argument("-f", "--format", choices=sorted(FORMATS),
+                        default=DEFAULT_FORMAT)
+    parser.add_argument("--full", action="store_true",
+                        help="rewrite every shot, not only new ones")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="trace file name regular expression")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    written = exportRun(args.dataDir, args.output, fmt=args.format,
+                        incremental=not args.full, workers=args.jobs,
+                        pattern=args.pattern, verbose=args.verbose)
+    print("Exported {} shot(s)".format(written))
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel ion grid fitting of every shot of a run, into a
+:class:`fitStore.FitStore`, and the optional plots drawn from it.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+
+import numpy as np
+
+from fitStore import ION_GRID_MODEL, STATUS_OK, FitStore, fitRecord, \
+    storeFile
+from runStore import sharedRun
+from trcIndex import DEFAULT_PATTERN, indexRun
+
+# %%DEFAULTS
+ION_GRID_CHANNEL = 5  # Column of the ion grid in the IDEX channel layout
+WORKER_CACHE_BYTES = 0  # Each shot is fitted once, nothing to cache
+WARM_CHUNK = 8  # Consecutive shots one worker fits when warm starting
+
+
+# %%NAMES
+def fitFolder(dataDir):
+    """The folder the quicklook viewer has always written ion fits to."""
+    name = os.path.basename(os.path.normpath(dataDir))
+    return os.path.join(dataDir, "{}_IonGridFits".format(name))
+
+
+# %%WORK DONE IN THE POOL PROCESSES
+def _ionGrid(dataDir, pattern, shotIdx, ionChannel):
+    # The time base (the first channel that has one) and the ion grid
+    run = sharedRun(dataDir, pattern=pattern, cacheBytes=WORKER_CACHE_BYTES)
+    times, amps = run.shot(shotIdx)
+    time = next((t for t in times if len(t)), times[0])
+    return np.asarray(time, dtype=float), np.asarray(amps[ionChannel],
+                                                     dtype=float)
+
+
+def fitShot(dataDir, pattern, shotIdx, ionChannel=ION_GRID_CHANNEL):
+    """Decode one shot and fit its ion grid. Only NumPy arrays go in and out
+    of the fit; the result row is returned to the parent process.
+
+        Args:
+           dataDir (str): The run folder.
+
+           pattern (str): The trace file name pattern.
+
+           shotIdx (int): The shot to fit.
+
+        Kwargs:
+           ionChannel (int): The channel column of the ion grid.
+
+        Returns:
+           record (dict): The :func:`fitStore.fitRecord` row, failed if the
+           fit did not converge.
+
+        Raises:
+           None
+           """
+    return fitShots(dataDir, pattern, [shotIdx], ionChannel,
+                    warmStart=False)[0]
+
+
+def fitShots(dataDir, pattern, shotIdxs, ionChannel=ION_GRID_CHANNEL,
+             warmStart=True):
+    """Fit consecutive shots in turn, warm starting each fit from the last
+    one that converged (see :func:`SudaIonTarget.fitIonGrid`).
+
+        Args:
+           dataDir (str): The run folder.
+
+           pattern (str): The trace file name pattern.
+
+           shotIdxs (list): The shots to fit, in order.
+
+        Kwargs:
+           ionChannel (int): The channel column of the ion grid.
+
+           warmStart (bool): Start from the previous solution.
+
+        Returns:
+           records (list): A :func:`fitStore.fitRecord` row per shot.
+
+        Raises:
+           None
+           """
+    from SudaIonTarget import fitIonGrid
+    records, previous = [], None
+    for shotIdx in shotIdxs:
+        time, amp = _ionGrid(dataDir, pattern, shotIdx, ionChannel)
+        try:
+            fit = fitIonGrid(time, amp, previous=previous, full_output=True)
+        except (RuntimeError, ValueError) as error:
+            # No convergence, or an empty or non-finite record; only this
+            # shot fails
+            records.append(fitRecord(dataDir, shotIdx, ionChannel,
+                                     ION_GRID_MODEL, message=str(error)))
+            continue
+        records.append(fitRecord(dataDir, shotIdx, ionChannel,
+                                 ION_GRID_MODEL, *fit))
+        if warmStart:
+            previous = fit[0]
+    return records
+
+
+def renderShot(dataDir, pattern, shotIdx, params, folder,
+               ionChannel=ION_GRID_CHANNEL):
+    """Draw a fitted shot to <folder>/IonGrid<n>.png, the plot
+    ImpactEvent.plotIonSignalFit makes (see
+    :func:`SudaIonTarget.drawIonGridFit`).
+
+        Args:
+           dataDir (str): The run folder.
+
+           pattern (str): The trace file name pattern.
+
+           shotIdx (int): The fitted shot.
+
+           params (np.ndarray): Its fit parameters.
+
+           folder (str): Where the PNG is written.
+
+        Kwargs:
+           ionChannel (int): The channel column of the ion grid.
+
+        Returns:
+           path (str): The PNG written.
+
+        Raises:
+           None
+           """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from SudaIonTarget import drawIonGridFit
+    time, amp = _ionGrid(dataDir, pattern, shotIdx, ionChannel)
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    drawIonGridFit(fig, time, amp, params, shotIdx)
+    path = os.path.join(folder, "IonGrid{}.png".format(shotIdx + 1))
+    fig.savefig(path)
+    return path
+
+
+# %%FIT A RUN
+def _streamed(pool, workers, submit):
+    # Yield (key, result, error) as the futures of submit(pool) finish,
+    # cancelling whatever is still queued if the caller stops early
+    ownPool = pool is None
+    if ownPool:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    futures = submit(pool)
+    try:
+        for future in as_completed(futures):
+            error = future.exception()
+            yield (futures[future], None if error else future.result(),
+                   error)
+    finally:
+        for future in futures:
+            future.cancel()
+        if ownPool:
+            pool.shutdown()
+
+
+def fitRun(dataDir, shots=None, ionChannel=ION_GRID_CHANNEL, workers=None,
+           pattern=DEFAULT_PATTERN, pool=None, warmStart=False):
+    """Fit the ion grid of many shots in a process pool, yielding each
+    result row as soon as it is ready (in completion order, not shot
+    order).
+    Every fit starts from :func:`SudaIonTarget.pulseGuess`; with warmStart
+    the shots are handed out in runs of :data:`WARM_CHUNK`, and each shot
+    of a run also starts from the time constants of the one before.
+
+        Args:
+           dataDir (str): The run folder.
+
+        Kwargs:
+           shots (list): The shot indices to fit, every shot by default.
+
+           ionChannel (int): The channel column of the ion grid.
+
+           workers (int): Pool size, defaults to the number of cores.
+
+           pattern (str): The trace file name pattern.
+
+           pool (Executor): A pool to use instead of starting one.
+
+           warmStart (bool): Warm start each fit from the previous shot.
+
+        Returns:
+           records (generator): A :func:`fitStore.fitRecord` row per shot.
+           A shot whose worker raised (e.g. an unreadable trace) gets a
+           failed row with the error as its message.
+
+        Raises:
+           ValueError: The run has no ion grid channel.
+           """
+    dataDir = os.path.abspath(dataDir)
+    index = indexRun(dataDir, pattern=pattern)
+    if ionChannel >= index.nChannels:
+        raise ValueError("{} has {} channels, no ion grid channel {}".format(
+            dataDir, index.nChannels, ionChannel))
+    if shots is None:
+        shots = range(index.nShots)
+    shots = list(shots)
+    if warmStart:
+        chunks = [shots[i:i + WARM_CHUNK] for i in range(0, len(shots),
+                                                          WARM_CHUNK)]
+        submit = lambda pool: {
+            pool.submit(fitShots, dataDir, pattern, chunk, ionChannel):
+            chunk for chunk in chunks}
+    else:
+        submit = lambda pool: {
+            pool.submit(fitShots, dataDir, pattern, [shotIdx], ionChannel,
+                        False): [shotIdx] for shotIdx in shots}
+    return _records(_streamed(pool, workers, submit), dataDir, ionChannel)
+
+
+def _records(results, dataDir, ionChannel):
+    # Flatten the per-chunk lists of rows; a chunk whose worker raised
+    # gets a failed row for each of its shots
+    with closing(results):
+        for chunk, records, error in results:
+            if error is not None:
+                records = [fitRecord(dataDir, shotIdx, ionChannel,
+                                     ION_GRID_MODEL, message=str(error))
+                           for shotIdx in chunk]
+            yield from records
+
+
+# %%DRAW THE FITS, A SEPARATE STEP
+def renderFits(fits, folder, workers=None, pattern=DEFAULT_PATTERN,
+               pool=None):
+    """Draw the PNG of every converged fit of a table in a process pool.
+    Only the table is needed, so the plots can be made any time after the
+    fitting, or never.
+
+        Args:
+           fits (dict): Columns from :meth:`fitStore.FitStore.load`; the
+           waveforms are read again from each row's run folder.
+
+           folder (str): Where the PNGs are written.
+
+        Kwargs:
+           workers (int): Pool size, defaults to the number of cores.
+
+           pattern (str): The trace file name pattern.
+
+           pool (Executor): A pool to use instead of starting one.
+
+        Returns:
+           results (generator): (row, path, error) tuples, row indexing the
+           columns of fits.
+
+        Raises:
+           None
+           """
+    rows = np.flatnonzero(fits["status"] == STATUS_OK)
+    return _streamed(pool, workers, lambda pool: {
+        pool.submit(renderShot, fits["run"][row], pattern,
+                    int(fits["shot"][row]), fits["params"][row], folder,
+                    int(fits["channel"][row])): row
+        for row in rows})
+
+
+# %%FIT A RUN INTO ITS STORE
+def fitIonGrids(dataDir, folder=None, plot=False, ionChannel=ION_GRID_CHANNEL,
+                workers=None, pattern=DEFAULT_PATTERN, warmStart=False,
+                verbose=False):
+    """Fit every shot of a run and append the results to
+    <folder>/fit-results.h5 as they arrive, then optionally draw every fit.
+    One pool serves both steps.
+
+        Args:
+           dataDir (str): The run folder.
+
+        Kwargs:
+           folder (str): The output folder, :func:`fitFolder` by default.
+
+           plot (bool): Also write an IonGrid<n>.png per shot.
+
+           ionChannel (int): The channel column of the ion grid.
+
+           workers (int): Pool size, defaults to the number of cores.
+
+           pattern (str): The trace file name pattern.
+
+           warmStart (bool): See :func:`fitRun`.
+
+           verbose (bool): Print every shot as it finishes.
+
+        Returns:
+           fits (dict): {shotIdx: params} of the shots that converged.
+
+           failed (dict): {shotIdx: message} of the others.
+
+        Raises:
+           ValueError: The run has no ion grid channel.
+           """
+    folder = folder or fitFolder(dataDir)
+    os.makedirs(folder, exist_ok=True)
+    store = FitStore(storeFile(folder))
+    fits, failed = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for record in fitRun(dataDir, ionChannel=ionChannel, pattern=pattern,
+                             pool=pool, warmStart=warmStart):
+            store.append([record])
+            if record["status"] == STATUS_OK:
+                fits[record["shot"]] = record["params"]
+            else:
+                failed[record["shot"]] = record["message"]
+            if verbose:
+                print("Trace {}: {}".format(record["shot"] + 1,
+                                            record["message"] or "fitted"))
+        if plot:
+            renderStore(store, dataDir, folder, ionChannel, pattern=pattern,
+                        pool=pool, verbose=verbose)
+    return fits, failed
+
+
+def renderStore(store, dataDir, folder, ionChannel=ION_GRID_CHANNEL,
+                workers=None, pattern=DEFAULT_PATTERN, pool=None,
+                verbose=False):
+    """:func:`renderFits` for the ion grid fits of one run in a store,
+    printing the plots that could not be drawn."""
+    fits = store.load(run=dataDir, model=ION_GRID_MODEL, channel=ionChannel,
+                      okOnly=True)
+    drawn = 0
+    with closing(renderFits(fits, folder, workers=workers, pattern=pattern,
+                            pool=pool)) as results:
+        for row, path, error in results:
+            if error is not None:
+                print("Trace {}: plot failed: {}".format(
+                    fits["shot"][row] + 1, error))
+                continue
+            drawn += 1
+            if verbose:
+                print("Wrote {}".format(path))
+    return drawn
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fit the ion grid waveform of every shot of a run.")
+    parser.add_argument("dataDir", help="run folder containing .trc files")
+    parser.add_argument("-o", "--output", default=None,
+                        help="output folder (default <run>/<run>_IonGridFits)")
+    parser.add_argument("-p", "--plot", action="store_true",
+                        help="also draw every fit to a PNG")
+    parser.add_argument("--plot-only", action="store_true",
+                        help="only draw the fits already in the store")
+    parser.add_argument("--ion-channel", type=int, default=ION_GRID_CHANNEL,
+                        help="channel column of the ion grid")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="trace file name regular expression")
+    parser.add_argument("-w", "--warm-start", action="store_true",
+                        help="start each fit from the previous shot's")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.plot_only:
+        folder = args.output or fitFolder(args.dataDir)
+        drawn = renderStore(FitStore(storeFile(folder)), args.dataDir, folder,
+                            args.ion_channel, workers=args.jobs,
+                            pattern=args.pattern, verbose=args.verbose)
+        print("Drew {} fit(s)".format(drawn))
+        return 0
+
+    fits, failed = fitIonGrids(args.dataDir, args.output, plot=args.plot,
+                               ionChannel=args.ion_channel,
+                               workers=args.jobs, pattern=args.pattern,
+                               warmStart=args.warm_start,
+                               verbose=args.verbose)
+    print("Fitted {} shot(s), {} failed".format(len(fits), len(failed)))
+    return 1 if failed else 0
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lazy, cached access to the shots of a run directory.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from readTrc import Trc
+from trcIndex import DEFAULT_PATTERN, indexRun
+
+# %%DEFAULTS
+# Enough for a handful of 8 channel, 500k sample shots
+DEFAULT_CACHE_BYTES = 256 * 2**20
+
+
+# %%LEAST RECENTLY USED CACHE BOUNDED BY BYTES
+class ShotCache:
+
+    def __init__(self, maxBytes=DEFAULT_CACHE_BYTES):
+        """A least recently used cache of decoded shots whose size is bounded
+        by the number of bytes held rather than by the number of entries.
+        Safe to use from several threads.
+
+        Args:
+           None
+
+        Kwargs:
+           maxBytes (int): The most bytes to hold. The newest entry is always
+           kept, even if it alone is larger than this.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        """Return the cached value for key, or None, and mark it as used."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        """Store value under key, evicting the least recently used entries
+        until the cache fits in maxBytes again."""
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxBytes and len(self._entries) > 1:
+                _, (_, oldBytes) = self._entries.popitem(last=False)
+                self.nbytes -= oldBytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# %%SEQUENCE VIEW OF ONE QUANTITY OF EVERY SHOT
+class _ShotView:
+
+    def __init__(self, run, field):
+        # field 0 = times, 1 = amplitudes
+        self._run = run
+        self._field = field
+
+    def __len__(self):
+        return len(self._run)
+
+    def __getitem__(self, shotIdx):
+        return self._run.shot(shotIdx)[self._field]
+
+    def __iter__(self):
+        for shotIdx in range(len(self._run)):
+            yield self[shotIdx]
+
+
+# %%RUN MODEL
+class RunModel:
+
+    def __init__(self, dataDir, pattern=DEFAULT_PATTERN,
+                 cacheBytes=DEFAULT_CACHE_BYTES, verbose=False):
+        """A run directory whose trace headers are read when it is opened and
+        whose waveforms are decoded one shot at a time, on first use. Decoded
+        shots are kept in a :class:`ShotCache`.
+
+        The times, amps and metas attributes behave like the lists returned
+        by :func:`IDEX-quicklook.generalReadTRC`, so existing code can index
+        them by shot and channel without loading the whole run.
+
+        Args:
+           dataDir (str): The folder containing the trace files.
+
+        Kwargs:
+           pattern (str): The file name pattern handed to
+           :func:`trcIndex.indexRun`.
+
+           cacheBytes (int): The size limit of the decoded shot cache.
+
+           verbose (bool): Print the table size and every missing channel.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.dataDir = dataDir
+        self.index = indexRun(dataDir, pattern=pattern, verbose=verbose)
+        self.index.report()
+        self.cache = ShotCache(cacheBytes)
+
+        # Header-only reads, no sample data is touched here
+        trc = Trc()
+        self.headers = [[trc.readHeader(path) if path is not None else None
+                         for path in row] for row in self.index.paths]
+
+        self.times = _ShotView(self, 0)
+        self.amps = _ShotView(self, 1)
+        self.metas = self.headers
+
+    def __len__(self):
+        return self.index.nShots
+
+    @property
+    def nShots(self):
+        return self.index.nShots
+
+    @property
+    def nChannels(self):
+        return self.index.nChannels
+
+    def isLoaded(self, shotIdx):
+        """True if shot shotIdx is already decoded and cached."""
+        return shotIdx in self.cache
+
+    def shot(self, shotIdx):
+        """Decode (or fetch from the cache) every channel of one shot.
+
+        Args:
+           shotIdx (int): The row of the shot in the run index.
+
+        Kwargs:
+           None
+
+        Returns:
+           times (list): The time array of each channel.
+
+           amps (list): The amplitude array of each channel. Missing channels
+           are empty arrays in both lists.
+
+        Raises:
+           IndexError: shotIdx is outside the run.
+           """
+        if shotIdx < 0:
+            shotIdx += len(self)
+        if not 0 <= shotIdx < len(self):
+            raise IndexError("Shot index {} out of range".format(shotIdx))
+        cached = self.cache.get(shotIdx)
+        if cached is not None:
+            return cached
+
+        # A fresh reader per call, Trc keeps per-file state on itself
+        trc = Trc()
+        tmpTime = []
+        tmpAmp = []
+        nbytes = 0
+        for path in self.index.paths[shotIdx]:
+            if path is None:
+                t, y = np.empty(0), np.empty(0)
+            else:
+                t, y, _ = trc.open(path)
+            tmpTime.append(t)
+            tmpAmp.append(y)
+            nbytes += t.nbytes + y.nbytes
+        data = (tmpTime, tmpAmp)
+        self.cache.put(shotIdx, data, nbytes)
+        return data
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The state of one open run in the quicklook viewer.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from envelopePyramid import EnvelopePyramid
+from runModel import ShotCache
+from runStore import openRun, triggerTimes
+from shotPrefetcher import ShotPrefetcher
+from sqlWorker import DustEventMatcher
+from triggerCatalog import TriggerCatalog, catalogPath
+from trcIndex import DEFAULT_PATTERN, readChannelNames
+
+# Plot envelopes kept for the shots viewed last, see RunSession.pyramids
+PYRAMID_CACHE_BYTES = 128 * 2**20
+
+
+# %%ONE OPEN RUN
+class RunSession(QObject):
+
+    runOpened = pyqtSignal()          # A new run replaced the old one
+    shotChanged = pyqtSignal(int)     # The trace number on screen changed
+    displayChanged = pyqtSignal()     # The set of displayed channels changed
+    sqlMatched = pyqtSignal()         # Mass and velocity were (re)matched
+    sqlFailed = pyqtSignal(str)       # The accelerator query failed
+    shotReady = pyqtSignal(int)       # A neighbouring shot was prefetched
+
+    def __init__(self, parent=None, catalogFile=None, db=None):
+        """Owns everything the quicklook viewer used to keep in module
+        globals: the lazily loaded run (index and shot cache), the channel
+        names, the shot and channels on display and the matched accelerator
+        data. Views read from the session and subscribe to its signals, so
+        several sessions, and so several runs, can be open side by side.
+
+        Every accessor takes the session lock, so worker threads may read a
+        consistent snapshot while the Qt thread changes the selection.
+
+        Args:
+           None
+
+        Kwargs:
+           parent (QObject): The Qt parent, usually the main window.
+
+           catalogFile (str): A trigger-time catalog shared by many runs,
+           brought up to date with each run opened. Without one the
+           session writes nothing: the trigger times are read from the
+           catalog a batch or the triggerCatalog command left in the run
+           folder (see :func:`triggerCatalog.catalogPath`), if it has
+           every shot, else from the trace headers.
+
+           db (str or Engine): The accelerator database, the configured one
+           by default; see :func:`dbConnection.dustEventUrl`.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        super().__init__(parent)
+        self._lock = threading.RLock()
+        self.run = None
+        self.trcdir = None
+        self.channelNames = []
+        self.traceNumber = 0
+        self.displayDex = [0, 1, 2, 3]
+        self.mass = []
+        self.velocity = []
+        self.timeStamps = []
+        self.sqlMatch = None
+        self.catalogFile = catalogFile
+        self.catalog = None
+        self.prefetcher = None
+        self.pyramidCache = ShotCache(PYRAMID_CACHE_BYTES)
+        self.matcher = DustEventMatcher(db=db, parent=self)
+        self.matcher.matched.connect(self._sqlMatched)
+        self.matcher.failed.connect(self._sqlFailed)
+        self._sqlRequest = None
+
+    # %%OPEN A RUN
+    def open(self, trcdir, pattern=DEFAULT_PATTERN, verbose=False):
+        """Open a run folder (or its consolidated store) and make it the
+        session's run. Only headers are read; see :func:`runStore.openRun`.
+
+        Args:
+           trcdir (str): The folder containing the trace files.
+
+        Kwargs:
+           pattern (str): The trace file name pattern.
+
+           verbose (bool): Print the number of shots, channels and any
+           missing channels.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        # The slow part happens outside the lock
+        run = openRun(trcdir, pattern=pattern, verbose=verbose)
+        if len(run) == 0:
+            print("No data was detected.")
+        channelNames = readChannelNames(trcdir) or []
+        catalog, timeStamps = self._triggerTimes(run, trcdir, pattern)
+
+        # A match still running belongs to the old run
+        self.matcher.cancel()
+        with self._lock:
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown()
+            if self.catalog is not None:
+                self.catalog.close()
+            self.run = run
+            self.trcdir = trcdir
+            self.channelNames = channelNames
+            self.traceNumber = 0
+            self.displayDex = [0, 1, 2, 3][:max(run.nChannels, 1)]
+            self.mass = []
+            self.velocity = []
+            self.sqlMatch = None
+            self._sqlRequest = None
+            self.timeStamps = timeStamps
+            self.catalog = catalog
+            self.prefetcher = ShotPrefetcher(run, parent=self)
+            self.pyramidCache = ShotCache(PYRAMID_CACHE_BYTES)
+            self.prefetcher.shotReady.connect(self._prefetched)
+        self.runOpened.emit()
+
+    def _triggerTimes(self, run, trcdir, pattern):
+        # The trigger time of every shot: from the shared catalog, updated
+        # for this run; from a catalog already in the run folder, read once
+        # and only if it has every shot; otherwise from the headers
+        if self.catalogFile and os.path.isdir(trcdir):
+            try:
+                catalog = TriggerCatalog(self.catalogFile)
+                catalog.addRun(trcdir, pattern=pattern)
+                shots, triggerMs = catalog.shotTimes(trcdir)
+                return catalog, triggerMs.tolist()
+            except (sqlite3.Error, OSError) as error:
+                print("No trigger catalog for {}: {}".format(trcdir, error))
+        elif os.path.exists(catalogPath(trcdir)):
+            try:
+                catalog = TriggerCatalog(catalogPath(trcdir), readOnly=True)
+                try:
+                    shots, triggerMs = catalog.shotTimes(trcdir)
+                finally:
+                    catalog.close()
+                if len(shots) == len(run):
+                    return None, triggerMs.tolist()
+                print("The trigger catalog of {} is out of date".format(
+                    trcdir))
+            except sqlite3.Error as error:
+                print("Cannot read the trigger catalog of {}: {}".format(
+                    trcdir, error))
+        return None, triggerTimes(run.metas)
+
+    def close(self):
+        """Stop the background decoding and any accelerator query of the
+        session's run."""
+        self.matcher.shutdown()
+        with self._lock:
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown()
+                self.prefetcher = None
+            if self.catalog is not None:
+                self.catalog.close()
+                self.catalog = None
+
+    def _prefetched(self, shotIdx, data):
+        self.shotReady.emit(shotIdx)
+
+    # %%READ-ONLY VIEWS OF THE RUN
+    @property
+    def times(self):
+        with self._lock:
+            return self.run.times
+
+    @property
+    def amps(self):
+        with self._lock:
+            return self.run.amps
+
+    @property
+    def metas(self):
+        with self._lock:
+            return self.run.metas
+
+    @property
+    def nChannels(self):
+        with self._lock:
+            return self.run.nChannels if self.run is not None else 0
+
+    @property
+    def traceList(self):
+        with self._lock:
+            return list(range(len(self.run))) if self.run else []
+
+    @property
+    def numDisplay(self):
+        with self._lock:
+            return len(self.displayDex)
+
+    def shot(self, traceNumber=None):
+        """The (times, amps) channel lists of a shot, the current one by
+        default. Safe to call from any thread."""
+        with self._lock:
+            run = self.run
+            if traceNumber is None:
+                traceNumber = self.traceNumber
+        return run.shot(traceNumber)
+
+    def pyramids(self, channels, traceNumber=None):
+        """The :class:`envelopePyramid.EnvelopePyramid` of each of channels
+        of a shot, the current one by default. A pyramid is built the first
+        time its shot is shown and then kept in a :class:`runModel.ShotCache`
+        keyed by shot and channel, so going back to a shot only swaps the
+        line data."""
+        with self._lock:
+            run = self.run
+            cache = self.pyramidCache
+            if traceNumber is None:
+                traceNumber = self.traceNumber
+        pyramids = []
+        shot = None
+        for channel in channels:
+            key = (traceNumber, channel)
+            pyramid = cache.get(key)
+            if pyramid is None:
+                if shot is None:
+                    shot = run.shot(traceNumber)
+                pyramid = EnvelopePyramid(shot[0][channel], shot[1][channel])
+                cache.put(key, pyramid, pyramid.nbytes)
+            pyramids.append(pyramid)
+        return pyramids
+
+    def title(self):
+        """The figure title of the current trace, with the matched particle
+        mass and velocity from the accelerator database. Like the result
+        tables, it numbers shot index k as Trace Number k + 1."""
+        with self._lock:
+            k = self.traceNumber
+            text = "Trace Number " + str(k + 1)
+            if (0 <= k < len(self.mass) and 0 <= k < len(self.velocity)
+                    and not np.isnan(self.mass[k])):
+                text += ": {:.2e} kg Particle @ {:.2e} km/s".format(
+                    self.mass[k], self.velocity[k])
+            return text
+
+    # %%CHANGE WHAT IS ON DISPLAY
+    def setTraceNumber(self, traceNumber):
+        """Move to traceNumber (clamped to the trace list) and start
+        prefetching its neighbours."""
+        with self._lock:
+            last = max(len(self.run) - 1, 0)
+            self.traceNumber = min(max(int(traceNumber), 0), last)
+            traceNumber = self.traceNumber
+            self.prefetcher.request(traceNumber)
+        self.shotChanged.emit(traceNumber)
+
+    def shotAtTime(self, ms):
+        """The index of the shot triggered closest to ms (epoch ms)."""
+        with self._lock:
+            if self.catalog is not None:
+                return self.catalog.nearestShot(self.trcdir, ms)
+            if not self.timeStamps:
+                return None
+            return int(np.argmin(np.abs(np.asarray(self.timeStamps) - ms)))
+
+    def step(self, delta):
+        with self._lock:
+            traceNumber = self.traceNumber + delta
+        self.setTraceNumber(traceNumber)
+
+    def setDisplay(self, displayDex):
+        """Show the channels at the given indices (at most four); an empty
+        selection falls back to the first four channels."""
+        with self._lock:
+            displayDex = list(displayDex)[:4]
+            if not displayDex:
+                displayDex = [0, 1, 2, 3][:max(self.nChannels, 1)]
+            self.displayDex = displayDex
+        self.displayChanged.emit()
+
+    def setChannelNames(self, channelNames):
+        with self._lock:
+            self.channelNames = list(channelNames)
+
+    # %%MATCH AGAINST THE ACCELERATOR DATABASE
+    def matchSQL(self):
+        """Start matching the run's traces to accelerator dust events on a
+        worker thread. sqlMatched (or sqlFailed) is emitted when the answer
+        arrives, unless another run was opened in the meantime."""
+        with self._lock:
+            timeStamps = list(self.timeStamps)
+        requestId = self.matcher.request(timeStamps)
+        with self._lock:
+            self._sqlRequest = requestId
+
+    def _sqlMatched(self, requestId, df):
+        with self._lock:
+            if requestId != self._sqlRequest:
+                return
+        self.setSQLMatch(df)
+
+    def _sqlFailed(self, requestId, message):
+        with self._lock:
+            if requestId != self._sqlRequest:
+                return
+        print("Accelerator database query failed: {}".format(message))
+        self.sqlFailed.emit(message)
+
+    def setSQLMatch(self, df):
+        """Take the particle mass and velocity of each trace from the matched
+        accelerator table."""
+        with self._lock:
+            self.sqlMatch = df
+            self.mass = list(df["Mass (kg)"])
+            self.velocity = list(df["Velocity (km/s)"])
+        self.sqlMatched.emit()
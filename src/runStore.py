@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Consolidated run store: every trace of a run in one chunked HDF5 file.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+Layout of a store (one row per shot, one column per channel):
+    /waveforms       (shots, channels, samples) int16, raw sample codes
+    /gain, /offset   (shots, channels) volts = gain * raw - offset
+    /n_samples       (shots, channels) valid samples in each row
+    /horiz_interval, /horiz_offset  (shots, channels) time axis
+    /trigger_time    (shots, 7) TRIGGER_TIME tuples from the headers
+    /trigger_ms      (shots,) epoch milliseconds of the first channel
+    /timebase        (shots, channels) TIMEBASE strings
+    /missing         (shots, channels) True where no trace file existed
+    /shots, /channels, /channel_names
+    /derived/...     optional per-run results (fits, SQL matches, ...)
+
+Usage:
+    python runStore.py consolidate <run folder> [-o <store.h5>]
+"""
+
+import argparse
+import datetime
+import os
+
+import h5py
+import numpy as np
+
+from readTrc import Trc
+from runModel import DEFAULT_CACHE_BYTES, RunModel, ShotCache, _ShotView
+from trcIndex import DEFAULT_PATTERN, indexRun, readChannelNames
+
+# %%STORE CONSTANTS
+STORE_SUFFIX = ".spy.h5"
+STORE_VERSION = 1
+
+
+# %%DEFAULT STORE LOCATION
+def storePath(dataDir):
+    """The default store file of a run: <run>/<run name>.spy.h5"""
+    runName = os.path.basename(os.path.normpath(dataDir))
+    return os.path.join(dataDir, runName + STORE_SUFFIX)
+
+
+# %%TRIGGER TIME IN EPOCH MILLISECONDS
+def triggerTimeMs(meta):
+    """Convert the TRIGGER_TIME tuple of a trace header to epoch ms, the same
+    way the quicklook viewer matches traces against the accelerator."""
+    return int(1000 * datetime.datetime(*meta["TRIGGER_TIME"]).timestamp())
+
+
+def epochMs(triggerTimes):
+    """:func:`triggerTimeMs` for a whole array of TRIGGER_TIME tuples at
+    once. Like datetime.timestamp the tuples are read as local time; the UTC
+    offset is looked up once per distinct minute instead of once per trace.
+
+        Args:
+           triggerTimes (np.ndarray): An (N, 7) array of (year, month, day,
+           hour, minute, second, microsecond) rows.
+
+        Kwargs:
+           None
+
+        Returns:
+           ms (np.ndarray): The N trigger times as int64 epoch ms.
+
+        Raises:
+           None
+           """
+    tt = np.asarray(triggerTimes, dtype=np.int64).reshape(-1, 7)
+    years = (tt[:, 0] - 1970).astype("datetime64[Y]")
+    months = years.astype("datetime64[M]") + (tt[:, 1] - 1)
+    days = months.astype("datetime64[D]") + (tt[:, 2] - 1)
+    naiveUs = (days.astype("datetime64[us]").astype(np.int64)
+               + ((tt[:, 3] * 60 + tt[:, 4]) * 60 + tt[:, 5]) * 1000000
+               + tt[:, 6])
+
+    minutes, inverse = np.unique(naiveUs // 60000000, return_inverse=True)
+    epoch = datetime.datetime(1970, 1, 1)
+    offsetUs = np.array([
+        round((epoch + datetime.timedelta(minutes=int(m))).timestamp()
+              * 1000000) - int(m) * 60000000 for m in minutes],
+        dtype=np.int64)
+    return (naiveUs + offsetUs[inverse.ravel()]) // 1000
+
+
+def triggerTimes(metas):
+    """The epoch ms trigger time of every shot in metas, taken from the first
+    channel that has a header. Shots with no header at all are skipped."""
+    rows = []
+    for row in metas:
+        first = next((meta for meta in row if meta is not None), None)
+        if first is not None:
+            rows.append(first["TRIGGER_TIME"])
+    return epochMs(rows).tolist()
+
+
+# %%WRITE A RUN INTO ONE FILE
+def consolidate(dataDir, outPath=None, pattern=DEFAULT_PATTERN,
+                compression="gzip", derived=None, verbose=False):
+    """Write every trace of a run directory into one chunked, compressed
+    HDF5 file. Each (shot, channel) row is one chunk, so a single shot can be
+    read back without touching the rest of the run.
+
+        Args:
+           dataDir (str): The folder containing the trace files.
+
+        Kwargs:
+           outPath (str): Where to write the store. Defaults to
+           :func:`storePath` of dataDir.
+
+           pattern (str): The file name pattern handed to
+           :func:`trcIndex.indexRun`.
+
+           compression (str): An h5py compression filter, or None.
+
+           derived (dict): Optional name -> array datasets written under
+           /derived, e.g. fit parameters or matched SQL columns.
+
+           verbose (bool): Print each shot as it is written.
+
+        Returns:
+           outPath (str): The path of the written store.
+
+        Raises:
+           ValueError: No trace files were found in dataDir.
+           """
+    if outPath is None:
+        outPath = storePath(dataDir)
+    index = indexRun(dataDir, pattern=pattern, verbose=verbose)
+    index.report()
+    if index.nShots == 0:
+        raise ValueError("No trace files found in {}".format(dataDir))
+    nShots, nChannels = index.nShots, index.nChannels
+
+    trc = Trc()
+    headers = [[trc.readHeader(path) if path is not None else None
+                for path in row] for row in index.paths]
+    nSamples = np.zeros((nShots, nChannels), dtype=np.int32)
+    for k, row in enumerate(headers):
+        for c, meta in enumerate(row):
+            if meta is not None:
+                nSamples[k, c] = meta["WAVE_ARRAY_COUNT"]
+    maxSamples = max(int(nSamples.max()), 1)
+
+    channelNames = readChannelNames(dataDir)
+    if channelNames is None or len(channelNames) != nChannels:
+        channelNames = ["C{}".format(chan) for chan in index.channels]
+
+    strType = h5py.string_dtype()
+    with h5py.File(outPath, "w") as f:
+        f.attrs["format"] = "SpectrumPY run store"
+        f.attrs["version"] = STORE_VERSION
+        f.attrs["run"] = os.path.basename(os.path.normpath(dataDir))
+        f.attrs["source"] = os.path.abspath(dataDir)
+
+        f.create_dataset("shots", data=np.asarray(index.shots))
+        f.create_dataset("channels", data=np.asarray(index.channels))
+        f.create_dataset("channel_names", data=channelNames, dtype=strType)
+        f.create_dataset("n_samples", data=nSamples)
+        waves = f.create_dataset("waveforms", (nShots, nChannels, maxSamples),
+                                 dtype=np.int16,
+                                 chunks=(1, 1, maxSamples),
+                                 compression=compression, shuffle=True)
+        gain = np.zeros((nShots, nChannels), dtype=np.float64)
+        offset = np.zeros_like(gain)
+        interval = np.zeros_like(gain)
+        horizOffset = np.zeros_like(gain)
+        trigger = np.zeros((nShots, 7), dtype=np.int64)
+        triggerMs = np.zeros(nShots, dtype=np.int64)
+        timebase = np.full((nShots, nChannels), "", dtype=object)
+        missing = np.zeros((nShots, nChannels), dtype=bool)
+
+        for k, row in enumerate(index.paths):
+            if verbose:
+                print("Writing shot {:05d}".format(index.shots[k]))
+            first = None
+            for c, path in enumerate(row):
+                if path is None:
+                    missing[k, c] = True
+                    continue
+                raw, meta = trc.readRaw(path)
+                waves[k, c, :len(raw)] = raw
+                gain[k, c] = meta["VERTICAL_GAIN"]
+                offset[k, c] = meta["VERTICAL_OFFSET"]
+                interval[k, c] = meta["HORIZ_INTERVAL"]
+                horizOffset[k, c] = meta["HORIZ_OFFSET"]
+                timebase[k, c] = meta["TIMEBASE"]
+                if first is None:
+                    first = meta
+            if first is not None:
+                trigger[k] = first["TRIGGER_TIME"]
+
+        f.create_dataset("gain", data=gain)
+        f.create_dataset("offset", data=offset)
+        f.create_dataset("horiz_interval", data=interval)
+        f.create_dataset("horiz_offset", data=horizOffset)
+        f.create_dataset("trigger_time", data=trigger)
+        recorded = ~missing.all(axis=1)
+        triggerMs[recorded] = epochMs(trigger[recorded])
+        f.create_dataset("trigger_ms", data=triggerMs)
+        f.create_dataset("timebase", data=timebase.astype(str).tolist(),
+                         dtype=strType)
+        f.create_dataset("missing", data=missing)
+        group = f.create_group("derived")
+        for name, values in (derived or {}).items():
+            group.create_dataset(name, data=values)
+    return outPath
+
+
+# %%RANDOM ACCESS TO A CONSOLIDATED RUN
+class RunStore:
+
+    def __init__(self, path, cacheBytes=DEFAULT_CACHE_BYTES):
+        """A consolidated run opened for random shot access. It has the same
+        interface as :class:`runModel.RunModel` (times, amps, metas, shot,
+        isLoaded), so the quicklook viewer and the fitters can use either.
+
+        Args:
+           path (str): A file written by :func:`consolidate`.
+
+        Kwargs:
+           cacheBytes (int): The size limit of the decoded shot cache.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.path = path
+        self._file = h5py.File(path, "r")
+        f = self._file
+        self.dataDir = f.attrs["source"]
+        self.shots = f["shots"][()]
+        self.channels = f["channels"][()]
+        self.channelNames = [name.decode() if isinstance(name, bytes)
+                             else name for name in f["channel_names"][()]]
+        self.nSamples = f["n_samples"][()]
+        self.gain = f["gain"][()]
+        self.offset = f["offset"][()]
+        self.interval = f["horiz_interval"][()]
+        self.horizOffset = f["horiz_offset"][()]
+        self.triggerMs = f["trigger_ms"][()]
+        self.missing = f["missing"][()]
+        self.cache = ShotCache(cacheBytes)
+
+        trigger = f["trigger_time"][()]
+        timebase = f["timebase"][()]
+        self.headers = []
+        for k in range(len(self.shots)):
+            row = []
+            for c in range(len(self.channels)):
+                if self.missing[k, c]:
+                    row.append(None)
+                    continue
+                tb = timebase[k, c]
+                row.append({"TRIGGER_TIME": tuple(int(v) for v in trigger[k]),
+                            "TIMEBASE": tb.decode()
+                            if isinstance(tb, bytes) else tb,
+                            "WAVE_ARRAY_COUNT": int(self.nSamples[k, c]),
+                            "VERTICAL_GAIN": self.gain[k, c],
+                            "VERTICAL_OFFSET": self.offset[k, c],
+                            "HORIZ_INTERVAL": self.interval[k, c],
+                            "HORIZ_OFFSET": self.horizOffset[k, c]})
+            self.headers.append(row)
+
+        self.times = _ShotView(self, 0)
+        self.amps = _ShotView(self, 1)
+        self.metas = self.headers
+
+    def __len__(self):
+        return len(self.shots)
+
+    @property
+    def nShots(self):
+        return len(self.shots)
+
+    @property
+    def nChannels(self):
+        return len(self.channels)
+
+    def isLoaded(self, shotIdx):
+        return shotIdx in self.cache
+
+    def matches(self, index):
+        """True if the store holds the same shots, channels and recorded
+        traces as a fresh :func:`trcIndex.indexRun` of its run folder, i.e.
+        no trace was added or removed since it was consolidated."""
+        missing = np.array([[path is None for path in row]
+                            for row in index.paths], dtype=bool)
+        return (list(self.shots) == list(index.shots)
+                and list(self.channels) == list(index.channels)
+                and self.missing.shape == missing.shape
+                and bool((self.missing == missing).all()))
+
+    def derived(self, name):
+        """Read a dataset from the /derived group."""
+        return self._file["derived"][name][()]
+
+    def shot(self, shotIdx):
+        """Decode (or fetch from the cache) every channel of one shot, see
+        :meth:`runModel.RunModel.shot`."""
+        if shotIdx < 0:
+            shotIdx += len(self)
+        if not 0 <= shotIdx < len(self):
+            raise IndexError("Shot index {} out of range".format(shotIdx))
+        cached = self.cache.get(shotIdx)
+        if cached is not None:
+            return cached
+
+        raw = self._file["waveforms"][shotIdx]
+        tmpTime = []
+        tmpAmp = []
+        nbytes = 0
+        for c in range(len(self.channels)):
+            n = int(self.nSamples[shotIdx, c])
+            y = self.gain[shotIdx, c] * raw[c, :n] - self.offset[shotIdx, c]
+            t = np.arange(1, n + 1, dtype=float)
+            t *= self.interval[shotIdx, c]
+            t += self.horizOffset[shotIdx, c]
+            tmpTime.append(t)
+            tmpAmp.append(y)
+            nbytes += t.nbytes + y.nbytes
+        data = (tmpTime, tmpAmp)
+        self.cache.put(shotIdx, data, nbytes)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+# %%OPEN A RUN FOLDER OR STORE
+def runSource(path, pattern=DEFAULT_PATTERN, index=None):
+    """Where :func:`openRun` reads a run from: the path itself if it is a
+    store file, the run folder's default store if that still matches the
+    trace files (see :meth:`RunStore.matches`), otherwise the folder.
+    Planning from an index and handing the source to the workers that
+    decode the shots keeps both on the same shots.
+
+        Args:
+           path (str): A run folder or a store file.
+
+        Kwargs:
+           pattern (str): The trace file name pattern for run folders.
+
+           index (RunIndex): The folder's :func:`trcIndex.indexRun`, if
+           already made.
+
+        Returns:
+           source (str): A store file or the run folder.
+
+        Raises:
+           None
+           """
+    if os.path.isfile(path) or not os.path.exists(storePath(path)):
+        return path
+    store = RunStore(storePath(path), cacheBytes=0)
+    try:
+        if store.matches(index or indexRun(path, pattern=pattern)):
+            return store.path
+    finally:
+        store.close()
+    print("{} does not match the trace files, reading them instead. "
+          "Consolidate the run again to update it.".format(store.path))
+    return path
+
+
+def openRun(path, pattern=DEFAULT_PATTERN, cacheBytes=DEFAULT_CACHE_BYTES,
+            verbose=False):
+    """Open a run for lazy access. A store file, or a run folder holding its
+    default store, is opened as a :class:`RunStore`; any other folder is
+    indexed as a :class:`runModel.RunModel`. So is a folder whose store no
+    longer matches its trace files (see :func:`runSource`), so the shots
+    are always those :func:`trcIndex.indexRun` finds.
+
+        Args:
+           path (str): A run folder or a store file.
+
+        Kwargs:
+           pattern (str): The trace file name pattern for run folders.
+
+           cacheBytes (int): The size limit of the decoded shot cache.
+
+           verbose (bool): Print the table size and every missing channel.
+
+        Returns:
+           run (RunStore or RunModel): The opened run.
+
+        Raises:
+           None
+           """
+    source = runSource(path, pattern=pattern)
+    if os.path.isfile(source):
+        if verbose and source != path:
+            print("Opening consolidated store {}".format(source))
+        return RunStore(source, cacheBytes=cacheBytes)
+    return RunModel(path, pattern=pattern, cacheBytes=cacheBytes,
+                    verbose=verbose)
+
+
+# Runs opened by sharedRun in this process
+_openRuns = {}
+
+
+def sharedRun(path, pattern=DEFAULT_PATTERN, cacheBytes=DEFAULT_CACHE_BYTES):
+    """:func:`openRun`, but each run is opened once per process and reused.
+    Meant for pool workers that are handed many shots of the same runs. A
+    run is opened again once its folder (or store file) has changed, so a
+    long-lived worker sees the shots added since."""
+    key = (path, pattern)
+    stamp = os.stat(path).st_mtime_ns
+    if key not in _openRuns or _openRuns[key][0] != stamp:
+        _openRuns[key] = (stamp, openRun(path, pattern=pattern,
+                                         cacheBytes=cacheBytes))
+    return _openRuns[key][1]
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert a folder of .trc files into one run store.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cons = commands.add_parser("consolidate",
+                               help="write a run folder into one HDF5 file")
+    cons.add_argument("dataDir", help="run folder containing .trc files")
+    cons.add_argument("-o", "--output", default=None,
+                      help="store file (default <run>/<run>.spy.h5)")
+    cons.add_argument("--pattern", default=DEFAULT_PATTERN,
+                      help="trace file name regular expression")
+    cons.add_argument("--no-compression", action="store_true",
+                      help="write uncompressed chunks")
+    cons.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "consolidate":
+        outPath = consolidate(args.dataDir, args.output, pattern=args.pattern,
+                              compression=None if args.no_compression
+                              else "gzip",
+                              verbose=args.verbose)
+        print("Wrote {}".format(outPath))
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
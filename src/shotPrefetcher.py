@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background decoding of the shots around the one being viewed.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+# %%DEFAULTS
+PREFETCH_RADIUS = 2  # Shots decoded ahead of and behind the current one
+
+
+# %%NEIGHBOURING SHOT PREFETCHER
+class ShotPrefetcher(QObject):
+
+    # (shot index, (times, amps)) emitted from the worker, delivered queued
+    # to slots living on the Qt thread
+    shotReady = pyqtSignal(int, object)
+
+    def __init__(self, run, radius=PREFETCH_RADIUS, parent=None):
+        """Decodes the next and previous shots of a run on a worker thread
+        while the user looks at the current one, so stepping through a run
+        only ever hits the cache.
+
+        Args:
+           run (RunModel): The lazily loaded run whose cache gets filled.
+
+        Kwargs:
+           radius (int): How many shots on either side of the current one
+           to decode.
+
+           parent (QObject): The Qt parent, usually the main window.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        super().__init__(parent)
+        self.run = run
+        self.radius = radius
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wanted = set()
+
+    def request(self, center):
+        """Prefetch the neighbours of shot center, nearest first. Anything
+        still queued for an earlier center that is no longer wanted is
+        cancelled.
+
+        Args:
+           center (int): The shot index now on screen.
+
+        Kwargs:
+           None
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        order = []
+        for step in range(1, self.radius + 1):
+            for shotIdx in (center + step, center - step):
+                if 0 <= shotIdx < len(self.run):
+                    order.append(shotIdx)
+
+        with self._lock:
+            self._wanted = set(order)
+            # Drop the old queue, a future that is already running finishes
+            for future in self._pending:
+                future.cancel()
+            self._pending = [self._executor.submit(self._load, shotIdx)
+                             for shotIdx in order
+                             if not self.run.isLoaded(shotIdx)]
+
+    def _load(self, shotIdx):
+        # Runs on the worker thread
+        with self._lock:
+            if shotIdx not in self._wanted:
+                return
+        data = self.run.shot(shotIdx)
+        self.shotReady.emit(shotIdx, data)
+
+    def shutdown(self):
+        """Cancel everything queued and stop the worker thread."""
+        with self._lock:
+            self._wanted = set()
+            for future in self._pending:
+                future.cancel()
+            self._pending = []
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lazy, indexed access to HDF5 spectrum exports.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+An export holds one group per spectrum under /Spectra, named
+"<n>: <uuid>", each with 1-D datasets such as Time, Mass, Amplitude and
+AmplitudeDenoised. Opening a store only lists those groups and the shape
+and dtype of their datasets; samples are read when asked for, and only
+the slice asked for.
+
+Usage:
+    python spectraStore.py <export.h5> [--root Spectra]
+"""
+
+import argparse
+import re
+
+import h5py
+import numpy as np
+
+# %%DEFAULTS
+SPECTRA_ROOT = "Spectra"
+CHUNK_SPECTRA = 64  # Spectra read together by H5SpectraStore.iterChunks
+_GROUP_NAME = re.compile(r"^\s*(?P<number>\d+)\s*:\s*(?P<uuid>.+?)\s*$")
+
+
+# %%THE STORE
+class H5SpectraStore:
+
+    def __init__(self, path, root=SPECTRA_ROOT):
+        """An exported spectrum file opened for random access. The index,
+        built once here, maps every spectrum to its group and caches the
+        shape and dtype of its datasets without reading any samples.
+
+        A spectrum can be named by its number (47), its uuid or its group
+        name ("47: 9CE8F380-..."); :meth:`keys` lists the group names in
+        number order.
+
+        Args:
+           path (str): The HDF5 export.
+
+        Kwargs:
+           root (str): The group holding one group per spectrum.
+
+        Returns:
+           None
+
+        Raises:
+           KeyError: The file has no root group.
+           """
+        self.path = path
+        self._file = h5py.File(path, "r")
+        self._root = self._file[root]
+
+        self._fields = {}
+        self._numbers = {}
+        self._uuids = {}
+        order = []
+        for name, group in self._root.items():
+            if not isinstance(group, h5py.Group):
+                continue
+            self._fields[name] = {
+                field: (dataset.shape, dataset.dtype)
+                for field, dataset in group.items()
+                if isinstance(dataset, h5py.Dataset)}
+            match = _GROUP_NAME.match(name)
+            if match:
+                number = int(match.group("number"))
+                self._numbers[number] = name
+                self._uuids[match.group("uuid")] = name
+                order.append((0, number, name))
+            else:
+                order.append((1, 0, name))
+        self._keys = [name for _, _, name in sorted(order)]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        try:
+            self._resolve(key)
+        except KeyError:
+            return False
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def keys(self):
+        """The group names of every spectrum, in number order."""
+        return list(self._keys)
+
+    def _resolve(self, key):
+        # A spectrum number, uuid or group name to its group name
+        if isinstance(key, (int, np.integer)):
+            if int(key) in self._numbers:
+                return self._numbers[int(key)]
+        elif key in self._fields:
+            return key
+        elif key in self._uuids:
+            return self._uuids[key]
+        raise KeyError("No spectrum {!r} in {}".format(key, self.path))
+
+    # %%CACHED METADATA
+    def fields(self, key):
+        """{dataset name: (shape, dtype)} of one spectrum, from the index."""
+        return dict(self._fields[self._resolve(key)])
+
+    def shape(self, key, field):
+        return self._fields[self._resolve(key)][field][0]
+
+    def dtype(self, key, field):
+        return self._fields[self._resolve(key)][field][1]
+
+    # %%SLICED READS
+    def read(self, key, field, start=None, stop=None):
+        """Read samples [start:stop] of one dataset; only that slice is
+        read from the file.
+
+        Args:
+           key (int or str): The spectrum number, uuid or group name.
+
+           field (str): The dataset, e.g. "Amplitude".
+
+        Kwargs:
+           start (int): The first sample.
+
+           stop (int): One past the last sample.
+
+        Returns:
+           values (np.ndarray): The samples.
+
+        Raises:
+           KeyError: No such spectrum or dataset.
+           """
+        name = self._resolve(key)
+        if field not in self._fields[name]:
+            raise KeyError("Spectrum {!r} has no {}".format(name, field))
+        return self._root[name][field][start:stop]
+
+    def spectrum(self, key, fields=("Time", "Amplitude"), start=None,
+                 stop=None):
+        """The same [start:stop] slice of several datasets of one spectrum,
+        as a tuple in the order of fields."""
+        return tuple(self.read(key, field, start, stop) for field in fields)
+
+    def window(self, key, lo, hi, axis="Mass", fields=("Amplitude",)):
+        """The part of a spectrum whose axis lies between lo and hi. The
+        axis dataset is read whole; the others only over the window.
+
+        Args:
+           key (int or str): The spectrum number, uuid or group name.
+
+           lo (float): The low end of the window, in axis units.
+
+           hi (float): The high end of the window.
+
+        Kwargs:
+           axis (str): The dataset the window is given in, e.g. "Mass" or
+           "Time".
+
+           fields (tuple): The datasets to read over the window.
+
+        Returns:
+           values (tuple): The axis values inside the window, then one
+           array per field. Samples between the first and last inside the
+           window are all kept, so a non-monotonic axis gives a contiguous
+           slice.
+
+        Raises:
+           KeyError: No such spectrum or dataset.
+           """
+        values = self.read(key, axis)
+        inside = np.flatnonzero((values >= lo) & (values <= hi))
+        if not len(inside):
+            return (values[:0],) + tuple(
+                np.empty(0, dtype=self.dtype(key, field))
+                for field in fields)
+        start, stop = int(inside[0]), int(inside[-1]) + 1
+        return (values[start:stop],) + self.spectrum(key, fields, start,
+                                                     stop)
+
+    # %%STREAMING
+    def iterChunks(self, fields=("Time", "Amplitude"),
+                   chunkSize=CHUNK_SPECTRA, keys=None):
+        """Read the spectra a few at a time, for analyses that stream over
+        a whole export. Spectra missing one of the fields are skipped.
+
+        Args:
+           None
+
+        Kwargs:
+           fields (tuple): The datasets to read.
+
+           chunkSize (int): Spectra per chunk.
+
+           keys (list): The spectra to read, all of them by default.
+
+        Returns:
+           chunks (generator): (names, values) tuples, the group names of
+           the chunk and {field: list of arrays, one per spectrum}.
+
+        Raises:
+           None
+           """
+        names = [self._resolve(key) for key in keys] if keys is not None \
+            else self._keys
+        names = [name for name in names
+                 if all(field in self._fields[name] for field in fields)]
+        for first in range(0, len(names), chunkSize):
+            chunk = names[first:first + chunkSize]
+            yield chunk, {field: [self._root[name][field][()]
+                                  for name in chunk] for field in fields}
+
+    def report(self):
+        """Print one line per spectrum with the shape and dtype of its
+        datasets."""
+        print("{}: {} spectra".format(self.path, len(self)))
+        for name in self._keys:
+            print("{}  {}".format(name, ", ".join(
+                "{} {}{}".format(field, dtype, list(shape)) for
+                field, (shape, dtype) in sorted(self._fields[name].items()))))
+
+    def close(self):
+        self._file.close()
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="List the spectra of an HDF5 export without reading "
+        "them.")
+    parser.add_argument("path", help="HDF5 spectrum export")
+    parser.add_argument("--root", default=SPECTRA_ROOT,
+                        help="group holding one group per spectrum")
+    args = parser.parse_args(argv)
+
+    with H5SpectraStore(args.path, root=args.root) as store:
+        store.report()
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
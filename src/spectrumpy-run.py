@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+spectrumpy-run: process accelerator run folders without the GUI.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+Usage:
+    python spectrumpy-run.py RUN [RUN ...] [-s STAGE ...] [-j JOBS]
+"""
+
+from batchRun import main
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    raise SystemExit(main())
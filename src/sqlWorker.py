@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accelerator database queries on a worker thread.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from dustEvents import DEFAULT_TOLERANCE_MS, matchDustEvents, \
+    queryAllDustEvents
+
+
+# %%DUST EVENT MATCHER
+class DustEventMatcher(QObject):
+
+    # (request id, matched DataFrame) or (request id, error text), emitted
+    # from the worker and delivered queued to slots on the Qt thread
+    matched = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, db=None, toleranceMs=DEFAULT_TOLERANCE_MS,
+                 parent=None):
+        """Runs :func:`dustEvents.matchDustEvents` off the Qt thread, so the
+        viewer stays responsive while the database answers. Only the latest
+        request counts: a new request or :meth:`cancel` drops anything still
+        queued, and the result of a query already on the wire is thrown away
+        when it arrives.
+
+        Args:
+           None
+
+        Kwargs:
+           db (str or Engine): The database, the configured one by default;
+           see :func:`dbConnection.dustEventUrl`.
+
+           toleranceMs (float): See :func:`dustEvents.matchDustEvents`.
+
+           parent (QObject): The Qt parent, usually the run session.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        super().__init__(parent)
+        self.db = db
+        self.toleranceMs = toleranceMs
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="sql")
+        self._lock = threading.Lock()
+        self._pending = None
+        self._current = 0
+
+    def request(self, timebase):
+        """Match the traces with trigger times timebase (epoch ms).
+
+        Args:
+           timebase (list): The trigger times of the traces, in trace order.
+
+        Kwargs:
+           None
+
+        Returns:
+           requestId (int): The id the matched or failed signal will carry.
+
+        Raises:
+           None
+           """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.cancel()
+            self._current += 1
+            requestId = self._current
+            self._pending = self._executor.submit(self._match, requestId,
+                                                  list(timebase))
+        return requestId
+
+    def isCurrent(self, requestId):
+        with self._lock:
+            return requestId == self._current
+
+    def _match(self, requestId, timebase):
+        # Runs on the worker thread
+        if not self.isCurrent(requestId):
+            return
+        try:
+            df = matchDustEvents(timebase, db=self.db,
+                                 toleranceMs=self.toleranceMs)
+        except Exception as error:
+            if self.isCurrent(requestId):
+                self.failed.emit(requestId, str(error))
+            return
+        if self.isCurrent(requestId):
+            self.matched.emit(requestId, df)
+
+    def cancel(self):
+        """Forget the outstanding request, e.g. when another run is opened."""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.cancel()
+                self._pending = None
+            self._current += 1
+
+    def shutdown(self):
+        """Cancel the outstanding request and stop the worker thread."""
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+
+# %%WHOLE ACCELERATOR HISTORY
+class DustHistoryLoader(QObject):
+
+    loaded = pyqtSignal(object)  # Every dust event, a DataFrame
+    failed = pyqtSignal(str)     # The query failed
+
+    def __init__(self, db=None, parent=None):
+        """Runs :func:`dustEvents.queryAllDustEvents` off the Qt thread. A
+        new :meth:`load` or :meth:`cancel` drops the result of one still
+        running.
+
+        Args:
+           None
+
+        Kwargs:
+           db (str or Engine): The database, the local mirror or the
+           configured one by default; see :func:`dbConnection.dustEventUrl`.
+
+           parent (QObject): The Qt parent, usually the accelerator window.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        super().__init__(parent)
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="history")
+        self._lock = threading.Lock()
+        self._current = 0
+
+    def load(self):
+        with self._lock:
+            self._current += 1
+            job = self._current
+        self._executor.submit(self._load, job)
+
+    def _isCurrent(self, job):
+        with self._lock:
+            return job == self._current
+
+    def _load(self, job):
+        # Runs on the worker thread
+        try:
+            df = queryAllDustEvents(db=self.db)
+        except Exception as error:
+            if self._isCurrent(job):
+                self.failed.emit(str(error))
+            return
+        if self._isCurrent(job):
+            self.loaded.emit(df)
+
+    def cancel(self):
+        with self._lock:
+            self._current += 1
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
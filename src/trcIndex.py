@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+One-pass indexing of a directory of LeCroy trace files.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import os
+import re
+
+# %%FILENAME PATTERNS
+# Matches both the scope default "C1--Trace--00000.trc" and the shortened
+# "C1Fe00000.trc" naming used at the accelerator. The pattern must define a
+# "channel" and a "shot" group, both of which are parsed as integers.
+DEFAULT_PATTERN = r"^C(?P<channel>\d+)\D*?(?P<shot>\d+)\.trc$"
+
+
+# %%SHOTS X CHANNELS TABLE OF TRACE FILES
+class RunIndex:
+
+    def __init__(self, dataDir, shots, channels, paths):
+        """A table of the trace files in a run directory, one row per shot
+        and one column per channel. Built by :func:`indexRun`.
+
+        Args:
+           dataDir (str): The folder that was indexed.
+
+           shots (list): The sorted shot numbers found in the folder.
+
+           channels (list): The sorted channel numbers found in the folder.
+
+           paths (list): A 2 dimensional list (shots x channels) of file
+           paths. Missing files are None.
+
+        Kwargs:
+           None
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.dataDir = dataDir
+        self.shots = shots
+        self.channels = channels
+        self.paths = paths
+        self.missing = [(shot, chan)
+                        for row, shot in zip(paths, shots)
+                        for path, chan in zip(row, channels) if path is None]
+
+    @property
+    def nShots(self):
+        return len(self.shots)
+
+    @property
+    def nChannels(self):
+        return len(self.channels)
+
+    def __len__(self):
+        return len(self.shots)
+
+    def path(self, shotIdx, chanIdx):
+        """Return the file for row shotIdx and column chanIdx, or None if
+        that channel was not recorded for the shot."""
+        return self.paths[shotIdx][chanIdx]
+
+    def isComplete(self, shotIdx):
+        """True if every channel of row shotIdx has a trace file."""
+        return all(path is not None for path in self.paths[shotIdx])
+
+    def report(self):
+        """Print one line for every missing (shot, channel) pair."""
+        for shot, chan in self.missing:
+            print("Shot {:05d} is missing channel C{}.".format(shot, chan))
+
+
+# %%SCAN A RUN DIRECTORY ONCE
+def indexRun(dataDir, pattern=DEFAULT_PATTERN, verbose=False):
+    """Scan a run directory once and sort its trace files into a shots x
+    channels table. No waveform data is read.
+
+        Args:
+           dataDir (str): The folder containing the trace files. Files that
+           do not match the pattern (settings.txt, exports, ...) are ignored.
+
+        Kwargs:
+           pattern (str): A regular expression with named groups "channel"
+           and "shot", matched against each file name.
+
+           verbose (bool): Print the table size. Missing channels are
+           printed by :meth:`RunIndex.report`.
+
+        Returns:
+           index (RunIndex): The shots x channels table of file paths.
+
+        Raises:
+           ValueError: The pattern lacks a "channel" or "shot" group.
+           """
+    regex = re.compile(pattern)
+    if not {"channel", "shot"} <= set(regex.groupindex):
+        raise ValueError("Trace file pattern must define 'channel' and "
+                         "'shot' groups: {}".format(pattern))
+
+    found = {}
+    channels = set()
+    with os.scandir(dataDir) as entries:
+        for entry in entries:
+            match = regex.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            shot = int(match.group("shot"))
+            chan = int(match.group("channel"))
+            found.setdefault(shot, {})[chan] = entry.path
+            channels.add(chan)
+
+    shots = sorted(found)
+    channels = sorted(channels)
+    paths = [[found[shot].get(chan) for chan in channels] for shot in shots]
+    index = RunIndex(dataDir, shots, channels, paths)
+
+    if verbose:
+        print(r"{} channels detected.".format(index.nChannels))
+        print(r"{} shots detected.".format(index.nShots))
+    return index
+
+
+# %%CHANNEL NAMES FROM SETTINGS.TXT
+def readChannelNames(dataDir):
+    """Read the channel names saved in a run's settings.txt, one per line.
+
+        Args:
+           dataDir (str): The run folder.
+
+        Kwargs:
+           None
+
+        Returns:
+           channelNames (list): The stripped, non-empty lines of
+           settings.txt, or None if the run has no settings file.
+
+        Raises:
+           None
+           """
+    settingsPath = os.path.join(dataDir, "settings.txt")
+    if not os.path.exists(settingsPath):
+        return None
+    with open(settingsPath, "r") as settingsFile:
+        return [line.strip() for line in settingsFile if line.strip()]
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A SQLite catalog of trace trigger times across runs.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+import argparse
+import datetime
+import os
+import pathlib
+import sqlite3
+
+import numpy as np
+
+from readTrc import Trc
+from runStore import epochMs
+from trcIndex import DEFAULT_PATTERN, indexRun
+
+# %%DEFAULTS
+CATALOG_NAME = "trigger-catalog.sqlite"
+CATALOG_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS traces (
+    run TEXT NOT NULL,
+    shot INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    trigger_ms INTEGER NOT NULL,
+    timebase TEXT,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (run, shot, channel)
+);
+CREATE INDEX IF NOT EXISTS traces_trigger_ms ON traces (trigger_ms);
+"""
+
+
+# %%DEFAULT CATALOG LOCATION
+def catalogPath(dataDir):
+    """The catalog kept beside a run: <run>/trigger-catalog.sqlite"""
+    return os.path.join(dataDir, CATALOG_NAME)
+
+
+# %%THE CATALOG
+class TriggerCatalog:
+
+    def __init__(self, path, readOnly=False):
+        """One row per trace file (run, shot, channel) with its trigger time
+        in epoch ms, timebase and path, indexed by trigger time. A catalog
+        can sit beside a single run or be shared by every run of a campaign.
+
+        Args:
+           path (str): The SQLite file, created if it does not exist.
+
+        Kwargs:
+           readOnly (bool): Only query an existing catalog. It is opened
+           immutable, so nothing is written beside it, not even SQLite's
+           lock and journal files; it must not be written to while open.
+
+        Returns:
+           None
+
+        Raises:
+           sqlite3.Error: readOnly and the catalog cannot be opened.
+           """
+        self.path = path
+        if readOnly:
+            # as_uri percent-encodes the path, e.g. a "?" or "#" in it
+            uri = pathlib.Path(os.path.abspath(path)).as_uri()
+            self._db = sqlite3.connect(uri + "?mode=ro&immutable=1", uri=True)
+            return
+        self._db = sqlite3.connect(path)
+        # Readers (the viewer) and the writer (a batch) may share the file
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._db.execute("PRAGMA user_version={}".format(CATALOG_VERSION))
+
+    def close(self):
+        self._db.close()
+
+    # %%FILL FROM A RUN FOLDER
+    def addRun(self, dataDir, pattern=DEFAULT_PATTERN, verbose=False):
+        """Add or refresh the traces of one run folder. Only the headers of
+        files that are new or changed (size or modification time) are read,
+        and no waveform data is touched. Rows of deleted files are dropped.
+
+        Args:
+           dataDir (str): The run folder.
+
+        Kwargs:
+           pattern (str): The trace file name pattern.
+
+           verbose (bool): Print how many headers were read.
+
+        Returns:
+           run (str): The run key, the absolute path of the folder.
+
+        Raises:
+           None
+           """
+        run = os.path.abspath(dataDir)
+        index = indexRun(dataDir, pattern=pattern)
+        known = {(shot, chan): (size, mtime) for shot, chan, size, mtime in
+                 self._db.execute("SELECT shot, channel, size, mtime_ns "
+                                  "FROM traces WHERE run=?", (run,))}
+
+        trc = Trc()
+        rows = []
+        triggers = []
+        present = set()
+        for shot, row in zip(index.shots, index.paths):
+            for chan, path in zip(index.channels, row):
+                if path is None:
+                    continue
+                present.add((shot, chan))
+                stat = os.stat(path)
+                if known.get((shot, chan)) == (stat.st_size,
+                                               stat.st_mtime_ns):
+                    continue
+                meta = trc.readHeader(path)
+                triggers.append(meta["TRIGGER_TIME"])
+                rows.append([run, shot, chan, None, str(meta["TIMEBASE"]),
+                             os.path.abspath(path), stat.st_size,
+                             stat.st_mtime_ns])
+
+        # Every new trigger time is converted in one go
+        for row, ms in zip(rows, epochMs(triggers).tolist()):
+            row[3] = ms
+        gone = [(run, shot, chan) for shot, chan in set(known) - present]
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO traces VALUES "
+                                 "(?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.executemany("DELETE FROM traces WHERE run=? AND shot=? "
+                                 "AND channel=?", gone)
+        if verbose:
+            print("{}: {} header(s) read, {} unchanged, {} removed".format(
+                run, len(rows), len(present) - len(rows), len(gone)))
+        return run
+
+    # %%QUERIES
+    def runs(self):
+        return [run for run, in
+                self._db.execute("SELECT DISTINCT run FROM traces "
+                                 "ORDER BY run")]
+
+    def shotTimes(self, run):
+        """The shot numbers of a run in index order and the trigger time of
+        each, in epoch ms.
+
+        Args:
+           run (str): A run folder (or the key returned by addRun).
+
+        Kwargs:
+           None
+
+        Returns:
+           shots (np.ndarray): The sorted shot numbers.
+
+           triggerMs (np.ndarray): The trigger time of each shot.
+
+        Raises:
+           None
+           """
+        rows = self._db.execute("SELECT shot, MIN(trigger_ms) FROM traces "
+                                "WHERE run=? GROUP BY shot ORDER BY shot",
+                                (os.path.abspath(run),)).fetchall()
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        shots, triggerMs = np.array(rows, dtype=np.int64).T
+        return shots, triggerMs
+
+    def between(self, startMs, endMs, runs=None):
+        """Every trace triggered in [startMs, endMs], oldest first.
+
+        Args:
+           startMs (int): The start of the range in epoch ms.
+
+           endMs (int): The end of the range in epoch ms.
+
+        Kwargs:
+           runs (list): Only look in these run folders.
+
+        Returns:
+           rows (list): (run, shot, channel, trigger_ms, timebase, path)
+           tuples.
+
+        Raises:
+           None
+           """
+        query = ("SELECT run, shot, channel, trigger_ms, timebase, path "
+                 "FROM traces WHERE trigger_ms BETWEEN ? AND ?")
+        args = [int(startMs), int(endMs)]
+        if runs is not None:
+            runs = [os.path.abspath(run) for run in runs]
+            query += " AND run IN ({})".format(", ".join("?" * len(runs)))
+            args += runs
+        query += " ORDER BY trigger_ms, run, shot, channel"
+        return self._db.execute(query, args).fetchall()
+
+    def nearestShot(self, run, ms):
+        """The index (position in :meth:`shotTimes`) of the shot of run
+        triggered closest to ms, or None for an empty run."""
+        shots, triggerMs = self.shotTimes(run)
+        if len(shots) == 0:
+            return None
+        order = np.argsort(triggerMs, kind="stable")
+        k = int(np.searchsorted(triggerMs[order], ms))
+        candidates = order[max(k - 1, 0):k + 1]
+        return int(candidates[np.argmin(np.abs(triggerMs[candidates] - ms))])
+
+
+# %%COMMAND LINE INTERFACE
+def _parseTime(text):
+    # Epoch ms, or an ISO date/time read as local time like TRIGGER_TIME
+    try:
+        return int(text)
+    except ValueError:
+        return int(1000 * datetime.datetime.fromisoformat(text).timestamp())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build and query a trigger-time catalog of runs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="catalog one or more run folders")
+    add.add_argument("dataDirs", nargs="+", metavar="RUN")
+    add.add_argument("-c", "--catalog", default=None,
+                     help="shared catalog file (default: one per run)")
+    add.add_argument("--pattern", default=DEFAULT_PATTERN,
+                     help="trace file name regular expression")
+    add.add_argument("-v", "--verbose", action="store_true")
+    query = commands.add_parser("query", help="list traces in a time range")
+    query.add_argument("catalog", help="catalog file")
+    query.add_argument("start", help="epoch ms or ISO time")
+    query.add_argument("end", help="epoch ms or ISO time")
+    args = parser.parse_args(argv)
+
+    if args.command == "add":
+        for dataDir in args.dataDirs:
+            catalog = TriggerCatalog(args.catalog or catalogPath(dataDir))
+            catalog.addRun(dataDir, pattern=args.pattern,
+                           verbose=args.verbose)
+            catalog.close()
+    else:
+        catalog = TriggerCatalog(args.catalog)
+        for row in catalog.between(_parseTime(args.start),
+                                   _parseTime(args.end)):
+            print("\t".join(str(value) for value in row))
+        catalog.close()
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
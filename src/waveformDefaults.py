@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Defaults shared by the waveform fits and statistics. They live here, with
+no imports of their own, so SudaIonTarget, jointFit, qdAnalysis and
+waveformStats can all import them at module level.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+"""
+
+# %%ION GRID PULSES
+IMAGE_START = -3.0e-5  # Before image charge
+ONSET_SIGMA = 5.0  # Noise levels a pulse must rise above to have started
+SMOOTH_FRACTION = 1.0e-3  # Moving average width, as a fraction of the record
+
+# %%QD PICKUP TUBE
+# Nominal QD geometry; replace with the measured values of the beamline
+QD_GEOMETRY = {"length": 0.10,        # Pickup tube length L (m)
+               "drift": 0.50,         # Tube exit to target D (m)
+               "ramp": 0.01,          # Fringe length R of the tube ends (m)
+               "capacitance": 1e-12}  # Charge per QD plateau volt (C/V)
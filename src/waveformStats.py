@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Quick-look statistics of whole runs: baseline, noise, image charge, peak,
+10-90% rise time and decay constant of every waveform from (shots,
+samples) arrays, with no curve fitting.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+The quantities are those SudaIonTarget.pulseGuess reads off a single
+waveform, computed for a block of records at once: the baseline mean and
+standard deviation before the image charge window, at full resolution;
+everything else from a moving average over SMOOTH_FRACTION of the record
+(after block averaging to MAX_SAMPLES), so single noisy samples do not
+move it. The image charge is the lowest level between the end of the
+baseline and the trigger, the peak the largest excursion after the
+baseline, the rise the time between the 10% and 90% crossings before the
+peak and the decay the 90-10% fall after it over ln 9, or, if the record
+ends first, the constant of an exponential through the peak and the last
+sample.
+
+Usage:
+    python waveformStats.py <run folder> [--channels 4 5] [-o table.csv]
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from qdAnalysis import _chunk, _rowCumsum, blockRows, clippedRows
+from runStore import RunStore, openRun
+from trcIndex import DEFAULT_PATTERN, readChannelNames
+from waveformDefaults import IMAGE_START, SMOOTH_FRACTION
+
+# %%DEFAULTS
+MAX_SAMPLES = 50000  # Per record; longer ones are block averaged first
+CHUNK_SHOTS = 64  # Shots decoded and analysed together
+MIN_SAMPLES = 16  # Shorter records (empty channels) are left out
+RESULTS_NAME = "{}_Stats.csv"
+
+
+# %%OUTPUT, NEXT TO THE OTHER PER-RUN TABLES
+def resultsPath(dataDir):
+    """Where a run's feature table goes: <run>/<run>_Stats/<run>_Stats.csv"""
+    name = os.path.basename(os.path.normpath(dataDir))
+    return os.path.join(dataDir, "{}_Stats".format(name),
+                        RESULTS_NAME.format(name))
+
+
+# %%THE KERNEL, ALL SHOTS AT ONCE
+def _smoothedRows(z, width):
+    # Centred moving average of every row by cumulative sums, same shape
+    if width <= 1:
+        return z
+    n = z.shape[1]
+    total = _rowCumsum(z)
+    lo = np.clip(np.arange(n) - width // 2, 0, n)
+    hi = np.clip(lo + width, 0, n)
+    return (total[:, hi] - total[:, lo]) / (hi - lo)
+
+
+def _crossing(z, rows, i, level):
+    # Fractional sample where each row of z passes level between i and i+1
+    i = np.clip(i, 0, z.shape[1] - 2)
+    a, b = z[rows, i], z[rows, i + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where(b != a, (level - a) / (b - a), 0.0)
+    return i + np.clip(frac, 0.0, 1.0)
+
+
+def _baseCount(start, step, pre, n):
+    # Samples before pre in each record, or the first tenth of the record
+    # when that leaves fewer than two or all of them
+    with np.errstate(divide="ignore", invalid="ignore"):
+        count = np.nan_to_num(np.clip(np.ceil((pre - start) / step), 0, n))
+    count = count.astype(int)
+    count[(count < 2) | (count == n)] = int(0.1 * (n - 1)) + 1
+    return count
+
+
+def waveformStats(y, start, step, pre=IMAGE_START,
+                  smoothFraction=SMOOTH_FRACTION, maxSamples=MAX_SAMPLES):
+    """Baseline, noise, image charge, peak, rise and decay of every record,
+    with whole-array operations only.
+
+        Args:
+           y (np.ndarray): (shots, samples) amplitudes (V).
+
+           start (np.ndarray): (shots,) time of the first sample of each
+           record (s).
+
+           step (np.ndarray): (shots,) sample interval of each record (s).
+
+        Kwargs:
+           pre (float): The end of the baseline window (s). If fewer than
+           two samples come before it, the first tenth of the record is
+           used, as in SudaIonTarget.pulseGuess.
+
+           smoothFraction (float): The moving average width, as a fraction
+           of the record.
+
+           maxSamples (int): Longer records are block averaged down to this
+           many samples before smoothing; None keeps every sample.
+
+        Returns:
+           stats (dict): (shots,) arrays baseline and noise (V, the noise
+           with one degree of freedom like pandas), image (V, the lowest
+           baseline-subtracted level before the trigger, NaN without a
+           window), peak (V, signed, baseline subtracted), peakTime, rise
+           (10-90%) and decay (time constant) (s).
+
+        Raises:
+           None
+           """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    start = np.broadcast_to(np.asarray(start, dtype=float), len(y))
+    step = np.broadcast_to(np.asarray(step, dtype=float), len(y))
+    shots, n = y.shape
+    rows = np.arange(shots)
+
+    # Baseline window [0, nBase) of every record, at full resolution
+    nBase = _baseCount(start, step, pre, n)
+    head = y[:, :nBase.max()]
+    inBase = np.arange(head.shape[1])[None, :] < nBase[:, None]
+    baseline = np.where(inBase, head, 0.0).sum(axis=1) / nBase
+    deviation = np.where(inBase, head - baseline[:, None], 0.0)
+    noise = np.sqrt((deviation**2.0).sum(axis=1) / np.maximum(nBase - 1, 1))
+
+    # The levels, from the smoothed and baseline subtracted records
+    z, start, step = blockRows(y - baseline[:, None], start, step,
+                               maxSamples)
+    n = z.shape[1]
+    nBase = np.clip(_baseCount(start, step, pre, n), 1, n - 1)
+    idx = np.arange(n)[None, :]
+    t = start[:, None] + idx * step[:, None]
+    s = _smoothedRows(z, int(smoothFraction * n))
+
+    # Image charge: the lowest level between the baseline and the trigger
+    window = (idx >= nBase[:, None]) & (t < 0.0)
+    image = np.where(window, s, np.inf).min(axis=1)
+    image[~window.any(axis=1)] = np.nan
+
+    # The extremum after the baseline sets polarity and height
+    k = np.argmax(np.where(idx >= nBase[:, None], np.abs(s), -1.0), axis=1)
+    peak = s[rows, k]
+    height = np.abs(peak)
+    zz = np.where(peak >= 0.0, 1.0, -1.0)[:, None] * s
+
+    # 10-90% rise: the last 10% crossing before the peak, the first 90% one
+    # after it
+    below10 = (idx <= k[:, None]) & (zz < 0.1 * height[:, None])
+    i10 = np.where(below10.any(axis=1),
+                   n - 1 - np.argmax(below10[:, ::-1], axis=1), nBase)
+    above90 = (idx >= i10[:, None]) & (zz >= 0.9 * height[:, None])
+    i90 = np.maximum(np.argmax(above90, axis=1) - 1, i10)
+    rise = (_crossing(zz, rows, i90, 0.9 * height)
+            - _crossing(zz, rows, i10, 0.1 * height)) * step
+
+    # Decay: the 90-10% fall over ln 9, or the fraction left at the end
+    fell90 = (idx >= k[:, None]) & (zz < 0.9 * height[:, None])
+    fell10 = (idx >= k[:, None]) & (zz < 0.1 * height[:, None])
+    j90, j10 = np.argmax(fell90, axis=1), np.argmax(fell10, axis=1)
+    fell = fell10.any(axis=1) & (j10 > j90)
+    fall = (_crossing(zz, rows, j10 - 1, 0.1 * height)
+            - _crossing(zz, rows, j90 - 1, 0.9 * height)) * step
+    with np.errstate(divide="ignore", invalid="ignore"):
+        left = np.clip(zz[:, -1] / height, 0.01, 0.99)
+        decay = np.where(fell, fall / np.log(9.0),
+                         (n - 1 - k) * step / -np.log(left))
+    flat = ~(height > 0.0)
+    rise[flat], decay[flat] = np.nan, np.nan
+
+    return {"baseline": baseline,
+            "noise": noise,
+            "image": image,
+            "peak": peak,
+            "peakTime": t[rows, k],
+            "rise": rise,
+            "decay": decay}
+
+
+# %%A WHOLE RUN
+def statsRun(dataDir, channels=None, pattern=DEFAULT_PATTERN,
+             pre=IMAGE_START, chunkShots=CHUNK_SHOTS, verbose=False):
+    """Run :func:`waveformStats` over every shot and channel of a run,
+    chunkShots shots at a time.
+
+        Args:
+           dataDir (str): The run folder (or its consolidated store).
+
+        Kwargs:
+           channels (list): The channel columns, by default all of them.
+           Channels with records shorter than MIN_SAMPLES are left out.
+
+           pattern (str): The trace file name pattern.
+
+           pre (float): See :func:`waveformStats`.
+
+           chunkShots (int): Shots decoded and analysed together.
+
+           verbose (bool): Print every chunk.
+
+        Returns:
+           df (pd.DataFrame): One row per shot and channel: Trace Number,
+           Channel, Channel Name, Baseline (V), Noise (V), Image Charge (V),
+           Peak (V), Peak Time (s), Rise Time (s), Decay Time (s) and
+           Clipped.
+
+        Raises:
+           None
+           """
+    names = readChannelNames(dataDir) or []
+
+    # The shots are planned from the run they are decoded from
+    run = openRun(dataDir, pattern=pattern, cacheBytes=0)
+    parts = []
+    try:
+        if channels is None:
+            channels = range(run.nChannels)
+        channels = [c for c in channels if 0 <= c < run.nChannels]
+        for first in range(0, run.nShots, chunkShots):
+            shotIdxs = range(first, min(first + chunkShots, run.nShots))
+            for channel in channels:
+                y, start, step = _chunk(run, shotIdxs, channel)
+                if y.shape[1] < MIN_SAMPLES:
+                    continue
+                stats = waveformStats(y, start, step, pre=pre)
+                stats["clipped"] = clippedRows(y)
+                stats["shot"] = np.asarray(shotIdxs)
+                stats["channel"] = np.full(len(y), channel)
+                parts.append(stats)
+            if verbose:
+                print("Shots {}-{} done".format(first + 1, shotIdxs[-1] + 1))
+    finally:
+        if isinstance(run, RunStore):
+            run.close()
+
+    columns = {key: np.concatenate([part[key] for part in parts])
+               for key in parts[0]} if parts else {}
+    channel = columns.get("channel", np.empty(0, int))
+    df = pd.DataFrame({
+        "Trace Number": columns.get("shot", np.empty(0, int)) + 1,
+        "Channel": channel,
+        "Channel Name": [names[c] if c < len(names) else "" for c in channel],
+        "Baseline (V)": columns.get("baseline", np.empty(0)),
+        "Noise (V)": columns.get("noise", np.empty(0)),
+        "Image Charge (V)": columns.get("image", np.empty(0)),
+        "Peak (V)": columns.get("peak", np.empty(0)),
+        "Peak Time (s)": columns.get("peakTime", np.empty(0)),
+        "Rise Time (s)": columns.get("rise", np.empty(0)),
+        "Decay Time (s)": columns.get("decay", np.empty(0)),
+        "Clipped": columns.get("clipped", np.empty(0, bool))})
+    return df.sort_values(["Trace Number", "Channel"], kind="stable",
+                          ignore_index=True)
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Baseline, noise, image charge, peak, rise and decay of "
+        "every waveform of a run.")
+    parser.add_argument("dataDir", help="run folder containing .trc files")
+    parser.add_argument("-o", "--output", default=None,
+                        help="CSV file (default "
+                        "<run>/<run>_Stats/<run>_Stats.csv)")
+    parser.add_argument("--channels", type=int, nargs="+", default=None,
+                        help="channel columns (default: all)")
+    parser.add_argument("--pre", type=float, default=IMAGE_START,
+                        help="end of the baseline window in s")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="trace file name regular expression")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    df = statsRun(args.dataDir, args.channels, pattern=args.pattern,
+                  pre=args.pre, verbose=args.verbose)
+    output = args.output or resultsPath(args.dataDir)
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    df.to_csv(output, index=False)
+    print("{} waveforms of {} shots, wrote {}".format(
+        len(df), df["Trace Number"].nunique(), output))
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()
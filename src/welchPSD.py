@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming Welch power spectral density of many noise records, from trace
+runs or HDF5 spectrum exports, in bounded memory.
+
+__author__      = Ethan Ayari,
+Institute for Modeling Plasmas, Atmospheres and Cosmic Dust
+
+Works with Python 3.8.10
+
+Every record is cut into overlapping windowed segments of its own, so no
+segment straddles the join between two records, and only the running sum
+of the segment periodograms is kept. Sums from different workers add up
+to the sum over all their records, so a run is split into chunks of
+shots, each summed in a pool process, and the parts merged. The estimate
+matches scipy.signal.welch (constant detrend, density scaling, mean
+average) over the same segments.
+
+Usage:
+    python welchPSD.py <run folder> [--channel 5] [-o psd.csv]
+    python welchPSD.py <export.h5> [--field Amplitude] [-o psd.csv]
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import get_window
+
+from runFits import ION_GRID_CHANNEL, _streamed
+from runStore import sharedRun
+from spectraStore import H5SpectraStore
+from trcIndex import DEFAULT_PATTERN, indexRun
+from waveformDefaults import IMAGE_START
+
+# %%DEFAULTS
+NPERSEG = 4096  # Samples per segment, the frequency resolution
+OVERLAP = 0.5  # Fraction of a segment shared with the next one
+WINDOW = "hann"
+CHUNK_SHOTS = 16  # Shots one pool task sums
+WORKER_CACHE_BYTES = 0  # Each shot is read once, nothing to cache
+STEP_TOLERANCE = 1.0e-6  # Relative sample interval mismatch allowed
+
+
+# %%OUTPUT, NEXT TO THE OTHER PER-RUN TABLES
+def resultsPath(dataDir, channel):
+    """Where a run's noise spectrum goes:
+    <run>/<run>_Noise/<run>_PSD_C<channel>.csv"""
+    name = os.path.basename(os.path.normpath(dataDir))
+    return os.path.join(dataDir, "{}_Noise".format(name),
+                        "{}_PSD_C{}.csv".format(name, channel))
+
+
+# %%THE RUNNING ESTIMATE
+class WelchPSD:
+
+    def __init__(self, nperseg=NPERSEG, step=None, window=WINDOW,
+                 overlap=OVERLAP):
+        """A Welch estimate that records are added to one at a time. Only
+        the summed periodogram and a few counts are kept, so the memory
+        does not grow with the number of records, and the object pickles
+        small enough to be returned from a pool worker.
+
+        Args:
+           None
+
+        Kwargs:
+           nperseg (int): Samples per segment.
+
+           step (float): The sample interval (s); taken from the first
+           record added with one if None.
+
+           window (str): A scipy.signal.get_window name.
+
+           overlap (float): Fraction of a segment shared with the next.
+
+        Returns:
+           None
+
+        Raises:
+           None
+           """
+        self.nperseg = int(nperseg)
+        self.step = step
+        self.window = window
+        self.overlap = overlap
+        self._window = get_window(window, self.nperseg)
+        self.total = np.zeros(self.nperseg // 2 + 1)
+        self.segments = 0
+        self.records = 0
+        self.samples = 0
+        self.skipped = 0
+
+    @property
+    def hop(self):
+        return max(1, self.nperseg - int(self.overlap * self.nperseg))
+
+    def _checkStep(self, step):
+        if step is None:
+            return
+        if self.step is None:
+            self.step = float(step)
+        elif not np.isclose(step, self.step, rtol=STEP_TOLERANCE, atol=0.0):
+            raise ValueError("Sample interval {} s differs from {} s".format(
+                step, self.step))
+
+    # %%ADD RECORDS
+    def add(self, y, step=None):
+        """Add the segments of one record, or of each row of a (records,
+        samples) array. Records shorter than a segment are only counted in
+        skipped.
+
+        Args:
+           y (np.ndarray): The amplitudes.
+
+        Kwargs:
+           step (float): The sample interval of y (s).
+
+        Returns:
+           self (WelchPSD): For chaining.
+
+        Raises:
+           ValueError: step differs from that of the records added before.
+           """
+        self._checkStep(step)
+        for record in np.atleast_2d(np.asarray(y, dtype=float)):
+            self.samples += len(record)
+            if len(record) < self.nperseg:
+                self.skipped += 1
+                continue
+            segments = sliding_window_view(record, self.nperseg)[::self.hop]
+            segments = segments - segments.mean(axis=1, keepdims=True)
+            spectra = np.fft.rfft(segments * self._window, axis=1)
+            self.total += (spectra.real**2 + spectra.imag**2).sum(axis=0)
+            self.segments += len(segments)
+            self.records += 1
+        return self
+
+    # %%COMBINE PARTIAL ESTIMATES
+    def merge(self, other):
+        """Add the records of another estimate with the same segments,
+        window and sample interval, e.g. one summed by a pool worker.
+
+        Args:
+           other (WelchPSD): The partial estimate.
+
+        Kwargs:
+           None
+
+        Returns:
+           self (WelchPSD): For chaining.
+
+        Raises:
+           ValueError: The two estimates do not have the same settings.
+           """
+        if (other.nperseg, other.window, other.hop) != (
+                self.nperseg, self.window, self.hop):
+            raise ValueError("Cannot merge Welch estimates with different "
+                             "segments or windows")
+        self._checkStep(other.step)
+        self.total += other.total
+        self.segments += other.segments
+        self.records += other.records
+        self.samples += other.samples
+        self.skipped += other.skipped
+        return self
+
+    __iadd__ = merge
+
+    # %%THE SPECTRUM
+    def psd(self):
+        """The one-sided power spectral density.
+
+        Args:
+           None
+
+        Kwargs:
+           None
+
+        Returns:
+           freqs (np.ndarray): The frequencies (Hz), nperseg // 2 + 1 of
+           them.
+
+           psd (np.ndarray): The density (amplitude units^2/Hz), NaN before
+           any segment was added.
+
+        Raises:
+           None
+           """
+        step = 1.0 if self.step is None else self.step
+        freqs = np.fft.rfftfreq(self.nperseg, step)
+        if not self.segments:
+            return freqs, np.full(len(freqs), np.nan)
+        psd = self.total * step / (self.segments *
+                                   (self._window**2).sum())
+        psd[1:len(psd) - (self.nperseg % 2 == 0)] *= 2.0
+        return freqs, psd
+
+
+# %%RECORDS OF A TRACE RUN
+def _shotsPSD(dataDir, pattern, shotIdxs, channel, nperseg, window, overlap,
+              pre):
+    # The sum over some shots of one channel, in a pool process
+    run = sharedRun(dataDir, pattern=pattern, cacheBytes=WORKER_CACHE_BYTES)
+    welch = WelchPSD(nperseg, window=window, overlap=overlap)
+    for shotIdx in shotIdxs:
+        times, amps = run.shot(shotIdx)
+        t = np.asarray(times[channel], dtype=float)
+        y = np.asarray(amps[channel], dtype=float)
+        if len(t) < 2:
+            continue
+        if pre is not None:
+            y = y[t < pre]
+        welch.add(y, step=(t[-1] - t[0]) / (len(t) - 1))
+    return welch
+
+
+def runPSD(dataDir, channel=ION_GRID_CHANNEL, shots=None, nperseg=NPERSEG,
+           window=WINDOW, overlap=OVERLAP, pre=IMAGE_START,
+           chunkShots=CHUNK_SHOTS, workers=None, pattern=DEFAULT_PATTERN,
+           pool=None):
+    """The Welch PSD of one channel over many shots of a run, summed
+    chunkShots shots at a time in a process pool and merged.
+
+        Args:
+           dataDir (str): The run folder (or its consolidated store).
+
+        Kwargs:
+           channel (int): The channel column.
+
+           shots (list): The shot indices, every shot by default.
+
+           nperseg (int): Samples per segment.
+
+           window (str): A scipy.signal.get_window name.
+
+           overlap (float): Fraction of a segment shared with the next.
+
+           pre (float): Only the samples before this time (s), the noise
+           ahead of the image charge; None for whole records.
+
+           chunkShots (int): Shots one pool task sums.
+
+           workers (int): Pool size, defaults to the number of cores.
+
+           pattern (str): The trace file name pattern.
+
+           pool (Executor): A pool to use instead of starting one.
+
+        Returns:
+           welch (WelchPSD): The merged estimate.
+
+           errors (list): (shots, error) of the chunks that could not be
+           read; their shots are left out.
+
+        Raises:
+           ValueError: The run has no such channel.
+           """
+    dataDir = os.path.abspath(dataDir)
+    index = indexRun(dataDir, pattern=pattern)
+    if not 0 <= channel < index.nChannels:
+        raise ValueError("{} has {} channels, no channel {}".format(
+            dataDir, index.nChannels, channel))
+    if shots is None:
+        shots = range(index.nShots)
+    shots = list(shots)
+    chunks = [shots[i:i + chunkShots] for i in range(0, len(shots),
+                                                     chunkShots)]
+
+    welch = WelchPSD(nperseg, window=window, overlap=overlap)
+    errors = []
+    results = _streamed(pool, workers, lambda pool: {
+        pool.submit(_shotsPSD, dataDir, pattern, chunk, channel, nperseg,
+                    window, overlap, pre): chunk for chunk in chunks})
+    for chunk, part, error in results:
+        if error is not None:
+            errors.append((chunk, error))
+        else:
+            welch.merge(part)
+    return welch, errors
+
+
+# %%RECORDS OF AN HDF5 EXPORT
+def exportPSD(path, field="Amplitude", nperseg=NPERSEG, window=WINDOW,
+              overlap=OVERLAP, chunkSize=None):
+    """The Welch PSD of one dataset over every spectrum of an export, read
+    a chunk of spectra at a time (see spectraStore.H5SpectraStore). The
+    sample interval of each spectrum comes from the first two samples of
+    its Time dataset.
+
+        Args:
+           path (str): The HDF5 export.
+
+        Kwargs:
+           field (str): The dataset, e.g. "Amplitude".
+
+           nperseg (int): Samples per segment.
+
+           window (str): A scipy.signal.get_window name.
+
+           overlap (float): Fraction of a segment shared with the next.
+
+           chunkSize (int): Spectra read together, the store's default if
+           None.
+
+        Returns:
+           welch (WelchPSD): The estimate.
+
+        Raises:
+           ValueError: The spectra do not share one sample interval.
+           """
+    welch = WelchPSD(nperseg, window=window, overlap=overlap)
+    with H5SpectraStore(path) as store:
+        keys = [key for key in store if "Time" in store.fields(key)]
+        kwargs = {} if chunkSize is None else {"chunkSize": chunkSize}
+        for names, chunk in store.iterChunks((field,), keys=keys, **kwargs):
+            for name, y in zip(names, chunk[field]):
+                t = store.read(name, "Time", 0, 2)
+                welch.add(y, step=float(t[1] - t[0]) if len(t) > 1
+                          else None)
+    return welch
+
+
+# %%COMMAND LINE INTERFACE
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Welch power spectral density of the noise of a run or "
+        "of an HDF5 spectrum export.")
+    parser.add_argument("path", help="run folder or HDF5 export")
+    parser.add_argument("-o", "--output", default=None,
+                        help="CSV file (default, for a run: "
+                        "<run>/<run>_Noise/<run>_PSD_C<channel>.csv)")
+    parser.add_argument("-c", "--channel", type=int,
+                        default=ION_GRID_CHANNEL,
+                        help="channel column of a run")
+    parser.add_argument("--field", default="Amplitude",
+                        help="dataset of an export")
+    parser.add_argument("--nperseg", type=int, default=NPERSEG,
+                        help="samples per segment")
+    parser.add_argument("--whole-records", action="store_true",
+                        help="use whole records of a run, not only the "
+                        "samples before the image charge")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="pool size (default: number of cores)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="trace file name regular expression")
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.path):
+        welch, errors = runPSD(args.path, args.channel,
+                               nperseg=args.nperseg,
+                               pre=None if args.whole_records
+                               else IMAGE_START,
+                               workers=args.workers, pattern=args.pattern)
+        for chunk, error in errors:
+            print("Shots {}-{} failed: {}".format(chunk[0] + 1,
+                                                  chunk[-1] + 1, error))
+        output = args.output or resultsPath(args.path, args.channel)
+    else:
+        welch = exportPSD(args.path, args.field, nperseg=args.nperseg)
+        output = args.output or os.path.splitext(args.path)[0] + "_PSD.csv"
+
+    freqs, psd = welch.psd()
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    pd.DataFrame({"Frequency (Hz)": freqs,
+                  "PSD (units^2/Hz)": psd}).to_csv(output, index=False)
+    print("{} segments of {} records ({} too short), wrote {}".format(
+        welch.segments, welch.records, welch.skipped, output))
+
+
+# %%EXECUTABLE CODE BELOW
+if __name__ == "__main__":
+    main()